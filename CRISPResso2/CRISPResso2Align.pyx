@@ -6,8 +6,10 @@ import numpy as np
 cimport numpy as np
 
 from libc.stdlib cimport free, malloc
+from libc.string cimport memcpy
 
 cimport cython
+from CRISPResso2.CRISPRessoCOREResources cimport find_edits
 import sys
 import os.path
 
@@ -21,6 +23,25 @@ ctypedef long DTYPE_LONG
 
 cdef size_t UP = 1, LEFT = 2, DIAG = 3, NONE = 4
 cdef size_t MARRAY = 1, IARRAY = 2, JARRAY = 3
+#match counts and alignment lengths are packed into one int in the score-only kernel
+cdef enum:
+    COUNT_SHIFT = 16
+    COUNT_MASK = 0xFFFF
+#pointers of the M, I and J matrices are packed into one byte per cell
+cdef enum:
+    POINTER_BITS = 2
+    POINTER_MASK = 0x3
+#number of pointer cells kept at once by the linear-space traceback
+cdef enum:
+    LINEAR_BLOCK_CELLS = 1 << 22
+#range of the 16-bit scores used by the compact fill
+cdef enum:
+    SCORE16_MIN = -32768
+    SCORE16_MAX = 32767
+
+ctypedef fused score_t:
+    short
+    int
 
 
 cdef char* get_c_string_with_length(size_t length):
@@ -100,335 +121,1063 @@ def make_matrix(match_score=5, mismatch_score=-4, n_mismatch_score=-2, n_match_s
 
 @cython.boundscheck(False)
 @cython.nonecheck(False)
-def global_align(str pystr_seqj, str pystr_seqi, np.ndarray[DTYPE_LONG, ndim=2] matrix,
-          np.ndarray[DTYPE_LONG,ndim=1] gap_incentive, int gap_open=-1,
-          int gap_extend=-1):
+cdef inline void _store_score(score_t* dest, int val, int neg_cap, int low, bint* overflow) noexcept nogil:
     """
-    Global sequence alignment (needleman-wunsch) on seq i and j.
-    Reference is seq_i, sequenced read is seq_j
-    Match and mismatch values are read from matrix object
-    where matrix is of the format provided in the ncbi/data directory.
-    gap_incentive is the incentive for having a gap at each position in seqi -
-      this allows for the preferential location of gaps to be at the predicted
-      cut site in genome editing experiments.
-
+    Store a score computed in int in dest. For 16-bit scores, values that can only derive from
+    unreachable cells (at most neg_cap) are stored as SCORE16_MIN, and any other value outside of [low, SCORE16_MAX] sets overflow.
     """
+    if score_t is int:
+        dest[0] = val
+    else:
+        if val <= neg_cap:
+            dest[0] = SCORE16_MIN
+        else:
+            if val < low or val > SCORE16_MAX:
+                overflow[0] = True
+            dest[0] = <score_t> val
 
-    byte_seqj = pystr_seqj.encode('UTF-8')
-    cdef char* seqj = byte_seqj
-    byte_seqi = pystr_seqi.encode('UTF-8')
-    cdef char* seqi = byte_seqi
-
-    cdef size_t max_j = len(pystr_seqj)
-    cdef size_t max_i = len(pystr_seqi)
-    if len(gap_incentive) != max_i + 1:
-        print('\nERROR: Mismatch in gap_incentive length (gap_incentive: ' + str(len(gap_incentive)) + ' ref: '+str(max_i+1) + '\n')
-        return 0
-
-    # need to initialize j for the case when it's a zero-length string.
-    cdef size_t i = 0, j = 0, seqlen, align_counter = 0, p
-    cdef int diag_score, up_score, left_score, tscore
-
-    cdef str align_j
-    cdef str align_i
-    cdef char ci
-    cdef char cj
-
-    #create 3 arrays of scores and 3 arrays of pointers
-    # M array - best alignment so far ending with a match
-    # I array - best alignment so far ending with a gap in Read (J) (insertion in ref, deletion in read)
-    # J array - best alignment so far ending with a gap in Ref (I) (deletion in ref, insertion in read)
-
-    cdef int [:,:] mScore = np.empty((max_i + 1, max_j + 1), dtype=np.dtype("i"))
-    cdef int [:,:] iScore = np.empty((max_i + 1, max_j + 1), dtype=np.dtype("i"))
-    cdef int [:,:] jScore = np.empty((max_i + 1, max_j + 1), dtype=np.dtype("i"))
-    cdef int [:,:] mPointer = np.empty((max_i + 1, max_j + 1), dtype=np.dtype("i"))
-    cdef int [:,:] iPointer = np.empty((max_i + 1, max_j + 1), dtype=np.dtype("i"))
-    cdef int [:,:] jPointer = np.empty((max_i + 1, max_j + 1), dtype=np.dtype("i"))
-
-
-    cdef int min_score = gap_open * max_j * max_i
-
-    #init match matrix
-    mScore[0,1:] = min_score
-    mScore[1:,0] = min_score
-    mScore[0,0] = 0
-    mPointer[0,1:] = IARRAY
-    mPointer[1:,0] = JARRAY
-    mPointer[0,0] = 0
-
-# no penalty for gaps starting at beginning
-#    score[0, 1:] = 0
-#    score[1:, 0] = 0
-# gap extension penalty for gaps starting at beginning
-    #init i matrix
-    for i in range(1,max_j+1):
-        iScore[0,i] = gap_extend * i + gap_incentive[0]
-#    iScore[0,1:] = [gap_extend * np.arange(1, max_j+1, dtype=int)]
-    iScore[0:,0] = min_score
-    iPointer[0,1:] = IARRAY
-
-    #init j matrix
-    for i in range(1,max_i+1):
-        jScore[i,0] = gap_extend * i + gap_incentive[0]
-    #jScore[1:,0] = np.vectorize(gap_extend * np.arange(1, max_i+1, dtype=int))
-    jScore[0,0:] = min_score
-    jPointer[1:,0] = JARRAY
-
-#    print('gap penalty is'+str(gap_incentive))
-
-    cdef int iFromMVal
-    cdef int iExtendVal
-    cdef int jFromMVal
-    cdef int jExtendVal
-    cdef int mVal, iVal, jVal
 
-    #apply NW algorithm for inside squares (not last row or column)
-    for i in range(1, max_i):
+@cython.boundscheck(False)
+@cython.nonecheck(False)
+cdef bint _nw_fill(const char* seqj, const char* seqi, Py_ssize_t max_j, Py_ssize_t max_i,
+        const DTYPE_LONG[:, ::1] matrix, const DTYPE_LONG[:] gap_incentive,
+        int gap_open, int gap_extend, int min_score, Py_ssize_t band_lo, Py_ssize_t band_hi, int band_floor,
+        int neg_cap, int low, Py_ssize_t start_row, Py_ssize_t end_row,
+        score_t* rows, unsigned char* pointers, Py_ssize_t pointer_stride, int* last_scores) noexcept nogil:
+    """
+    Fill rows start_row to end_row of the pointer matrix (one byte per cell holding the M, I and J pointers
+    as M | I << POINTER_BITS | J << 2 * POINTER_BITS). Row i is stored at pointers + (i - start_row) * pointer_stride,
+    so a pointer_stride of max_j + 1 stores the rows one after the other and a pointer_stride of 0 only computes the scores.
+    Only two rows of scores are kept (rows must hold 6 * (max_j + 1) scores). If start_row is 0, the first row is initialized;
+    otherwise the first 3 * (max_j + 1) scores of rows must hold the M, I and J scores of start_row.
+    On return, they hold the scores of end_row, and the scores of the last cell of end_row are written to last_scores.
+    Only cells with band_lo <= j - i <= band_hi are computed; the cells bordering
+    the band are set to band_floor so that no path can enter them.
+    For the last column and last row, the gap opening penalty is ignored.
+
+    With 16-bit scores, cells that can only be reached from the initialized borders or from outside of the band
+    (at most neg_cap) hold SCORE16_MIN instead of min_score or band_floor. Every other score must be in [low, SCORE16_MAX];
+    if one isn't, False is returned and the result must be discarded. Otherwise the pointers on every optimal path
+    and the scores of the last cell are identical to those computed with int scores.
+    """
+    cdef Py_ssize_t w = max_j + 1
+    cdef Py_ssize_t i, j, jstart, jend, row
+    cdef int gap, inc_i, inc_prev
+    cdef int iFromMVal, iExtendVal, jFromMVal, jExtendVal
+    cdef int mVal, iVal, jVal, best
+    cdef int m_left, i_left
+    cdef unsigned char pointer
+    cdef char ci, cj
+    cdef const DTYPE_LONG* match_row
+    cdef bint overflow = False
+    cdef score_t floor_val
+    cdef score_t* mS
+    cdef score_t* iS
+    cdef score_t* jS
+    cdef score_t* pmS
+    cdef score_t* piS
+    cdef score_t* pjS
+    cdef score_t* swap_s
+
+    if score_t is int:
+        floor_val = band_floor
+    else:
+        floor_val = SCORE16_MIN
+        min_score = SCORE16_MIN
+
+    pmS = rows
+    piS = rows + w
+    pjS = rows + 2 * w
+    mS = rows + 3 * w
+    iS = rows + 4 * w
+    jS = rows + 5 * w
+
+    if start_row == 0:
+        #init match, i and j matrices
+        for j in range(w):
+            _store_score(&pmS[j], min_score, neg_cap, low, &overflow)
+            _store_score(&piS[j], gap_extend * j + gap_incentive[0], neg_cap, low, &overflow)
+            _store_score(&pjS[j], min_score, neg_cap, low, &overflow)
+            pointers[j] = IARRAY | IARRAY << POINTER_BITS | JARRAY << 2 * POINTER_BITS
+        pmS[0] = 0
+        pointers[0] = IARRAY << POINTER_BITS | JARRAY << 2 * POINTER_BITS
+        _store_score(&piS[0], min_score, neg_cap, low, &overflow)
+
+        #close off the part of the first row that falls outside of the band
+        for j in range(band_hi + 1, max_j + 1):
+            piS[j] = floor_val
+
+    for i in range(start_row + 1, end_row + 1):
         ci = seqi[i - 1] #char in i
-
-        for j in range(1, max_j):
+        match_row = &matrix[ci, 0]
+        row = (i - start_row) * pointer_stride
+        inc_i = gap_incentive[i]
+        inc_prev = gap_incentive[i - 1]
+
+        #first column, closed off where it falls outside of the band
+        _store_score(&mS[0], min_score, neg_cap, low, &overflow)
+        _store_score(&iS[0], min_score, neg_cap, low, &overflow)
+        if i <= -band_lo:
+            _store_score(&jS[0], gap_extend * i + gap_incentive[0], neg_cap, low, &overflow)
+        else:
+            jS[0] = floor_val
+        pointers[row] = JARRAY | IARRAY << POINTER_BITS | JARRAY << 2 * POINTER_BITS
+
+        jstart = i + band_lo
+        if jstart < 1:
+            jstart = 1
+        jend = i + band_hi
+        if jend > max_j:
+            jend = max_j
+        if jstart > 1:
+            mS[jstart - 1] = floor_val
+            iS[jstart - 1] = floor_val
+            jS[jstart - 1] = floor_val
+        if jend < max_j:
+            mS[jend + 1] = floor_val
+            iS[jend + 1] = floor_val
+            jS[jend + 1] = floor_val
+
+        #for last column and last row, ignore gap opening penalty
+        gap = gap_extend if i == max_i else gap_open
+        #values of the cell to the left are kept in registers
+        m_left = mS[jstart - 1]
+        i_left = iS[jstart - 1]
+        for j in range(jstart, jend + 1):
             cj = seqj[j - 1] #char in j
+            if j == max_j:
+                gap = gap_extend
 
-            iFromMVal = gap_open + mScore[i, j - 1] + gap_incentive[i]
-            iExtendVal = gap_extend + iScore[i, j - 1] + gap_incentive[i]
+            iFromMVal = gap + m_left + inc_i
+            iExtendVal = gap_extend + i_left + inc_i
             if iFromMVal > iExtendVal:
-                iScore[i,j] = iFromMVal
-                iPointer[i,j] = MARRAY
+                i_left = iFromMVal
+                pointer = MARRAY << POINTER_BITS
             else:
-                iScore[i,j] = iExtendVal
-                iPointer[i,j] = IARRAY
-
-            jFromMVal = gap_open + mScore[i - 1, j] + gap_incentive[i-1]
-	    #no gap incentive here -- J already got the gap incentive when it transitioned from M, so don't add it again if we're extending.
-            jExtendVal = gap_extend + jScore[i - 1, j]
+                i_left = iExtendVal
+                pointer = IARRAY << POINTER_BITS
+            _store_score(&iS[j], i_left, neg_cap, low, &overflow)
+            i_left = iS[j]
+
+            jFromMVal = gap + pmS[j] + inc_prev
+            #no gap incentive here -- J already got the gap incentive when it transitioned from M, so don't add it again if we're extending.
+            jExtendVal = gap_extend + pjS[j]
             if jFromMVal > jExtendVal:
-                jScore[i,j] =  jFromMVal
-                jPointer[i,j] = MARRAY
+                _store_score(&jS[j], jFromMVal, neg_cap, low, &overflow)
+                pointer |= MARRAY << 2 * POINTER_BITS
             else:
-                jScore[i,j] = jExtendVal
-                jPointer[i,j] = JARRAY
+                _store_score(&jS[j], jExtendVal, neg_cap, low, &overflow)
+                pointer |= JARRAY << 2 * POINTER_BITS
 
-            mVal = mScore[i - 1, j - 1] + matrix[ci,cj]
-            iVal = iScore[i - 1, j - 1] + matrix[ci,cj]
-            jVal = jScore[i - 1, j - 1] + matrix[ci,cj]
+            #same choice as _best_of: J if strictly better than I, then M if strictly better than both
+            mVal = pmS[j - 1]
+            iVal = piS[j - 1]
+            jVal = pjS[j - 1]
             if mVal > jVal:
                 if mVal > iVal:
-                    mScore[i, j] = mVal
-                    mPointer[i, j] = MARRAY
+                    best = mVal
+                    pointer |= MARRAY
                 else:
-                    mScore[i, j]   = iVal
-                    mPointer[i, j] = IARRAY
+                    best = iVal
+                    pointer |= IARRAY
             else:
                 if jVal > iVal:
-                    mScore[i, j]  = jVal
-                    mPointer[i, j] = JARRAY
+                    best = jVal
+                    pointer |= JARRAY
                 else:
-                    mScore[i, j] = iVal
-                    mPointer[i, j] = IARRAY
-
-#            print('mScore['+str(i) + ',' + str(j) +']: ' + str(mScore[i,j]) + ': max(' + str(mScore[i - 1, j - 1])+ '+ (' + str(ci)+ ',' + str(cj) + ') ' + str(matrix[ci,cj]) + ', i:'+str(iVal) + ',j:' + str(jVal))
-
-    #for last column and last row, ignore gap opening penalty
-    #last column
-    j = max_j
-    cj = seqj[j-1]
-    for i in range(1, max_i):
-        ci = seqi[i-1]
-
-        iFromMVal = gap_extend + mScore[i, j - 1] + gap_incentive[i]
-        iExtendVal = gap_extend + iScore[i, j - 1] + gap_incentive[i]
-        if iFromMVal > iExtendVal:
-            iScore[i,j] =  iFromMVal
-            iPointer[i,j] = MARRAY
-        else:
-            iScore[i,j] = iExtendVal
-            iPointer[i,j] = IARRAY
-
-        jFromMVal = gap_extend + mScore[i - 1, j] + gap_incentive[i-1]
-        jExtendVal = gap_extend + jScore[i - 1, j]
-        if jFromMVal > jExtendVal:
-            jScore[i,j] =  jFromMVal
-            jPointer[i,j] = MARRAY
-        else:
-            jScore[i,j] = jExtendVal
-            jPointer[i,j] = JARRAY
-
-        mVal = mScore[i - 1, j - 1] + matrix[ci,cj]
-        iVal = iScore[i - 1, j - 1] + matrix[ci,cj]
-        jVal = jScore[i - 1, j - 1] + matrix[ci,cj]
-        if mVal > jVal:
-            if mVal > iVal:
-                mScore[i, j] = mVal
-                mPointer[i, j] = MARRAY
-            else:
-                mScore[i, j]   = iVal
-                mPointer[i, j] = IARRAY
-        else:
-            if jVal > iVal:
-                mScore[i, j]  = jVal
-                mPointer[i, j] = JARRAY
-            else:
-                mScore[i, j] = iVal
-                mPointer[i, j] = IARRAY
-#        print('lastCol: mScore['+str(i) + ',' + str(j) +']: ' + str(mScore[i,j]) + ': max(' + str(mScore[i - 1, j - 1])+ '+ (' + str(ci)+ ',' + str(cj) + ') ' + str(matrix[ci,cj]) + ', i:'+str(iVal) + ',j:' + str(jVal))
-
-    #last row
-    i = max_i
-    ci = seqi[i - 1]
-    for j in range(1, max_j+1):
-        cj = seqj[j - 1]
-
-        iFromMVal = gap_extend + mScore[i, j - 1] + gap_incentive[i]
-        iExtendVal = gap_extend + iScore[i, j - 1] + gap_incentive[i]
-        if iFromMVal > iExtendVal:
-            iScore[i,j] =  iFromMVal
-            iPointer[i,j] = MARRAY
-        else:
-            iScore[i,j] = iExtendVal
-            iPointer[i,j] = IARRAY
-
-        jFromMVal = gap_extend + mScore[i - 1, j] + gap_incentive[i-1]
-        jExtendVal = gap_extend + jScore[i - 1, j]
-        if jFromMVal > jExtendVal:
-            jScore[i,j] =  jFromMVal
-            jPointer[i,j] = MARRAY
-        else:
-            jScore[i,j] = jExtendVal
-            jPointer[i,j] = JARRAY
+                    best = iVal
+                    pointer |= IARRAY
+            _store_score(&mS[j], best + <int> match_row[cj], neg_cap, low, &overflow)
+            m_left = mS[j]
+            pointers[row + j] = pointer
+
+        swap_s = pmS; pmS = mS; mS = swap_s
+        swap_s = piS; piS = iS; iS = swap_s
+        swap_s = pjS; pjS = jS; jS = swap_s
+
+    #the last computed row is now in the 'previous' arrays
+    if pmS != rows:
+        memcpy(rows, pmS, 3 * w * sizeof(score_t))
+    last_scores[0] = rows[max_j]
+    last_scores[1] = rows[w + max_j]
+    last_scores[2] = rows[2 * w + max_j]
+    return not overflow
+
+
+cdef inline int _best_of(int m_val, int i_val, int j_val) noexcept nogil:
+    """
+    Return the matrix (MARRAY, IARRAY or JARRAY) holding the best of the three scores, using the same tie-breaking as the fill.
+    """
+    if m_val > j_val:
+        if m_val > i_val:
+            return MARRAY
+        return IARRAY
+    if j_val > i_val:
+        return JARRAY
+    return IARRAY
 
 
-        mVal = mScore[i - 1, j - 1] + matrix[ci,cj]
-        iVal = iScore[i - 1, j - 1] + matrix[ci,cj]
-        jVal = jScore[i - 1, j - 1] + matrix[ci,cj]
-        if mVal > jVal:
-            if mVal > iVal:
-                mScore[i, j] = mVal
-                mPointer[i, j] = MARRAY
+@cython.boundscheck(False)
+@cython.nonecheck(False)
+cdef void _nw_score(const char* seqj, const char* seqi, Py_ssize_t max_j, Py_ssize_t max_i,
+        const DTYPE_LONG[:, ::1] matrix, const DTYPE_LONG[:] gap_incentive,
+        int gap_open, int gap_extend, int min_score, Py_ssize_t band_lo, Py_ssize_t band_hi, int band_floor,
+        int* rows, int* result) noexcept nogil:
+    """
+    Compute the same scores as _nw_fill keeping only two rows of the matrices.
+    Instead of pointers, each cell carries the number of matching bases and the
+    length of the alignment that the traceback from that cell would produce
+    (packed as matches << COUNT_SHIFT | length), so the percent identity of the
+    final alignment is known without a traceback. max_i + max_j must be less than
+    2 ** COUNT_SHIFT. rows must hold 12 * (max_j + 1) ints.
+    result is set to (best score, matching bases, alignment length).
+    """
+    cdef Py_ssize_t w = max_j + 1
+    cdef Py_ssize_t i, j, jstart, jend
+    cdef int gap, inc_i, inc_prev, best
+    cdef int iFromMVal, iExtendVal, jFromMVal, jExtendVal
+    cdef int mVal, iVal, jVal
+    cdef int m_left, i_left
+    cdef unsigned int step, prev_c, m_left_c, i_left_c
+    cdef char ci, cj
+    cdef const DTYPE_LONG* match_row
+    cdef int* mS
+    cdef int* iS
+    cdef int* jS
+    cdef int* pmS
+    cdef int* piS
+    cdef int* pjS
+    cdef unsigned int* mC
+    cdef unsigned int* iC
+    cdef unsigned int* jC
+    cdef unsigned int* pmC
+    cdef unsigned int* piC
+    cdef unsigned int* pjC
+    cdef int* swap_s
+    cdef unsigned int* swap_c
+    cdef unsigned int* counts = <unsigned int*> (rows + 6 * w)
+
+    #each row holds the scores (S) and the packed match counts and alignment lengths (C) for the M, I and J matrices
+    pmS = rows
+    piS = rows + w
+    pjS = rows + 2 * w
+    mS = rows + 3 * w
+    iS = rows + 4 * w
+    jS = rows + 5 * w
+    pmC = counts
+    piC = counts + w
+    pjC = counts + 2 * w
+    mC = counts + 3 * w
+    iC = counts + 4 * w
+    jC = counts + 5 * w
+
+    #first row
+    for j in range(w):
+        pmS[j] = min_score
+        piS[j] = gap_extend * j + gap_incentive[0]
+        pjS[j] = min_score
+        pmC[j] = (((seqj[j - 1] == seqi[0]) << COUNT_SHIFT) if j > 0 else 0) | j
+        piC[j] = j
+        pjC[j] = 0
+    pmS[0] = 0
+    piS[0] = min_score
+    for j in range(band_hi + 1, max_j + 1):
+        piS[j] = band_floor
+
+    for i in range(1, max_i + 1):
+        ci = seqi[i - 1] #char in i
+        match_row = &matrix[ci, 0]
+        inc_i = gap_incentive[i]
+        inc_prev = gap_incentive[i - 1]
+
+        #first column
+        mS[0] = min_score
+        iS[0] = min_score
+        jS[0] = gap_extend * i + gap_incentive[0] if i <= -band_lo else band_floor
+        mC[0] = ((seqj[0] == ci) << COUNT_SHIFT) | i
+        iC[0] = 0
+        jC[0] = i
+
+        jstart = i + band_lo
+        if jstart < 1:
+            jstart = 1
+        jend = i + band_hi
+        if jend > max_j:
+            jend = max_j
+        if jstart > 1:
+            mS[jstart - 1] = band_floor
+            iS[jstart - 1] = band_floor
+            jS[jstart - 1] = band_floor
+        if jend < max_j:
+            mS[jend + 1] = band_floor
+            iS[jend + 1] = band_floor
+            jS[jend + 1] = band_floor
+
+        #for last column and last row, ignore gap opening penalty
+        gap = gap_extend if i == max_i else gap_open
+        #values of the cell to the left are kept in registers
+        m_left = mS[jstart - 1]
+        i_left = iS[jstart - 1]
+        m_left_c = mC[jstart - 1]
+        i_left_c = iC[jstart - 1]
+        for j in range(jstart, jend + 1):
+            cj = seqj[j - 1] #char in j
+            if j == max_j:
+                gap = gap_extend
+
+            iFromMVal = gap + m_left + inc_i
+            iExtendVal = gap_extend + i_left + inc_i
+            if iFromMVal > iExtendVal:
+                i_left = iFromMVal
+                i_left_c = m_left_c + 1
             else:
-                mScore[i, j]   = iVal
-                mPointer[i, j] = IARRAY
-        else:
+                i_left = iExtendVal
+                i_left_c = i_left_c + 1
+            iS[j] = i_left
+            iC[j] = i_left_c
+
+            jFromMVal = gap + pmS[j] + inc_prev
+            jExtendVal = gap_extend + pjS[j]
+            if jFromMVal > jExtendVal:
+                jS[j] = jFromMVal
+                jC[j] = pmC[j] + 1
+            else:
+                jS[j] = jExtendVal
+                jC[j] = pjC[j] + 1
+
+            #same choice as _best_of: J if strictly better than I, then M if strictly better than both
+            jVal = pjS[j - 1]
+            iVal = piS[j - 1]
             if jVal > iVal:
-                mScore[i, j]  = jVal
-                mPointer[i, j] = JARRAY
+                best = jVal
+                prev_c = pjC[j - 1]
             else:
-                mScore[i, j] = iVal
-                mPointer[i, j] = IARRAY
-#        print('lastRow: mScore['+str(i) + ',' + str(j) +']: ' + str(mScore[i,j]) + ': max(' + str(mScore[i - 1, j - 1])+ '+ (' + str(ci)+ ',' + str(cj) + ') ' + str(matrix[ci,cj]) + ', i:'+str(iVal) + ',j:' + str(jVal))
-
-
-
-#    print('mScore')
-#    for ii in range(mScore.shape[0]):
-#      for jj in range(mScore.shape[1]):
-#        print(str(mScore[ii,jj]) + '.' + str(mPointer[ii,jj])+ ","),
-#      print("\n"),
-#    print('iScore')
-#    for ii in range(iScore.shape[0]):
-#      for jj in range(iScore.shape[1]):
-#        print(str(iScore[ii,jj]) + '.' + str(iPointer[ii,jj])+ ","),
-#      print("\n"),
-#    print('jScore')
-#    for ii in range(jScore.shape[0]):
-#      for jj in range(jScore.shape[1]):
-#        print(str(jScore[ii,jj]) + '.' + str(jPointer[ii,jj])+ ","),
-#      print("\n"),
-
-    seqlen = max_i + max_j
-    cdef char* tmp_align_j = get_c_string_with_length(seqlen)
-    cdef char* tmp_align_i = get_c_string_with_length(seqlen)
-
-    cdef int matchCount = 0
-    i = max_i
-    j = max_j
-    ci = seqi[i - 1]
-    cj = seqj[j - 1]
-    cdef int currMatrix
-    currMatrix = MARRAY
-    if mScore[i,j] > jScore[i,j]:
-        if mScore[i,j] > iScore[i,j]:
-            currMatrix = MARRAY
-        else:
-            currMatrix = IARRAY
+                best = iVal
+                prev_c = piC[j - 1]
+            mVal = pmS[j - 1]
+            if mVal > best:
+                best = mVal
+                prev_c = pmC[j - 1]
+            m_left = best + <int> match_row[cj]
+            m_left_c = prev_c + ((ci == cj) << COUNT_SHIFT) + 1
+            mS[j] = m_left
+            mC[j] = m_left_c
+
+        swap_s = pmS; pmS = mS; mS = swap_s
+        swap_s = piS; piS = iS; iS = swap_s
+        swap_s = pjS; pjS = jS; jS = swap_s
+        swap_c = pmC; pmC = mC; mC = swap_c
+        swap_c = piC; piC = iC; iC = swap_c
+        swap_c = pjC; pjC = jC; jC = swap_c
+
+    #the last computed row is now in the 'previous' arrays
+    best = _best_of(pmS[max_j], piS[max_j], pjS[max_j])
+    if best == MARRAY:
+        result[0] = pmS[max_j]
+        step = pmC[max_j]
+    elif best == JARRAY:
+        result[0] = pjS[max_j]
+        step = pjC[max_j]
     else:
-        if jScore[i,j] > iScore[i,j]:
-            currMatrix = JARRAY
-        else:
+        result[0] = piS[max_j]
+        step = piC[max_j]
+    result[1] = step >> COUNT_SHIFT
+    result[2] = step & COUNT_MASK
+
+
+cdef struct TraceState:
+    Py_ssize_t i            # current row
+    Py_ssize_t j            # current column
+    int matrix              # current matrix (MARRAY, IARRAY or JARRAY)
+    Py_ssize_t length       # number of aligned positions written so far
+    int matches             # number of matching aligned positions so far
+
+
+@cython.boundscheck(False)
+cdef bint _nw_traceback(const char* seqj, const char* seqi, Py_ssize_t max_j, Py_ssize_t max_i,
+        const unsigned char* pointers, Py_ssize_t base_row, TraceState* state,
+        char* tmp_align_j, char* tmp_align_i) noexcept nogil:
+    """
+    Trace back through the packed pointer matrix filled by _nw_fill, continuing from state and writing the
+    (reversed) alignment into tmp_align_j and tmp_align_i (max_i + max_j chars each). pointers holds the rows from base_row onwards;
+    the traceback stops when it reaches row base_row (or the first cell if base_row is 0) and state is updated
+    so that it can be continued with the pointers of the previous rows.
+    The first row and column can only be left by a gap along them, so the rest of that row or column is always consumed.
+    Returns False if an invalid pointer was encountered or the alignment would overrun the buffers,
+    leaving state at the offending cell.
+    """
+    cdef Py_ssize_t w = max_j + 1
+    cdef Py_ssize_t i = state.i, j = state.j, align_counter = state.length
+    cdef int matchCount = state.matches
+    cdef int currMatrix = state.matrix
+    cdef unsigned char pointer
+    cdef char ci, cj
+    cdef bint ok = True
+
+    while i > base_row or (base_row == 0 and j > 0):
+        ci = seqi[i - 1] if i > 0 else seqi[0]
+        cj = seqj[j - 1] if j > 0 else seqj[0]
+        pointer = pointers[(i - base_row) * w + j]
+        if i == 0 and currMatrix != IARRAY:
             currMatrix = IARRAY
-#    print('seqi' + str(seqi))
-#    print('seqj' + str(seqj))
-    while i > 0 or j > 0:
-        # print("i: " + str(i) + " j: " + str(j) + " currMatrix: " + str(currMatrix) + " match score: " + str(mScore[i,j]) + " last match: " +  str(mScore[i-1,j-1]) + " matrix[" + str(ci) + "," + str(cj) + "]: " + str(matrix[ci,cj]) + " last j " + str(jScore[i,j]) + " last i: " + str(iScore[i,j]) + " mpointer: " + str(mPointer[i,j]) + " ipointer: " + str(iPointer[i,j]) + " jpointer: " + str(jPointer[i,j]))
-
-        currVal = mScore[i,j]
-        currPtr = mPointer[i,j]
-        if currMatrix == IARRAY:
-            currVal = iScore[i,j]
-            currPtr = iPointer[i,j]
-        if currMatrix == JARRAY:
-            currVal = jScore[i,j]
-            currPtr = jPointer[i,j]
-#        print("i: " + str(i) + " j: " + str(j) + " " + str(currMatrix) +':' + str(currVal) + ' > ' + str(currPtr))
+            continue
+        if j == 0 and currMatrix != JARRAY:
+            currMatrix = JARRAY
+            continue
+        if align_counter >= max_i + max_j:
+            ok = False
+            break
         if currMatrix == MARRAY: # 1
-            currMatrix = mPointer[i,j]
+            currMatrix = pointer & POINTER_MASK
             tmp_align_j[align_counter] = cj
             tmp_align_i[align_counter] = ci
             if cj == ci:
                 matchCount += 1
-
-            if i > 1:
+            if i > 0:
                 i -= 1
-                ci = seqi[i - 1]
-            else:
-                i = 0
-                ci = seqi[i]
-            if j > 1:
+            if j > 0:
                 j -= 1
-                cj = seqj[j - 1]
-            else:
-                j = 0
-                cj = seqj[j]
-
-#            print('in M set to ' + str(currMatrix))
         elif currMatrix == JARRAY: # 3
-            currMatrix = jPointer[i,j]
+            currMatrix = (pointer >> 2 * POINTER_BITS) & POINTER_MASK
             tmp_align_j[align_counter] = c"-"
             tmp_align_i[align_counter] = ci
-            if i > 1:
+            if i > 0:
                 i -= 1
-                ci = seqi[i - 1]
-            else:
-                i = 0
-                ci = seqi[i]
         elif currMatrix == IARRAY: # 2
-            currMatrix = iPointer[i,j]
+            currMatrix = (pointer >> POINTER_BITS) & POINTER_MASK
             tmp_align_j[align_counter] = cj
             tmp_align_i[align_counter] = c"-"
-            if j > 1:
+            if j > 0:
                 j -= 1
-                cj = seqj[j - 1]
-            else:
-                j = 0
-                cj = seqj[j]
         else:
-            print('i: ' + str(i) + ' j: ' + str(j))
-            print('currMatrix:' + str(currMatrix))
-            print('seqj: ' + str(seqj) + ' seqi: ' + str(seqi))
-            raise Exception('wtf4!:pointer: %i', i)
-#          print('at end, currMatrix is ' + str(currMatrix))
+            ok = False
+            break
 
         align_counter += 1
-    try:
-        align_j = tmp_align_j[:align_counter].decode('UTF-8', 'strict')
-    finally:
-        free(tmp_align_j)
-    try:
-        align_i = tmp_align_i[:align_counter].decode('UTF-8', 'strict')
-    finally:
-        free(tmp_align_i)
-
-    # print(tounicode_with_length_and_free(alig))
-#    print(str(matchCount) + " aln: " + str(align_counter))
-    final_score = 100*matchCount/float(align_counter)
-    return align_j[::-1], align_i[::-1], round(final_score, 3)
+
+    state.i = i
+    state.j = j
+    state.matrix = currMatrix
+    state.length = align_counter
+    state.matches = matchCount
+    return ok
+
+
+@cython.boundscheck(False)
+cdef bint _band_is_exact(long best_score, long best_pair,
+        const DTYPE_LONG[:] gap_incentive, int gap_open, int gap_extend,
+        long min_score, long max_j, long max_i, long max_indel_size) noexcept nogil:
+    """
+    Check whether a score computed inside the band is guaranteed to be the global optimum.
+    Any path that leaves the band has at least max_indel_size + 1 gaps in each sequence, so it has at most
+    min(max_i, max_j) - max_indel_size - 1 aligned pairs and the remaining steps are gaps. If the banded score
+    is strictly greater than the best score such a path could have, the banded alignment is exact.
+    """
+    cdef long max_pairs = min(max_i, max_j) - max_indel_size - 1
+    if max_pairs < 0:
+        return True
+    cdef long max_incentive = 0
+    cdef Py_ssize_t k
+    for k in range(gap_incentive.shape[0]):
+        if gap_incentive[k] > max_incentive:
+            max_incentive = gap_incentive[k]
+    cdef long best_gap = max(gap_open, gap_extend) + max_incentive
+    cdef long escape_bound = (max_i + max_j) * best_gap + max_pairs * max(0, best_pair - 2 * best_gap)
+    #paths through the initialized borders of the matrices start from min_score
+    cdef long border_bound = min_score + (max_i + max_j) * max(0, best_pair, best_gap)
+    return best_score > escape_bound and best_score > border_bound
+
+
+@cython.boundscheck(False)
+cdef int _ungapped_matches(const char* seqj, const char* seqi, Py_ssize_t n,
+        const DTYPE_LONG[:, ::1] matrix, const DTYPE_LONG[:] gap_incentive,
+        int gap_open, int gap_extend, long best_pair) noexcept nogil:
+    """
+    Check whether the alignment of seqj to seqi (both of length n) is guaranteed to be the ungapped one,
+    and if so return its number of matches. Returns -1 if the full alignment has to be computed.
+    The gap opening penalty is ignored at the borders of the matrix, so the only gapped alignments without a gap
+    opening penalty are those shifted by d with a gap of length d at both ends. Their scores are computed for
+    every shift that could beat the ungapped score. Every other gapped alignment has at most n - 1 aligned pairs,
+    one gap opening and another gap. If the ungapped score is strictly greater than all of these,
+    it is the unique optimum and the traceback follows the diagonal.
+    """
+    if n == 0 or best_pair <= 0 or gap_open >= 0 or gap_open > gap_extend:
+        return -1
+    cdef long max_incentive = 0
+    cdef Py_ssize_t k
+    for k in range(gap_incentive.shape[0]):
+        if gap_incentive[k] > max_incentive:
+            max_incentive = gap_incentive[k]
+    #best scores of a gap at the border of the matrix and of a gap opening
+    cdef long border_gap = gap_extend + max_incentive
+    cdef long open_gap = gap_open + max_incentive
+    if border_gap > 0:
+        return -1
+
+    cdef long deficit = 0
+    cdef int matches = 0
+    cdef const DTYPE_LONG* match_row
+    for k in range(n):
+        match_row = &matrix[seqi[k], 0]
+        deficit += best_pair - match_row[seqj[k]]
+        if seqj[k] == seqi[k]:
+            matches += 1
+    cdef long ungapped = n * best_pair - deficit
+
+    #paths through the initialized borders of the matrices start from min_score
+    cdef long min_score = <long> gap_open * n * n
+    if min_score != <int> min_score or min_score + 2 * n * best_pair >= ungapped:
+        return -1
+    if deficit >= best_pair - open_gap - border_gap:
+        return -1
+
+    cdef Py_ssize_t d = 1
+    cdef long shifted_j, shifted_i
+    while d <= n and d * (best_pair - 2 * border_gap) <= deficit:
+        shifted_j = 0
+        shifted_i = 0
+        for k in range(n - d):
+            match_row = &matrix[seqi[k + d], 0]
+            shifted_j += match_row[seqj[k]]
+            match_row = &matrix[seqi[k], 0]
+            shifted_i += match_row[seqj[k + d]]
+        if max(shifted_j, shifted_i) + 2 * d * border_gap >= ungapped:
+            return -1
+        d += 1
+    return matches
+
+
+cdef void _nw_fill_compact(const char* seqj, const char* seqi, Py_ssize_t max_j, Py_ssize_t max_i,
+        const DTYPE_LONG[:, ::1] matrix, const DTYPE_LONG[:] gap_incentive,
+        int gap_open, int gap_extend, int min_score, Py_ssize_t band_lo, Py_ssize_t band_hi, int band_floor,
+        bint use_short, int neg_cap, int low, int* rows, unsigned char* pointers, int* last_scores) noexcept nogil:
+    """
+    Fill the whole pointer matrix with _nw_fill using 16-bit scores if use_short is set,
+    and with int scores if it isn't or if the 16-bit scores overflow.
+    """
+    if use_short:
+        if _nw_fill[short](seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                           neg_cap, low, 0, max_i, <short*> rows, pointers, max_j + 1, last_scores):
+            return
+    _nw_fill[int](seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                  neg_cap, low, 0, max_i, rows, pointers, max_j + 1, last_scores)
+
+
+cdef inline Py_ssize_t _nw_linear_block_rows(Py_ssize_t max_j) noexcept nogil:
+    """
+    Number of rows of pointers kept at once by the linear-space traceback.
+    """
+    return max(1, LINEAR_BLOCK_CELLS // (max_j + 1))
+
+
+cdef inline Py_ssize_t _nw_linear_levels(Py_ssize_t max_i, Py_ssize_t block_rows) noexcept nogil:
+    """
+    Number of times the rows have to be halved before they fit in a block of the linear-space traceback.
+    """
+    cdef Py_ssize_t levels = 0
+    while max_i > block_rows:
+        max_i -= max_i // 2
+        levels += 1
+    return levels
+
+
+@cython.boundscheck(False)
+cdef bint _nw_trace_linear(const char* seqj, const char* seqi, Py_ssize_t max_j, Py_ssize_t max_i,
+        const DTYPE_LONG[:, ::1] matrix, const DTYPE_LONG[:] gap_incentive,
+        int gap_open, int gap_extend, int min_score, Py_ssize_t band_lo, Py_ssize_t band_hi, int band_floor,
+        Py_ssize_t start_row, Py_ssize_t end_row, Py_ssize_t block_rows,
+        int* rows, int* checkpoints, unsigned char* block, TraceState* state,
+        char* tmp_align_j, char* tmp_align_i) noexcept nogil:
+    """
+    Continue the traceback in state from end_row down to start_row without keeping the whole pointer matrix.
+    If the rows fit in block (block_rows rows of pointers), they are filled and traced back directly.
+    Otherwise the scores of the middle row are computed and saved, the bottom half is traced back, then the top half.
+    checkpoints holds the M, I and J scores of start_row (unless start_row is 0), followed by space for those of the middle rows.
+    The pointers are recomputed from the same scores as in the full matrix, so the traceback is identical.
+    """
+    cdef Py_ssize_t w = max_j + 1
+    cdef Py_ssize_t mid_row
+    cdef int last_scores[3]
+    if start_row > 0:
+        memcpy(rows, checkpoints, 3 * w * sizeof(int))
+    if end_row - start_row <= block_rows:
+        _nw_fill[int](seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                      0, 0, start_row, end_row, rows, block, w, last_scores)
+        return _nw_traceback(seqj, seqi, max_j, max_i, block, start_row, state, tmp_align_j, tmp_align_i)
+
+    mid_row = start_row + (end_row - start_row) // 2
+    _nw_fill[int](seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                  0, 0, start_row, mid_row, rows, block, 0, last_scores)
+    memcpy(checkpoints + 3 * w, rows, 3 * w * sizeof(int))
+    if not _nw_trace_linear(seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                            mid_row, end_row, block_rows, rows, checkpoints + 3 * w, block, state, tmp_align_j, tmp_align_i):
+        return False
+    return _nw_trace_linear(seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                            start_row, mid_row, block_rows, rows, checkpoints, block, state, tmp_align_j, tmp_align_i)
+
+
+@cython.boundscheck(False)
+cdef Py_ssize_t _nw_align(const char* seqj, const char* seqi, Py_ssize_t max_j, Py_ssize_t max_i,
+        const DTYPE_LONG[:, ::1] matrix, const DTYPE_LONG[:] gap_incentive,
+        int gap_open, int gap_extend, int max_indel_size, long best_pair, long worst_pair, bint linear_space,
+        int* buffer, char* tmp_align_j, char* tmp_align_i, int* match_count) noexcept nogil:
+    """
+    Align seqj to seqi using buffer (_nw_align_buffer_size ints) for two rows of scores and the packed pointer matrix.
+    Computes the banded alignment if max_indel_size >= 0, falling back to the full matrix if the band may not be exact.
+    If linear_space is set, only a few rows of scores and a block of pointer rows are kept (see _nw_trace_linear).
+    Reads that are provably aligned without gaps (see _ungapped_matches) skip the dynamic programming.
+    Returns the alignment length and writes the number of matches to match_count,
+    or returns -1 - i if an invalid pointer was encountered in row i, writing the pointer to match_count.
+    """
+    cdef Py_ssize_t w = max_j + 1
+    cdef Py_ssize_t k
+    cdef int ungapped_matches
+    if max_j == max_i:
+        ungapped_matches = _ungapped_matches(seqj, seqi, max_j, matrix, gap_incentive, gap_open, gap_extend, best_pair)
+        if ungapped_matches >= 0:
+            #the alignment is written reversed, as by the traceback
+            for k in range(max_j):
+                tmp_align_j[k] = seqj[max_j - 1 - k]
+                tmp_align_i[k] = seqi[max_j - 1 - k]
+            match_count[0] = ungapped_matches
+            return max_j
+
+    #the buffer holds two rows of the M, I and J score matrices, followed by the pointers
+    # M array - best alignment so far ending with a match
+    # I array - best alignment so far ending with a gap in Read (J) (insertion in ref, deletion in read)
+    # J array - best alignment so far ending with a gap in Ref (I) (deletion in ref, insertion in read)
+    cdef unsigned char* pointers = <unsigned char*> (buffer + 6 * w)
+    cdef int last_scores[3]
+
+    cdef int min_score = gap_open * max_j * max_i
+    cdef int band_floor = min(min_score, -(1 << 30))
+
+    #bounds on the change in score between neighboring cells
+    cdef long min_incentive = gap_incentive[0], max_incentive = gap_incentive[0]
+    for k in range(1, gap_incentive.shape[0]):
+        min_incentive = min(min_incentive, gap_incentive[k])
+        max_incentive = max(max_incentive, gap_incentive[k])
+    cdef long max_step = max(best_pair, gap_open + max_incentive, gap_extend + max_incentive, gap_extend)
+    cdef long min_step = min(worst_pair, gap_open + min_incentive, gap_extend + min_incentive, gap_extend)
+    #in the 16-bit fill, scores derived only from unreachable cells are at most neg_cap, and all others must be at least low
+    cdef int neg_cap = SCORE16_MIN + max(0, max_step)
+    cdef int low = neg_cap + 1 - min(0, min_step)
+    #scores derived from min_score are at most two steps away from it, so they must stay below low for the 16-bit fill to be exact
+    cdef bint use_short = min_score + 2 * max(0, max_step) < low
+
+    cdef Py_ssize_t band_lo = -max_i, band_hi = max_j
+    if max_indel_size >= 0:
+        band_lo = min(0, max_j - max_i) - max_indel_size
+        band_hi = max(0, max_j - max_i) + max_indel_size
+
+    cdef Py_ssize_t block_rows
+    cdef int* checkpoints
+    if linear_space:
+        #scores only, to find the band and the matrix the traceback starts in
+        block_rows = _nw_linear_block_rows(max_j)
+        checkpoints = buffer + 6 * w
+        pointers = <unsigned char*> (checkpoints + 3 * w * (_nw_linear_levels(max_i, block_rows) + 1))
+        _nw_fill[int](seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                      0, 0, 0, max_i, buffer, pointers, 0, last_scores)
+    else:
+        _nw_fill_compact(seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                         use_short, neg_cap, low, buffer, pointers, last_scores)
+
+    cdef long best_score
+    if band_lo > -max_i or band_hi < max_j:
+        best_score = max(last_scores[0], last_scores[1], last_scores[2])
+        if not _band_is_exact(best_score, best_pair, gap_incentive, gap_open, gap_extend, min_score, max_j, max_i, max_indel_size):
+            band_lo = -max_i
+            band_hi = max_j
+            if linear_space:
+                _nw_fill[int](seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                              0, 0, 0, max_i, buffer, pointers, 0, last_scores)
+            else:
+                _nw_fill_compact(seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                                 use_short, neg_cap, low, buffer, pointers, last_scores)
+
+    cdef TraceState state
+    state.i = max_i
+    state.j = max_j
+    state.matrix = _best_of(last_scores[0], last_scores[1], last_scores[2])
+    state.length = 0
+    state.matches = 0
+    cdef bint ok
+    if linear_space:
+        ok = _nw_trace_linear(seqj, seqi, max_j, max_i, matrix, gap_incentive, gap_open, gap_extend, min_score, band_lo, band_hi, band_floor,
+                              0, max_i, block_rows, buffer, checkpoints, pointers, &state, tmp_align_j, tmp_align_i)
+    else:
+        ok = _nw_traceback(seqj, seqi, max_j, max_i, pointers, 0, &state, tmp_align_j, tmp_align_i)
+    if not ok:
+        match_count[0] = state.matrix
+        return -1 - state.i
+    match_count[0] = state.matches
+    return state.length
+
+
+cdef inline Py_ssize_t _nw_align_buffer_size(Py_ssize_t max_j, Py_ssize_t max_i, bint linear_space) noexcept nogil:
+    """
+    Number of ints needed by _nw_align: two rows of the three score matrices and one byte of pointers per cell,
+    or, in linear space, the saved score rows and one block of pointer rows.
+    """
+    cdef Py_ssize_t w = max_j + 1
+    cdef Py_ssize_t block_rows
+    if linear_space:
+        block_rows = min(max_i, _nw_linear_block_rows(max_j))
+        return 6 * w + 3 * w * (_nw_linear_levels(max_i, block_rows) + 1) + ((block_rows + 1) * w + sizeof(int) - 1) // sizeof(int)
+    return 6 * w + ((max_i + 1) * w + sizeof(int) - 1) // sizeof(int)
+
+
+cdef class Alignment:
+    """
+    Alignment of a read to a reference from Aligner.align_edits.
+    edits holds the modifications found in the traceback and score the percent identity of the alignment.
+    The aligned read and reference are kept as the bytes written by the traceback and are only
+    decoded when aligned_read or aligned_ref is first used.
+    """
+    cdef readonly object edits
+    cdef readonly object score
+    cdef bytes _reversed_read
+    cdef bytes _reversed_ref
+    cdef str _aligned_read
+    cdef str _aligned_ref
+
+    @property
+    def aligned_read(self):
+        if self._aligned_read is None:
+            self._aligned_read = self._reversed_read.decode('UTF-8', 'strict')[::-1]
+        return self._aligned_read
+
+    @property
+    def aligned_ref(self):
+        if self._aligned_ref is None:
+            self._aligned_ref = self._reversed_ref.decode('UTF-8', 'strict')[::-1]
+        return self._aligned_ref
+
+
+cdef class Aligner:
+    """
+    Needleman-Wunsch aligner that keeps the scoring matrix and gap penalties bound
+    and reuses its dynamic programming buffers across calls.
+    The buffers grow to fit the largest read/reference pair seen, so aligning many reads
+    with one Aligner avoids allocating six new matrices for every alignment.
+    The dynamic programming runs without the GIL, so separate Aligners can be used from separate threads.
+
+    matrix: substitution matrix as returned by read_matrix or make_matrix
+    gap_open: gap open penalty
+    gap_extend: gap extension penalty
+    max_indel_size: if >= 0, alignments are computed in a band (see global_align)
+    linear_space_threshold: if >= 0, alignments with more cells than this use a linear-space traceback (see global_align)
+    """
+    cdef readonly np.ndarray matrix
+    cdef readonly int gap_open
+    cdef readonly int gap_extend
+    cdef readonly int max_indel_size
+    cdef readonly long linear_space_threshold
+    cdef const DTYPE_LONG[:, ::1] matrix_view
+    cdef long best_pair
+    cdef long worst_pair
+    cdef int* buffer
+    cdef Py_ssize_t capacity
+    cdef char* tmp_align_j
+    cdef char* tmp_align_i
+    cdef Py_ssize_t align_capacity
+
+    def __cinit__(self):
+        self.buffer = NULL
+        self.capacity = 0
+        self.tmp_align_j = NULL
+        self.tmp_align_i = NULL
+        self.align_capacity = 0
+
+    def __init__(self, np.ndarray[DTYPE_LONG, ndim=2] matrix, int gap_open=-1, int gap_extend=-1, int max_indel_size=-1,
+                 long linear_space_threshold=-1):
+        self.matrix = np.ascontiguousarray(matrix)
+        self.matrix_view = self.matrix
+        self.gap_open = gap_open
+        self.gap_extend = gap_extend
+        self.max_indel_size = max_indel_size
+        self.linear_space_threshold = linear_space_threshold
+        self.best_pair = matrix.max()
+        self.worst_pair = matrix.min()
+
+    def __dealloc__(self):
+        free(self.buffer)
+        free(self.tmp_align_j)
+        free(self.tmp_align_i)
+
+    def __reduce__(self):
+        return (Aligner, (self.matrix, self.gap_open, self.gap_extend, self.max_indel_size, self.linear_space_threshold))
+
+    cdef inline bint _linear_space(self, Py_ssize_t max_j, Py_ssize_t max_i) noexcept nogil:
+        """
+        Whether the alignment of a read of length max_j to a reference of length max_i should use the linear-space traceback.
+        """
+        return self.linear_space_threshold >= 0 and (max_i + 1) * (max_j + 1) > self.linear_space_threshold
+
+    cdef int _reserve(self, Py_ssize_t n_ints, Py_ssize_t max_j, Py_ssize_t max_i) except -1:
+        """
+        Make sure the buffer holds at least n_ints ints and the alignment strings can hold sequences of length max_j and max_i.
+        """
+        cdef int* new_buffer
+        cdef char* new_align_j
+        cdef char* new_align_i
+        if n_ints > self.capacity:
+            new_buffer = <int*> malloc(n_ints * sizeof(int))
+            if not new_buffer:
+                raise MemoryError()
+            free(self.buffer)
+            self.buffer = new_buffer
+            self.capacity = n_ints
+        if max_i + max_j > self.align_capacity:
+            new_align_j = get_c_string_with_length(max_i + max_j)
+            try:
+                new_align_i = get_c_string_with_length(max_i + max_j)
+            except MemoryError:
+                free(new_align_j)
+                raise
+            free(self.tmp_align_j)
+            free(self.tmp_align_i)
+            self.tmp_align_j = new_align_j
+            self.tmp_align_i = new_align_i
+            self.align_capacity = max_i + max_j
+        return 0
+
+    def align(self, str pystr_seqj, str pystr_seqi, np.ndarray[DTYPE_LONG, ndim=1] gap_incentive):
+        """
+        Align read seqj to reference seqi (see global_align).
+        Returns the aligned read, the aligned reference and the percent identity of the alignment.
+        """
+        byte_seqj = pystr_seqj.encode('UTF-8')
+        cdef char* seqj = byte_seqj
+        byte_seqi = pystr_seqi.encode('UTF-8')
+        cdef char* seqi = byte_seqi
+
+        cdef Py_ssize_t max_j = len(pystr_seqj)
+        cdef Py_ssize_t max_i = len(pystr_seqi)
+        if len(gap_incentive) != max_i + 1:
+            print('\nERROR: Mismatch in gap_incentive length (gap_incentive: ' + str(len(gap_incentive)) + ' ref: '+str(max_i+1) + '\n')
+            return 0
+
+        cdef int matchCount = 0
+        cdef Py_ssize_t align_counter = self._traceback(seqj, seqi, max_j, max_i, gap_incentive, &matchCount)
+
+        cdef str align_j = self.tmp_align_j[:align_counter].decode('UTF-8', 'strict')
+        cdef str align_i = self.tmp_align_i[:align_counter].decode('UTF-8', 'strict')
+
+        final_score = 100*matchCount/float(align_counter)
+        return align_j[::-1], align_i[::-1], round(final_score, 3)
+
+    cdef Py_ssize_t _traceback(self, const char* seqj, const char* seqi, Py_ssize_t max_j, Py_ssize_t max_i,
+                               const DTYPE_LONG[:] incentive, int* match_count) except -1:
+        """
+        Align seqj to seqi, writing the reversed alignment to tmp_align_j and tmp_align_i and the number of matches to match_count.
+        Returns the alignment length.
+        """
+        cdef bint linear_space = self._linear_space(max_j, max_i)
+        self._reserve(_nw_align_buffer_size(max_j, max_i, linear_space), max_j, max_i)
+
+        cdef Py_ssize_t align_counter
+        with nogil:
+            align_counter = _nw_align(seqj, seqi, max_j, max_i, self.matrix_view, incentive, self.gap_open, self.gap_extend,
+                                      self.max_indel_size, self.best_pair, self.worst_pair, linear_space,
+                                      self.buffer, self.tmp_align_j, self.tmp_align_i, match_count)
+        if align_counter < 0:
+            print('i: ' + str(-1 - align_counter))
+            print('currMatrix:' + str(match_count[0]))
+            print('seqj: ' + str(seqj) + ' seqi: ' + str(seqi))
+            raise Exception('wtf4!:pointer: %i', -1 - align_counter)
+        return align_counter
+
+    def align_edits(self, str pystr_seqj, str pystr_seqi, np.ndarray[DTYPE_LONG, ndim=1] gap_incentive, const unsigned char[::1] include_mask):
+        """
+        Align read seqj to reference seqi (see global_align) and find the modifications of the alignment directly
+        from the traceback, without building the aligned strings first.
+        include_mask is the quantification window mask of seqi (see CRISPRessoCOREResources.get_include_mask).
+        Returns an Alignment, whose edits are those of CRISPRessoCOREResources.find_indels_substitutions_arrays
+        for the aligned read and reference.
+        """
+        byte_seqj = pystr_seqj.encode('UTF-8')
+        cdef char* seqj = byte_seqj
+        byte_seqi = pystr_seqi.encode('UTF-8')
+        cdef char* seqi = byte_seqi
+
+        cdef Py_ssize_t max_j = len(pystr_seqj)
+        cdef Py_ssize_t max_i = len(pystr_seqi)
+        if len(gap_incentive) != max_i + 1:
+            print('\nERROR: Mismatch in gap_incentive length (gap_incentive: ' + str(len(gap_incentive)) + ' ref: '+str(max_i+1) + '\n')
+            return 0
+
+        cdef int matchCount = 0
+        cdef Py_ssize_t align_counter = self._traceback(seqj, seqi, max_j, max_i, gap_incentive, &matchCount)
+
+        cdef Alignment alignment = Alignment.__new__(Alignment)
+        #the traceback is written from the end of the alignment, so it is read backwards
+        if align_counter > 0:
+            alignment.edits = find_edits(<const unsigned char*> self.tmp_align_j + align_counter - 1,
+                                         <const unsigned char*> self.tmp_align_i + align_counter - 1, align_counter, -1, include_mask)
+        else:
+            alignment.edits = find_edits(NULL, NULL, 0, 1, include_mask)
+        alignment._reversed_read = self.tmp_align_j[:align_counter]
+        alignment._reversed_ref = self.tmp_align_i[:align_counter]
+        final_score = 100*matchCount/float(align_counter)
+        alignment.score = round(final_score, 3)
+        return alignment
+
+    def align_batch(self, reads, str pystr_seqi, np.ndarray[DTYPE_LONG, ndim=1] gap_incentive):
+        """
+        Align each read in reads to reference seqi (see global_align).
+        All alignments are computed in a single call without holding the GIL.
+        Returns a list with a tuple of (aligned read, aligned reference, percent identity) for each read.
+        """
+        byte_seqi = pystr_seqi.encode('UTF-8')
+        cdef char* seqi = byte_seqi
+        cdef Py_ssize_t max_i = len(pystr_seqi)
+        if len(gap_incentive) != max_i + 1:
+            print('\nERROR: Mismatch in gap_incentive length (gap_incentive: ' + str(len(gap_incentive)) + ' ref: '+str(max_i+1) + '\n')
+            return 0
+
+        byte_reads = [read.encode('UTF-8') for read in reads]
+        cdef Py_ssize_t n_reads = len(byte_reads)
+        if n_reads == 0:
+            return []
+
+        cdef Py_ssize_t k, n_ints = 0, total_length = 0
+        for byte_read in byte_reads:
+            n_ints = max(n_ints, _nw_align_buffer_size(len(byte_read), max_i, self._linear_space(len(byte_read), max_i)))
+            total_length += len(byte_read) + max_i
+        self._reserve(n_ints, 0, 0)
+
+        cdef const DTYPE_LONG[:] incentive = gap_incentive
+        cdef const char** read_seqs = <const char**> malloc(n_reads * sizeof(char*))
+        cdef Py_ssize_t* read_lengths = <Py_ssize_t*> malloc(n_reads * sizeof(Py_ssize_t))
+        cdef Py_ssize_t* align_offsets = <Py_ssize_t*> malloc(n_reads * sizeof(Py_ssize_t))
+        cdef Py_ssize_t* align_counters = <Py_ssize_t*> malloc(n_reads * sizeof(Py_ssize_t))
+        cdef int* match_counts = <int*> malloc(n_reads * sizeof(int))
+        cdef char* align_js = <char*> malloc(total_length * sizeof(char))
+        cdef char* align_is = <char*> malloc(total_length * sizeof(char))
+        try:
+            if not (read_seqs and read_lengths and align_offsets and align_counters and match_counts and align_js and align_is):
+                raise MemoryError()
+            total_length = 0
+            for k in range(n_reads):
+                read_seqs[k] = byte_reads[k]
+                read_lengths[k] = len(byte_reads[k])
+                align_offsets[k] = total_length
+                total_length += read_lengths[k] + max_i
+
+            with nogil:
+                for k in range(n_reads):
+                    align_counters[k] = _nw_align(read_seqs[k], seqi, read_lengths[k], max_i, self.matrix_view, incentive, self.gap_open, self.gap_extend,
+                                                  self.max_indel_size, self.best_pair, self.worst_pair, self._linear_space(read_lengths[k], max_i),
+                                                  self.buffer, align_js + align_offsets[k], align_is + align_offsets[k], &match_counts[k])
+
+            alignments = []
+            for k in range(n_reads):
+                if align_counters[k] < 0:
+                    print('i: ' + str(-1 - align_counters[k]))
+                    print('currMatrix:' + str(match_counts[k]))
+                    print('seqj: ' + str(byte_reads[k]) + ' seqi: ' + str(byte_seqi))
+                    raise Exception('wtf4!:pointer: %i', -1 - align_counters[k])
+                align_j = align_js[align_offsets[k]:align_offsets[k] + align_counters[k]].decode('UTF-8', 'strict')
+                align_i = align_is[align_offsets[k]:align_offsets[k] + align_counters[k]].decode('UTF-8', 'strict')
+                final_score = 100*match_counts[k]/float(align_counters[k])
+                alignments.append((align_j[::-1], align_i[::-1], round(final_score, 3)))
+            return alignments
+        finally:
+            free(read_seqs)
+            free(read_lengths)
+            free(align_offsets)
+            free(align_counters)
+            free(match_counts)
+            free(align_js)
+            free(align_is)
+
+    def score(self, str pystr_seqj, str pystr_seqi, np.ndarray[DTYPE_LONG, ndim=1] gap_incentive):
+        """
+        Compute only the percent identity of the alignment of read seqj to reference seqi.
+        This uses memory linear in the read length and returns the same score as align,
+        so it can be used to decide which alignments are worth tracing back.
+        """
+        byte_seqj = pystr_seqj.encode('UTF-8')
+        cdef char* seqj = byte_seqj
+        byte_seqi = pystr_seqi.encode('UTF-8')
+        cdef char* seqi = byte_seqi
+
+        cdef Py_ssize_t max_j = len(pystr_seqj)
+        cdef Py_ssize_t max_i = len(pystr_seqi)
+        if len(gap_incentive) != max_i + 1:
+            print('\nERROR: Mismatch in gap_incentive length (gap_incentive: ' + str(len(gap_incentive)) + ' ref: '+str(max_i+1) + '\n')
+            return 0
+
+        cdef const DTYPE_LONG[:] incentive = gap_incentive
+        cdef int ungapped_matches
+        if max_j == max_i:
+            ungapped_matches = _ungapped_matches(seqj, seqi, max_j, self.matrix_view, incentive, self.gap_open, self.gap_extend, self.best_pair)
+            if ungapped_matches >= 0:
+                return round(100*ungapped_matches/float(max_j), 3)
+
+        if max_i + max_j >= (1 << COUNT_SHIFT):
+            return self.align(pystr_seqj, pystr_seqi, gap_incentive)[2]
+
+        self._reserve(12 * (max_j + 1), 0, 0)
+
+        cdef int min_score = self.gap_open * max_j * max_i
+        cdef int band_floor = min(min_score, -(1 << 30))
+        cdef int result[3]
+
+        cdef Py_ssize_t band_lo = -max_i, band_hi = max_j
+        if self.max_indel_size >= 0:
+            band_lo = min(0, max_j - max_i) - self.max_indel_size
+            band_hi = max(0, max_j - max_i) + self.max_indel_size
+
+        with nogil:
+            _nw_score(seqj, seqi, max_j, max_i, self.matrix_view, incentive, self.gap_open, self.gap_extend, min_score, band_lo, band_hi, band_floor,
+                      self.buffer, result)
+
+            if band_lo > -max_i or band_hi < max_j:
+                if not _band_is_exact(result[0], self.best_pair, incentive, self.gap_open, self.gap_extend, min_score, max_j, max_i, self.max_indel_size):
+                    _nw_score(seqj, seqi, max_j, max_i, self.matrix_view, incentive, self.gap_open, self.gap_extend, min_score, -max_i, max_j, band_floor,
+                              self.buffer, result)
+
+        final_score = 100*result[1]/float(result[2])
+        return round(final_score, 3)
+
+
+def global_align(str pystr_seqj, str pystr_seqi, np.ndarray[DTYPE_LONG, ndim=2] matrix,
+          np.ndarray[DTYPE_LONG,ndim=1] gap_incentive, int gap_open=-1,
+          int gap_extend=-1, int max_indel_size=-1, long linear_space_threshold=-1):
+    """
+    Global sequence alignment (needleman-wunsch) on seq i and j.
+    Reference is seq_i, sequenced read is seq_j
+    Match and mismatch values are read from matrix object
+    where matrix is of the format provided in the ncbi/data directory.
+    gap_incentive is the incentive for having a gap at each position in seqi -
+      this allows for the preferential location of gaps to be at the predicted
+      cut site in genome editing experiments.
+    max_indel_size: if >= 0, only cells within (length difference + max_indel_size)
+      of the diagonal are computed. If the banded score cannot be proven optimal,
+      the full matrix is computed instead, so the result is always identical to the unbanded alignment.
+    linear_space_threshold: if >= 0, alignments with more than this many cells ((len(seqi) + 1) * (len(seqj) + 1))
+      don't keep the whole traceback matrix. Only a block of rows is kept, and the rows are recomputed
+      by divide and conquer from saved rows of scores, so memory grows linearly with the sequence lengths
+      at the cost of a few more passes over the matrix. The alignment is identical to the one computed with the full matrix.
+    If seqj and seqi have the same length and few enough mismatches that no gapped alignment can score as well,
+      the ungapped alignment is returned without filling the matrix.
+    When aligning many reads, use an Aligner to reuse the alignment matrices between calls.
+
+    """
+    return Aligner(matrix, gap_open, gap_extend, max_indel_size, linear_space_threshold).align(pystr_seqj, pystr_seqi, gap_incentive)
+
+
+def global_align_batch(reads, str pystr_seqi, np.ndarray[DTYPE_LONG, ndim=2] matrix,
+          np.ndarray[DTYPE_LONG,ndim=1] gap_incentive, int gap_open=-1,
+          int gap_extend=-1, int max_indel_size=-1, long linear_space_threshold=-1):
+    """
+    Global sequence alignment (needleman-wunsch) of each sequenced read in reads to reference seq i.
+    Parameters are as for global_align. All reads are aligned in one call without holding the GIL,
+    so batches can be aligned in parallel from several threads.
+    Returns a list with a tuple of (aligned read, aligned reference, score) for each read.
+
+    """
+    return Aligner(matrix, gap_open, gap_extend, max_indel_size, linear_space_threshold).align_batch(reads, pystr_seqi, gap_incentive)
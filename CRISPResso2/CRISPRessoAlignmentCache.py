@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""CRISPResso2 - Kendell Clement and Luca Pinello 2018
+Software pipeline for the analysis of genome editing outcomes from deep sequencing data
+(c) 2018 The General Hospital Corporation. All Rights Reserved.
+"""
+
+import hashlib
+import multiprocessing as mp
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+CACHE_FILENAME = 'CRISPResso2_alignment_cache.sqlite'
+
+
+class AlignmentCache:
+    """Persistent cache of the variant objects computed for reads, shared across runs.
+
+    The variant objects are stored in an SQLite database in cache_dir, keyed by a hash of the read
+    and of everything else that determines the variant object (the context, e.g. the references,
+    gap incentives, scoring matrix and gap penalties). Runs with a different context never see each other's entries.
+    When the stored objects exceed max_size_mb, the least recently used ones are evicted.
+
+    The cache can be passed to other processes (it opens its own connection in each process) and shared by threads.
+    New entries and access times are written in batches, so flush (or close) must be called when a process is done with the cache.
+    """
+
+    def __init__(self, cache_dir, context, max_size_mb=1024, batch_size=1000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, CACHE_FILENAME)
+        self.context = hashlib.sha256(pickle.dumps(context, protocol=4)).digest()
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.batch_size = batch_size
+        self._hits = mp.Value('q', 0)
+        self._misses = mp.Value('q', 0)
+        self._evictions = mp.Value('q', 0)
+        self._init_state()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS alignments (key BLOB PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used)')
+
+    def _init_state(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._new_entries = {}
+        self._used_keys = set()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['_pid', '_lock', '_connection', '_new_entries', '_used_keys']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _connect(self):
+        """Return the connection of this process, opening it if needed. Must be called with the lock held (or from __init__)."""
+        if self._pid != os.getpid():
+            # a forked copy of the cache, the connection and pending writes belong to the parent
+            self._init_state()
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+        return self._connection
+
+    def _key(self, read):
+        return hashlib.sha256(self.context + read.encode('utf-8')).digest()
+
+    def get(self, read):
+        """Return the cached variant object of read, or None if it isn't in the cache."""
+        key = self._key(read)
+        with self._lock:
+            value = self._new_entries.get(key)
+            if value is None:
+                row = self._connect().execute('SELECT value FROM alignments WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value = row[0]
+                    self._used_keys.add(key)
+                    if len(self._used_keys) >= self.batch_size:
+                        self._write()
+        counter = self._misses if value is None else self._hits
+        with counter.get_lock():
+            counter.value += 1
+        return None if value is None else pickle.loads(value)
+
+    def put(self, read, variant):
+        """Add the variant object of read to the cache. It is stored as it is now, so it may be modified afterwards."""
+        value = pickle.dumps(variant, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._new_entries[self._key(read)] = value
+            if len(self._new_entries) >= self.batch_size:
+                self._write()
+
+    def _write(self):
+        """Write the pending entries and access times. Must be called with the lock held."""
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO alignments (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                                   [(key, value, len(value), now) for key, value in self._new_entries.items()])
+            connection.executemany('UPDATE alignments SET last_used = ? WHERE key = ?', [(now, key) for key in self._used_keys])
+        self._new_entries = {}
+        self._used_keys = set()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache fits in max_size. Must be called with the lock held."""
+        connection = self._connect()
+        with connection:
+            total_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM alignments').fetchone()[0]
+            if total_size <= self.max_size:
+                return
+            evicted_keys = []
+            for key, size in connection.execute('SELECT key, size FROM alignments ORDER BY last_used'):
+                if total_size <= self.max_size:
+                    break
+                evicted_keys.append((key,))
+                total_size -= size
+            connection.executemany('DELETE FROM alignments WHERE key = ?', evicted_keys)
+        with self._evictions.get_lock():
+            self._evictions.value += len(evicted_keys)
+
+    def flush(self):
+        """Write the pending entries to the database and evict entries if the cache is too large."""
+        with self._lock:
+            if self._new_entries or self._used_keys:
+                self._write()
+            self._evict()
+
+    def close(self):
+        """Flush the cache and close the connection of this process."""
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def get_stats(self):
+        """Return a dict with the number of cache hits, misses and evictions in this run and the size of the cache."""
+        with self._lock:
+            entries, size = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM alignments').fetchone()
+        return {
+            'path': self.path,
+            'hits': self._hits.value,
+            'misses': self._misses.value,
+            'evictions': self._evictions.value,
+            'entries': entries,
+            'size_bytes': size,
+            'max_size_bytes': self.max_size,
+        }
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""CRISPResso2 - Kendell Clement and Luca Pinello 2018
+Software pipeline for the analysis of genome editing outcomes from deep sequencing data
+(c) 2018 The General Hospital Corporation. All Rights Reserved.
+"""
+
+import os
+import re
+import struct
+import zlib
+
+from CRISPResso2.CRISPRessoShared import BadParameterException, InputFileFormatException
+
+# the BAM format is described in the SAM/BAM specification (https://samtools.github.io/hts-specs/SAMv1.pdf)
+BGZF_HEADER = struct.Struct('<4BI2BH')
+BGZF_EXTRA_FIELD = struct.Struct('<2BHH')
+BGZF_FOOTER = struct.Struct('<II')
+BGZF_MAX_BLOCK_DATA = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+BAM_RECORD_HEADER = struct.Struct('<iiBBHHHiiii')
+BAM_MAGIC = b'BAM\x01'
+BAI_MAGIC = b'BAI\x01'
+LINEAR_INDEX_SHIFT = 14
+
+SEQ_DECODE_TABLE = str.maketrans('0123456789abcdef', '=ACMGRSVTWYHKDBN')
+# CIGAR operations that consume the reference: M, D, N, = and X
+REFERENCE_CIGAR_OPS = (0, 2, 3, 7, 8)
+FLAG_NAMES = {
+    'PAIRED': 0x1,
+    'PROPER_PAIR': 0x2,
+    'UNMAP': 0x4,
+    'MUNMAP': 0x8,
+    'REVERSE': 0x10,
+    'MREVERSE': 0x20,
+    'READ1': 0x40,
+    'READ2': 0x80,
+    'SECONDARY': 0x100,
+    'QCFAIL': 0x200,
+    'DUP': 0x400,
+    'SUPPLEMENTARY': 0x800,
+}
+
+
+def parse_flags(flags):
+    """Parse a samtools flag argument (e.g. '4', '0x904' or 'UNMAP,SECONDARY') into an int."""
+    flags = flags.strip()
+    if not flags:
+        return 0
+    if flags[0].isdigit():
+        try:
+            if flags.lower().startswith('0x'):
+                return int(flags, 16)
+            if flags.startswith('0') and len(flags) > 1:
+                return int(flags, 8)
+            return int(flags)
+        except ValueError:
+            raise BadParameterException('Could not parse the flags "%s"' % flags)
+    value = 0
+    for name in flags.split(','):
+        if name.upper() not in FLAG_NAMES:
+            raise BadParameterException('Unknown flag "%s" in "%s", the flag names are %s' % (name, flags, ', '.join(FLAG_NAMES)))
+        value |= FLAG_NAMES[name.upper()]
+    return value
+
+
+def reg2bins(beg, end):
+    """Return the BAI bins that may contain records overlapping the 0-based region [beg, end)."""
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def get_index_filename(bam_filename):
+    """Return the path of the .bai index of bam_filename (file.bam.bai or file.bai), or None if it has no index."""
+    for index_filename in (bam_filename + '.bai', re.sub(r'\.bam$', '.bai', bam_filename)):
+        if index_filename != bam_filename and os.path.exists(index_filename):
+            return index_filename
+    return None
+
+
+class BgzfReader:
+    """Reads the decompressed data of a BGZF file (e.g. a BAM file) and seeks to virtual offsets."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._block_offset = 0
+        self._next_block_offset = 0
+        self._data = b''
+        self._pos = 0
+
+    def _read_block(self):
+        """Read the next block, return False at the end of the file."""
+        self._block_offset = self._next_block_offset
+        header = self._file.read(BGZF_HEADER.size)
+        if not header:
+            self._data = b''
+            self._pos = 0
+            return False
+        if len(header) < BGZF_HEADER.size:
+            raise InputFileFormatException('Truncated BGZF block in ' + self.filename)
+        id1, id2, _, flags, _, _, _, extra_length = BGZF_HEADER.unpack(header)
+        if id1 != 31 or id2 != 139 or not flags & 4:
+            raise InputFileFormatException('%s is not a BGZF (BAM) file' % self.filename)
+        extra = self._file.read(extra_length)
+        block_size = None
+        offset = 0
+        while offset + 4 <= len(extra):
+            si1, si2, length = struct.unpack_from('<2BH', extra, offset)
+            if si1 == 66 and si2 == 67:
+                block_size = struct.unpack_from('<H', extra, offset + 4)[0] + 1
+            offset += 4 + length
+        if block_size is None:
+            raise InputFileFormatException('%s is not a BGZF (BAM) file' % self.filename)
+        rest = self._file.read(block_size - BGZF_HEADER.size - extra_length)
+        if len(rest) != block_size - BGZF_HEADER.size - extra_length:
+            raise InputFileFormatException('Truncated BGZF block in ' + self.filename)
+        self._data = zlib.decompress(rest[:-BGZF_FOOTER.size], -15)
+        self._pos = 0
+        self._next_block_offset = self._block_offset + block_size
+        return True
+
+    def tell(self):
+        """Return the virtual offset of the next byte to read."""
+        if self._pos == len(self._data):
+            return self._next_block_offset << 16
+        return (self._block_offset << 16) | self._pos
+
+    def seek(self, virtual_offset):
+        """Seek to a virtual offset (the offset of a block in the file << 16 | the offset in its decompressed data)."""
+        self._file.seek(virtual_offset >> 16)
+        self._next_block_offset = virtual_offset >> 16
+        self._read_block()
+        self._pos = virtual_offset & 0xffff
+
+    def read(self, size):
+        """Read size bytes, or fewer at the end of the file."""
+        if self._pos + size <= len(self._data):
+            self._pos += size
+            return self._data[self._pos - size:self._pos]
+        parts = [self._data[self._pos:]]
+        remaining = size - len(parts[0])
+        while remaining > 0 and self._read_block():
+            parts.append(self._data[:remaining])
+            self._pos = len(parts[-1])
+            remaining -= self._pos
+        return b''.join(parts)
+
+    def close(self):
+        self._file.close()
+
+
+class BamRecord:
+    """A record of a BAM file. The sequence and the alignment end are only decoded when they are accessed."""
+
+    __slots__ = ('_n_cigar_op', '_name_length', '_seq_length', 'data', 'flag', 'pos', 'ref_id')
+
+    def __init__(self, data):
+        self.data = data  # the record without its block_size
+        self.ref_id, self.pos, self._name_length, _, _, self._n_cigar_op, self.flag, self._seq_length, _, _, _ = BAM_RECORD_HEADER.unpack_from(data)
+
+    @property
+    def seq(self):
+        """The read sequence as in the SEQ field of a SAM file ('*' if it isn't stored)."""
+        if self._seq_length == 0:
+            return '*'
+        start = 32 + self._name_length + 4 * self._n_cigar_op
+        return self.data[start:start + (self._seq_length + 1) // 2].hex().translate(SEQ_DECODE_TABLE)[:self._seq_length]
+
+    @property
+    def end(self):
+        """The 0-based exclusive end of the alignment on the reference (pos + 1 for unmapped reads or reads without reference-consuming operations)."""
+        if self.flag & FLAG_NAMES['UNMAP']:
+            return self.pos + 1
+        start = 32 + self._name_length
+        length = 0
+        for cigar_op in struct.unpack_from('<%dI' % self._n_cigar_op, self.data, start):
+            if cigar_op & 0xf in REFERENCE_CIGAR_OPS:
+                length += cigar_op >> 4
+        return self.pos + max(length, 1)
+
+
+class BamReader:
+    """Reads the header and the records of a BAM file, optionally only those overlapping a region (using the .bai index if there is one).
+
+    Parameters
+    ----------
+    bam_filename: str
+        The BAM file.
+
+    Attributes
+    ----------
+    header_text: str
+        The text of the header (the @HD, @SQ, @PG... lines).
+    references: list
+        The (name, length) of the reference sequences.
+
+    """
+
+    def __init__(self, bam_filename):
+        self.bam_filename = bam_filename
+        self._bgzf = BgzfReader(bam_filename)
+        if self._bgzf.read(4) != BAM_MAGIC:
+            raise InputFileFormatException('%s is not a BAM file' % bam_filename)
+        text_length = struct.unpack('<i', self._bgzf.read(4))[0]
+        self.header_text = self._bgzf.read(text_length).split(b'\0', 1)[0].decode('utf-8')
+        n_refs = struct.unpack('<i', self._bgzf.read(4))[0]
+        self.references = []
+        for _ in range(n_refs):
+            name_length = struct.unpack('<i', self._bgzf.read(4))[0]
+            name = self._bgzf.read(name_length)[:-1].decode('utf-8')
+            self.references.append((name, struct.unpack('<i', self._bgzf.read(4))[0]))
+        self._first_record_offset = self._bgzf.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._bgzf.close()
+
+    def parse_region(self, region):
+        """Return the (reference index, 0-based start, 0-based exclusive end) of a samtools region such as 'chr1', 'chr1:50' or 'chr1:50-100'."""
+        ref_ids = {name: ref_id for ref_id, (name, _) in enumerate(self.references)}
+        name, beg, end = region, 1, None
+        if region not in ref_ids:
+            match = re.match(r'^(.+):([\d,]+)(?:-([\d,]+))?$', region)
+            if match is None or match.group(1) not in ref_ids:
+                raise BadParameterException('Could not find the region "%s" in the bam file %s' % (region, self.bam_filename))
+            name = match.group(1)
+            beg = int(match.group(2).replace(',', ''))
+            if match.group(3) is not None:
+                end = int(match.group(3).replace(',', ''))
+        ref_id = ref_ids[name]
+        if end is None:
+            end = self.references[ref_id][1]
+        return ref_id, max(beg - 1, 0), end
+
+    def _read_records(self):
+        while True:
+            size = self._bgzf.read(4)
+            if len(size) < 4:
+                return
+            block_size = struct.unpack('<i', size)[0]
+            data = self._bgzf.read(block_size)
+            if len(data) < block_size:
+                raise InputFileFormatException('Truncated record in ' + self.bam_filename)
+            yield BamRecord(data)
+
+    def _get_region_start(self, ref_id, beg, end):
+        """Return the virtual offset to start reading the records of a region from, using the index, or None if no records overlap it."""
+        index_filename = get_index_filename(self.bam_filename)
+        if index_filename is None:
+            return self._first_record_offset
+        with open(index_filename, 'rb') as index_file:
+            index = index_file.read()
+        if index[:4] != BAI_MAGIC:
+            raise InputFileFormatException('%s is not a BAI index' % index_filename)
+        offset = 8
+        for current_ref_id in range(struct.unpack_from('<i', index, 4)[0]):
+            n_bins = struct.unpack_from('<i', index, offset)[0]
+            offset += 4
+            chunks = []
+            query_bins = set(reg2bins(beg, end)) if current_ref_id == ref_id else set()
+            for _ in range(n_bins):
+                bin_id, n_chunks = struct.unpack_from('<Ii', index, offset)
+                offset += 8
+                if bin_id in query_bins:
+                    offsets = struct.unpack_from('<%dQ' % (2 * n_chunks), index, offset)
+                    chunks.extend(zip(offsets[::2], offsets[1::2]))
+                offset += 16 * n_chunks
+            n_intervals = struct.unpack_from('<i', index, offset)[0]
+            offset += 4
+            if current_ref_id == ref_id:
+                linear_index = struct.unpack_from('<%dQ' % n_intervals, index, offset)
+                # records before the first record overlapping the 16kb window of beg can't overlap the region
+                min_offset = linear_index[min(beg >> LINEAR_INDEX_SHIFT, n_intervals - 1)] if n_intervals > 0 else 0
+                chunk_starts = [chunk_start for chunk_start, chunk_end in chunks if chunk_end > min_offset]
+                return max(min(chunk_starts), min_offset) if chunk_starts else None
+            offset += 8 * n_intervals
+        return None
+
+    def fetch(self, region=''):
+        """Yield the records of the file, or the records overlapping region (a samtools region, see parse_region).
+
+        Reading a region uses the .bai index if there is one, otherwise the whole file is read.
+        """
+        if region == '':
+            self._bgzf.seek(self._first_record_offset)
+            yield from self._read_records()
+            return
+        ref_id, beg, end = self.parse_region(region)
+        start = self._get_region_start(ref_id, beg, end)
+        if start is None:
+            return
+        sorted_index = get_index_filename(self.bam_filename) is not None
+        self._bgzf.seek(start)
+        for record in self._read_records():
+            if record.ref_id != ref_id:
+                if sorted_index and (record.ref_id > ref_id or record.ref_id < 0):
+                    return
+                continue
+            if record.pos >= end:
+                if sorted_index:
+                    return
+                continue
+            if record.end > beg:
+                yield record
+
+
+class BgzfWriter:
+    """Writes data to a BGZF file in compressed blocks."""
+
+    def __init__(self, filename, compression_level=6):
+        self._file = open(filename, 'wb')
+        self.compression_level = compression_level
+        self._data = []
+        self._data_size = 0
+
+    def write(self, data):
+        self._data.append(data)
+        self._data_size += len(data)
+        if self._data_size >= BGZF_MAX_BLOCK_DATA:
+            self._flush_blocks()
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        block_size = BGZF_HEADER.size + BGZF_EXTRA_FIELD.size + len(compressed) + BGZF_FOOTER.size
+        self._file.write(BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, BGZF_EXTRA_FIELD.size))
+        self._file.write(BGZF_EXTRA_FIELD.pack(66, 67, 2, block_size - 1))
+        self._file.write(compressed)
+        self._file.write(BGZF_FOOTER.pack(zlib.crc32(data), len(data)))
+
+    def _flush_blocks(self, flush_all=False):
+        data = b''.join(self._data)
+        offset = 0
+        while len(data) - offset >= BGZF_MAX_BLOCK_DATA or (flush_all and offset < len(data)):
+            self._write_block(data[offset:offset + BGZF_MAX_BLOCK_DATA])
+            offset += BGZF_MAX_BLOCK_DATA
+        self._data = [data[offset:]] if offset < len(data) else []
+        self._data_size = len(data) - offset
+
+    def close(self):
+        """Write the remaining data and the end-of-file block, and close the file."""
+        self._flush_blocks(flush_all=True)
+        self._file.write(BGZF_EOF)
+        self._file.close()
+
+
+class BamWriter:
+    """Writes a BAM file record by record.
+
+    Parameters
+    ----------
+    bam_filename: str
+        The BAM file to write.
+    header_text: str
+        The text of the header (the @HD, @SQ, @PG... lines).
+    references: list
+        The (name, length) of the reference sequences, as in BamReader.references.
+
+    """
+
+    def __init__(self, bam_filename, header_text, references):
+        self._bgzf = BgzfWriter(bam_filename)
+        text = header_text.encode('utf-8')
+        header = [BAM_MAGIC, struct.pack('<i', len(text)), text, struct.pack('<i', len(references))]
+        for name, length in references:
+            name = name.encode('utf-8') + b'\0'
+            header.append(struct.pack('<i', len(name)) + name + struct.pack('<i', length))
+        self._bgzf.write(b''.join(header))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, record_data, tags=None):
+        """Write a record (the data of a BamRecord), adding the string tags in the dict tags (e.g. {'c2': 'ALN=...'}) to it."""
+        if tags:
+            record_data = record_data + b''.join(tag.encode('ascii') + b'Z' + value.encode('utf-8') + b'\0' for tag, value in tags.items())
+        self._bgzf.write(struct.pack('<i', len(record_data)) + record_data)
+
+    def close(self):
+        self._bgzf.close()
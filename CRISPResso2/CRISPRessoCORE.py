@@ -7,20 +7,28 @@ Software pipeline for the analysis of genome editing outcomes from deep sequenci
 """
 
 import gzip
+import heapq
 import json
 import logging
+import math
+import multiprocessing as mp
 import os
+import pickle
+import queue
 import re
 import sys
 import subprocess as sb
+import struct
+import time
 import traceback
 import zipfile
 
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 from copy import deepcopy
-from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
 from functools import partial
+from itertools import islice, zip_longest
 from multiprocessing import Process
 from CRISPResso2 import CRISPRessoCOREResources, CRISPRessoShared
 from CRISPResso2.writers import vcf
@@ -29,7 +37,7 @@ from CRISPResso2.CRISPRessoReports import CRISPRessoReport
 CRISPRessoProVersion = CRISPRessoShared.get_C2Pro_version()
 C2PRO_INSTALLED = CRISPRessoProVersion is not None
 
-from CRISPResso2 import CRISPResso2Align, CRISPRessoMultiProcessing
+from CRISPResso2 import CRISPResso2Align, CRISPRessoAlignmentCache, CRISPRessoBAM, CRISPRessoMultiProcessing, CRISPRessoVariantStore
 from CRISPResso2.plots import data_prep as CRISPRessoPlotData
 from CRISPResso2.plots.plot_context import CorePlotContext
 
@@ -128,13 +136,8 @@ def get_avg_read_length_fastq(fastq_filename):
 
 
 def get_n_reads_bam(bam_filename, bam_chr_loc=""):
-    cmd = "samtools view -c " + bam_filename + " " + bam_chr_loc
-    p = sb.Popen(cmd, shell=True, stdout=sb.PIPE)
-    try:
-        retval = int(float(p.communicate()[0]))
-    except ValueError:
-        raise CRISPRessoShared.InstallationException('Error when running the command:' + cmd + '\nCheck that samtools is installed correctly.')
-    return retval
+    with CRISPRessoBAM.BamReader(bam_filename) as bam_reader:
+        return sum(1 for _ in bam_reader.fetch(bam_chr_loc))
 
 
 pd = check_library('pandas')
@@ -624,7 +627,281 @@ def get_prime_editing_guides(this_amp_seq, ref0_seq, prime_editing_edited_amp_se
 # end prime editing guide function
 
 
-def get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaffold_dna_info):
+def get_aligner(args, aln_matrix):
+    """Creates the aligner used to align reads to the amplicons
+
+    params:
+     args: CRISPResso2 args
+     aln_matrix: alignment matrix for needleman wunsch
+
+    Returns:
+     CRISPResso2Align.Aligner with the needleman wunsch parameters from args bound
+
+    """
+    return CRISPResso2Align.Aligner(
+        aln_matrix,
+        gap_open=args.needleman_wunsch_gap_open,
+        gap_extend=args.needleman_wunsch_gap_extend,
+        max_indel_size=args.aln_band_max_indel_size,
+        linear_space_threshold=args.aln_linear_space_threshold,
+    )
+
+
+def get_seed_matcher(args, refs, ref_names):
+    """Creates the matcher used to find the alignment seeds of the references in reads
+
+    params:
+     args: CRISPResso2 args
+     refs: dict with info for all refs
+     ref_names: list of ref names
+
+    Returns:
+     CRISPRessoCOREResources.SeedMatcher over the first args.aln_seed_count forward and reverse complement seeds of each ref
+
+    """
+    return CRISPRessoCOREResources.SeedMatcher(
+        [refs[ref_name]['fw_seeds'][:args.aln_seed_count] for ref_name in ref_names],
+        [refs[ref_name]['rc_seeds'][:args.aln_seed_count] for ref_name in ref_names],
+    )
+
+
+def get_include_masks(refs, ref_names):
+    """Creates the quantification window masks of the references used to find the modifications in the window
+
+    params:
+     refs: dict with info for all refs
+     ref_names: list of ref names
+
+    Returns:
+     dict of ref name to the mask of its include_idxs from CRISPRessoCOREResources.get_include_mask
+
+    """
+    return {ref_name: CRISPRessoCOREResources.get_include_mask(refs[ref_name]['include_idxs'], refs[ref_name]['sequence_length']) for ref_name in ref_names}
+
+
+# args that change the variant objects computed for reads, in addition to the references and the alignment matrix
+ALIGNMENT_CACHE_ARGS = [
+    'needleman_wunsch_gap_open',
+    'needleman_wunsch_gap_extend',
+    'aln_seed_count',
+    'aln_seed_min',
+    'aln_prune_references',
+    'aln_kmer_size',
+    'assign_ambiguous_alignments_to_first_reference',
+    'expand_ambiguous_alignments',
+    'ignore_deletions',
+    'ignore_insertions',
+    'ignore_substitutions',
+    'use_legacy_insertion_quantification',
+    'prime_editing_pegRNA_scaffold_seq',
+]
+
+
+def get_alignment_cache(args, refs, ref_names, aln_matrix, pe_scaffold_dna_info):
+    """Opens the persistent alignment cache in args.alignment_cache_dir
+
+    params:
+     args: CRISPResso2 args
+     refs: dict with info for all refs
+     ref_names: list of ref names
+     aln_matrix: alignment matrix for needleman wunsch
+     pe_scaffold_dna_info: for prime-editing tuple of(
+         index of location in ref to find scaffold seq if it exists
+         shortest dna sequence to identify scaffold sequence
+         )
+
+    Returns:
+     CRISPRessoAlignmentCache.AlignmentCache whose entries are only shared with runs that compute the same variant objects,
+     or None if no cache directory was given
+
+    """
+    if not args.alignment_cache_dir:
+        return None
+    context = {
+        'version': CRISPRessoShared.__version__,
+        'refs': [
+            (
+                ref_name,
+                refs[ref_name]['sequence'],
+                [int(x) for x in refs[ref_name]['gap_incentive']],
+                refs[ref_name]['min_aln_score'],
+                [int(x) for x in refs[ref_name]['include_idxs']],
+                refs[ref_name]['fw_seeds'],
+                refs[ref_name]['rc_seeds'],
+            )
+            for ref_name in ref_names
+        ],
+        'aln_matrix': (aln_matrix.shape, aln_matrix.tobytes()),
+        'pe_scaffold_dna_info': (int(pe_scaffold_dna_info[0]), pe_scaffold_dna_info[1]),
+        'trace_all_refs': bool(args.fastq_output or args.bam_output or args.bam_input),
+        'args': {arg_name: getattr(args, arg_name) for arg_name in ALIGNMENT_CACHE_ARGS},
+    }
+    return CRISPRessoAlignmentCache.AlignmentCache(args.alignment_cache_dir, context, args.alignment_cache_max_size)
+
+
+def add_alignment_cache_stats(alignment_cache, aln_stats):
+    """Writes the pending entries of the alignment cache and adds its statistics to aln_stats
+
+    params:
+     alignment_cache: CRISPRessoAlignmentCache.AlignmentCache from get_alignment_cache, or None
+     aln_stats: dictionary of alignment statistics
+
+    """
+    if alignment_cache is None:
+        return
+    alignment_cache.flush()
+    cache_stats = alignment_cache.get_stats()
+    info("Alignment cache: %d hits, %d misses, %d reads evicted; %d reads (%d bytes) in %s" % (cache_stats['hits'], cache_stats['misses'], cache_stats['evictions'], cache_stats['entries'], cache_stats['size_bytes'], cache_stats['path']))
+    aln_stats['alignment_cache'] = cache_stats
+
+
+def get_kmer_index(args, refs, ref_names):
+    """Creates the k-mer index used to prune the references a read is aligned to
+
+    params:
+     args: CRISPResso2 args
+     refs: dict with info for all refs
+     ref_names: list of ref names
+
+    Returns:
+     k-mer index (see build_kmer_index), or None if references aren't pruned
+
+    """
+    # when annotating reads, alignments to every reference are written out
+    if not args.aln_prune_references or args.aln_kmer_size <= 0 or args.fastq_output or args.bam_output or args.bam_input:
+        return None
+    return build_kmer_index([refs[ref_name]['sequence'] for ref_name in ref_names], args.aln_kmer_size)
+
+
+def build_kmer_index(ref_seqs, kmer_size):
+    """Builds an index of the k-mers in each reference sequence and in its reverse complement
+
+    params:
+     ref_seqs: list of reference sequences
+     kmer_size: length of the k-mers
+
+    Returns:
+     dict with the kmer_size, the ref_lengths and kmer_masks, which maps each k-mer to a bitmask with
+     bit 2 * i set if the k-mer occurs in ref_seqs[i] and bit 2 * i + 1 set if it occurs in its reverse complement
+
+    """
+    kmer_masks = defaultdict(int)
+    for idx, ref_seq in enumerate(ref_seqs):
+        for bit, seq in ((1 << (2 * idx), ref_seq), (1 << (2 * idx + 1), CRISPRessoShared.reverse_complement(ref_seq))):
+            for kmer in set(seq[i:i + kmer_size] for i in range(len(seq) - kmer_size + 1)):
+                kmer_masks[kmer] |= bit
+    return {'kmer_size': kmer_size, 'ref_lengths': [len(ref_seq) for ref_seq in ref_seqs], 'kmer_masks': dict(kmer_masks)}
+
+
+def get_score_upper_bounds(kmer_index, fastq_seq):
+    """Computes an upper bound of the alignment score of a read to each reference, on each strand, from the k-mers they share
+    Every mismatch, gap or unaligned base in an alignment is contained in at most kmer_size of the k-mers of the read,
+    and every other k-mer of the read is also a k-mer of the reference. So if only n_shared of the n_kmers k-mers of the read
+    are in the reference, the alignment has at least (n_kmers - n_shared) / kmer_size differences, and at least the difference in length.
+    The score (100 * matches / alignment length) is then at most 100 * min_length / (min_length + differences).
+    The bound is rounded like the alignment score, so scores are never greater than their bound.
+
+    params:
+     kmer_index: k-mer index from build_kmer_index
+     fastq_seq: read sequence
+
+    Returns:
+     list with a tuple of the score bounds of the read (forward, reverse complement) for each reference
+
+    """
+    kmer_size = kmer_index['kmer_size']
+    n_kmers = len(fastq_seq) - kmer_size + 1
+    n_shared = [0] * (2 * len(kmer_index['ref_lengths']))
+    if n_kmers > 0:
+        kmer_masks = kmer_index['kmer_masks']
+        mask_counts = Counter(kmer_masks.get(fastq_seq[i:i + kmer_size], 0) for i in range(n_kmers))
+        for mask, count in mask_counts.items():
+            bit = 0
+            while mask:
+                if mask & 1:
+                    n_shared[bit] += count
+                mask >>= 1
+                bit += 1
+
+    score_bounds = []
+    for idx, ref_length in enumerate(kmer_index['ref_lengths']):
+        min_length = min(len(fastq_seq), ref_length)
+        strand_bounds = []
+        for shared in n_shared[2 * idx:2 * idx + 2]:
+            min_diffs = abs(len(fastq_seq) - ref_length)
+            if n_kmers > 0:
+                min_diffs = max(min_diffs, -(-(n_kmers - shared) // kmer_size))
+            if min_length + min_diffs == 0:
+                strand_bounds.append(100.0)
+            else:
+                strand_bounds.append(round(100 * min_length / float(min_length + min_diffs), 3))
+        score_bounds.append(tuple(strand_bounds))
+    return score_bounds
+
+
+def trace_alignment(aligner, aln_seq, ref, include_mask=None):
+    """Aligns a read to a reference, finding the modifications of the alignment in the traceback if include_mask is given
+    params:
+     aligner: CRISPResso2Align.Aligner
+     aln_seq: read sequence to align
+     ref: dict with info for the ref
+     include_mask: quantification window mask of the ref from get_include_masks, or None to only align the read
+
+    Returns:
+     s1: aligned read
+     s2: aligned ref
+     score: alignment score
+     payload: modifications of the alignment as returned by CRISPRessoCOREResources.find_indels_substitutions, or None if include_mask is None
+
+    """
+    if include_mask is None:
+        s1, s2, score = aligner.align(aln_seq, ref['sequence'], ref['gap_incentive'])
+        return s1, s2, score, None
+    alignment = aligner.align_edits(aln_seq, ref['sequence'], ref['gap_incentive'], include_mask)
+    return alignment.aligned_read, alignment.aligned_ref, alignment.score, CRISPRessoCOREResources.payload_to_lists(alignment.edits)
+
+
+def align_best_strand(aligner, fastq_seq, ref, rc_first=False, score_bounds=None, include_mask=None):
+    """Aligns a read to a reference on whichever strand scores higher, for reads whose strand can't be determined from the seeds
+    Only the strand aligned first is traced back, unless the other strand scores higher
+    params:
+     aligner: CRISPResso2Align.Aligner
+     fastq_seq: read sequence to align
+     ref: dict with info for the ref
+     rc_first: whether the reverse complement of the read is the more likely to align
+     score_bounds: tuple of upper bounds of the (forward, reverse complement) scores; the second strand isn't aligned if its bound shows it can't score higher
+     include_mask: quantification window mask of the ref, passed to trace_alignment
+
+    Returns:
+     s1: aligned read
+     s2: aligned ref
+     score: alignment score
+     aln_strand: '+' or '-' (the forward strand is chosen if both strands score equally)
+     payload: modifications of the alignment from trace_alignment
+
+    """
+    rc_seq = CRISPRessoShared.reverse_complement(fastq_seq)
+    if rc_first:
+        rvs1, rvs2, rvscore, rvpayload = trace_alignment(aligner, rc_seq, ref, include_mask)
+        if score_bounds is not None and score_bounds[0] < rvscore:
+            return rvs1, rvs2, rvscore, '-', rvpayload
+        fwscore = aligner.score(fastq_seq, ref['sequence'], ref['gap_incentive'])
+        if rvscore > fwscore:
+            return rvs1, rvs2, rvscore, '-', rvpayload
+        fws1, fws2, fwscore, fwpayload = trace_alignment(aligner, fastq_seq, ref, include_mask)
+        return fws1, fws2, fwscore, '+', fwpayload
+
+    fws1, fws2, fwscore, fwpayload = trace_alignment(aligner, fastq_seq, ref, include_mask)
+    if score_bounds is not None and score_bounds[1] <= fwscore:
+        return fws1, fws2, fwscore, '+', fwpayload
+    rvscore = aligner.score(rc_seq, ref['sequence'], ref['gap_incentive'])
+    if rvscore > fwscore:
+        rvs1, rvs2, rvscore, rvpayload = trace_alignment(aligner, rc_seq, ref, include_mask)
+        return rvs1, rvs2, rvscore, '-', rvpayload
+    return fws1, fws2, fwscore, '+', fwpayload
+
+
+def get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=None, kmer_index=None, seed_matcher=None, alignment_cache=None, include_masks=None):
     """Gets the payload object for a read that hasn't been seen in the cache yet
     params:
      args: CRISPResso2 args
@@ -636,62 +913,119 @@ def get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaf
          index of location in ref to find scaffold seq if it exists
          shortest dna sequence to identify scaffold sequence
          )
+     aligner: CRISPResso2Align.Aligner to reuse between reads (if None, one is created from aln_matrix)
+     kmer_index: k-mer index of the refs from get_kmer_index. If given, references are aligned in decreasing order of their score
+         upper bound, references whose bound shows they can't be the best match are not aligned (their score is None),
+         and a strand of the read is not aligned if its bound shows it can't score higher than the other strand
+     seed_matcher: CRISPRessoCOREResources.SeedMatcher from get_seed_matcher to reuse between reads (if None, one is created from refs)
+     alignment_cache: CRISPRessoAlignmentCache.AlignmentCache from get_alignment_cache. If given, the variant payload is looked up
+         in it before aligning the read, and computed payloads are added to it
+     include_masks: quantification window masks of the refs from get_include_masks to reuse between reads (if None, they are created from refs)
 
     Returns:
      variant payload
 
     """
-    aln_scores = []
-    best_match_score = -1
-    best_unfiltered_score = -1
-    best_unfiltered_name = None
-    best_match_s1s = []
-    best_match_s2s = []
-    best_match_names = []
-    best_match_strands = []
-    ref_aln_details = []
-    for idx, ref_name in enumerate(ref_names):
+    if alignment_cache is not None:
+        new_variant = alignment_cache.get(fastq_seq)
+        if new_variant is None:
+            new_variant = get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, kmer_index=kmer_index, seed_matcher=seed_matcher, include_masks=include_masks)
+            alignment_cache.put(fastq_seq, new_variant)
+        return new_variant
+    if aligner is None:
+        aligner = get_aligner(args, aln_matrix)
+    if seed_matcher is None:
+        seed_matcher = get_seed_matcher(args, refs, ref_names)
+    if include_masks is None:
+        include_masks = get_include_masks(refs, ref_names)
+    # the modifications are found in the traceback, except for the legacy insertion quantification
+    trace_masks = include_masks
+    if args.use_legacy_insertion_quantification:
+        trace_masks = dict.fromkeys(ref_names)
+    found_forward_counts, found_reverse_counts = seed_matcher.count_seeds(fastq_seq)
+    # alignments to every reference are only written out when annotating reads; otherwise only the first reference
+    # (used to map indels of all reads onto ref1) and the best-matching references need to be traced back
+    trace_all_refs = args.fastq_output or args.bam_output or args.bam_input
+    ref_order = range(len(ref_names))
+    score_bounds = None
+    if kmer_index is not None and not trace_all_refs:
+        score_bounds = get_score_upper_bounds(kmer_index, fastq_seq)
+        # references that can't pass their min_aln_score can only tie with the best match, so they are aligned last
+        ref_order = sorted(ref_order, key=lambda idx: (max(score_bounds[idx]) <= refs[ref_names[idx]]['min_aln_score'], -max(score_bounds[idx])))
+    ref_alns = [None] * len(ref_names)
+    best_score_so_far = -1
+    for idx in ref_order:
+        ref_name = ref_names[idx]
+        strand_bounds = None
+        if score_bounds is not None:
+            strand_bounds = score_bounds[idx]
+            # the first reference is never pruned: main() maps the indels of all reads onto its alignment
+            if idx != 0 and max(strand_bounds) < best_score_so_far:
+                ref_alns[idx] = (None, None, None, '+', None)
+                continue
         # get alignment and score from cython
         # score = 100 * #matchedBases / length(including gaps)
-        seed_i = 0
-        found_forward_count = 0
-        found_reverse_count = 0
+        found_forward_count = found_forward_counts[idx]
+        found_reverse_count = found_reverse_counts[idx]
         aln_strand = '+'
-        while seed_i < args.aln_seed_count and seed_i < len(refs[ref_name]['fw_seeds']):
-            if refs[ref_name]['fw_seeds'][seed_i] in fastq_seq:  # is forward
-                found_forward_count += 1
-            if refs[ref_name]['rc_seeds'][seed_i] in fastq_seq:  # is rc
-                found_reverse_count += 1
-            seed_i += 1
-        if found_forward_count > args.aln_seed_min and found_reverse_count == 0:
-            fws1, fws2, fwscore = CRISPResso2Align.global_align(fastq_seq, refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
-            s1 = fws1
-            s2 = fws2
-            score = fwscore
+        s1 = None
+        s2 = None
+        payload = None
+        if idx == 0 or trace_all_refs:
+            if found_forward_count > args.aln_seed_min and found_reverse_count == 0:
+                s1, s2, score, payload = trace_alignment(aligner, fastq_seq, refs[ref_name], trace_masks[ref_name])
+            elif found_forward_count == 0 and found_reverse_count > args.aln_seed_min:
+                s1, s2, score, payload = trace_alignment(aligner, CRISPRessoShared.reverse_complement(fastq_seq), refs[ref_name], trace_masks[ref_name])
+                aln_strand = '-'
+            else:
+                s1, s2, score, aln_strand, payload = align_best_strand(aligner, fastq_seq, refs[ref_name], found_reverse_count > found_forward_count, strand_bounds, trace_masks[ref_name])
+        # otherwise only score this reference; it is traced back below if the read is assigned to it
+        elif found_forward_count > args.aln_seed_min and found_reverse_count == 0:
+            score = aligner.score(fastq_seq, refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
         elif found_forward_count == 0 and found_reverse_count > args.aln_seed_min:
-            rvs1, rvs2, rvscore = CRISPResso2Align.global_align(CRISPRessoShared.reverse_complement(fastq_seq), refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
-            s1 = rvs1
-            s2 = rvs2
-            score = rvscore
+            score = aligner.score(CRISPRessoShared.reverse_complement(fastq_seq), refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
+            aln_strand = '-'
+        elif strand_bounds is not None and strand_bounds[1] > strand_bounds[0]:
+            # score the more promising strand first; the forward strand is kept if both score equally
+            score = aligner.score(CRISPRessoShared.reverse_complement(fastq_seq), refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
             aln_strand = '-'
+            if strand_bounds[0] >= score:
+                fwscore = aligner.score(fastq_seq, refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
+                if not score > fwscore:
+                    score = fwscore
+                    aln_strand = '+'
         else:
-            fws1, fws2, fwscore = CRISPResso2Align.global_align(fastq_seq, refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
-            rvs1, rvs2, rvscore = CRISPResso2Align.global_align(CRISPRessoShared.reverse_complement(fastq_seq), refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
-            s1 = fws1
-            s2 = fws2
+            fwscore = aligner.score(fastq_seq, refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
             score = fwscore
-            if (rvscore > fwscore):
-                s1 = rvs1
-                s2 = rvs2
-                score = rvscore
-                aln_strand = '-'
+            if strand_bounds is None or strand_bounds[1] > fwscore:
+                rvscore = aligner.score(CRISPRessoShared.reverse_complement(fastq_seq), refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
+                if (rvscore > fwscore):
+                    score = rvscore
+                    aln_strand = '-'
 
 #                print "for " + ref_name + " got fws1: " + str(fws1) + " and fws2: " + str(fws2) + " score: " +str(fwscore)
+        ref_alns[idx] = (s1, s2, score, aln_strand, payload)
+        if score > best_score_so_far and score > refs[ref_name]['min_aln_score']:
+            best_score_so_far = score
+
+    aln_scores = []
+    best_match_score = -1
+    best_unfiltered_score = -1
+    best_unfiltered_name = None
+    best_match_s1s = []
+    best_match_s2s = []
+    best_match_names = []
+    best_match_strands = []
+    best_match_payloads = []
+    ref_aln_details = []
+    for ref_name, (s1, s2, score, aln_strand, payload) in zip(ref_names, ref_alns):
         ref_aln_details.append((ref_name, s1, s2, score))
+        aln_scores.append(score)
+        if score is None:
+            continue
         if score > best_unfiltered_score:
             best_unfiltered_score = score
             best_unfiltered_name = ref_name
-        aln_scores.append(score)
 
         # reads are matched to the reference to which they best align. The 'min_aln_score' is calculated using only the changes in 'include_idxs'
         if score > best_match_score and score > refs[ref_name]['min_aln_score']:
@@ -700,13 +1034,24 @@ def get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaf
             best_match_s2s = [s2]
             best_match_names = [ref_name]
             best_match_strands = [aln_strand]
+            best_match_payloads = [payload]
         elif score == best_match_score:
             best_match_s1s.append(s1)
             best_match_s2s.append(s2)
             best_match_names.append(ref_name)
             best_match_strands.append(aln_strand)
+            best_match_payloads.append(payload)
 
     if best_match_score > 0:
+        # trace back the best-matching references that were only scored above
+        for idx, best_match_name in enumerate(best_match_names):
+            if best_match_s1s[idx] is None:
+                aln_seq = fastq_seq if best_match_strands[idx] == '+' else CRISPRessoShared.reverse_complement(fastq_seq)
+                s1, s2, score, best_match_payloads[idx] = trace_alignment(aligner, aln_seq, refs[best_match_name], trace_masks[best_match_name])
+                best_match_s1s[idx] = s1
+                best_match_s2s[idx] = s2
+                ref_aln_details[ref_names.index(best_match_name)] = (best_match_name, s1, s2, score)
+
         new_variant = {}
         new_variant['count'] = 1
         new_variant['aln_ref_names'] = best_match_names
@@ -721,7 +1066,7 @@ def get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaf
             if args.use_legacy_insertion_quantification:
                 payload = CRISPRessoCOREResources.find_indels_substitutions_legacy(best_match_s1s[idx], best_match_s2s[idx], refs[best_match_name]['include_idxs'])
             else:
-                payload = CRISPRessoCOREResources.find_indels_substitutions(best_match_s1s[idx], best_match_s2s[idx], refs[best_match_name]['include_idxs'])
+                payload = best_match_payloads[idx]
 
             payload['ref_name'] = best_match_name
             payload['aln_scores'] = aln_scores
@@ -984,7 +1329,7 @@ def get_consensus_alignment_from_pairs(
     return final_aln, final_qual, final_ref, round(float(100 * final_homology_score / float(len(final_ref))), 3), caching_is_ok
 
 
-def get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual, fastq2_qual, refs, ref_names, aln_matrix, pe_scaffold_dna_info):
+def get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual, fastq2_qual, refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=None, seed_matcher=None, alignment_cache=None, include_masks=None):
     """Gets the payload object for a read that hasn't been seen in the cache yet
 
     Parameters
@@ -1001,6 +1346,11 @@ def get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual
         index of location in ref to find scaffold seq if it exists
         shortest dna sequence to identify scaffold sequence
         )
+    aligner: CRISPResso2Align.Aligner to reuse between reads (if None, one is created from aln_matrix)
+    seed_matcher: CRISPRessoCOREResources.SeedMatcher from get_seed_matcher to reuse between reads (if None, one is created from refs)
+    alignment_cache: CRISPRessoAlignmentCache.AlignmentCache from get_alignment_cache. If given, the payload is looked up
+        in it (by both reads and their qualities) before aligning the reads, and computed payloads are added to it
+    include_masks: quantification window masks of the refs from get_include_masks to reuse between reads (if None, they are created from refs)
 
     Returns
     -------
@@ -1008,6 +1358,20 @@ def get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual
         The payload object for the read that hasn't been seen in the cache yet
 
     """
+    if alignment_cache is not None:
+        cache_key = fastq1_seq + '+' + fastq2_seq + ' ' + fastq1_qual + ' ' + fastq2_qual
+        new_variant = alignment_cache.get(cache_key)
+        if new_variant is None:
+            new_variant = get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual, fastq2_qual, refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, seed_matcher=seed_matcher, include_masks=include_masks)
+            alignment_cache.put(cache_key, new_variant)
+        return new_variant
+    if aligner is None:
+        aligner = get_aligner(args, aln_matrix)
+    if seed_matcher is None:
+        seed_matcher = get_seed_matcher(args, refs, ref_names)
+    if include_masks is None:
+        include_masks = get_include_masks(refs, ref_names)
+    found_forward_counts, found_reverse_counts = seed_matcher.count_seeds(fastq1_seq, fastq2_seq)
     aln_scores = []
     best_match_score = -1
     best_unfiltered_score = -1
@@ -1019,33 +1383,26 @@ def get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual
     for idx, ref_name in enumerate(ref_names):
         # get alignment and score from cython
         # score = 100 * #matchedBases / length(including gaps)
-        seed_i = 0
-        found_forward_count = 0
-        found_reverse_count = 0
-        while seed_i < args.aln_seed_count and seed_i < len(refs[ref_name]['fw_seeds']):
-            if refs[ref_name]['fw_seeds'][seed_i] in fastq1_seq or refs[ref_name]['fw_seeds'][seed_i] in fastq2_seq:  # is forward
-                found_forward_count += 1
-            if refs[ref_name]['rc_seeds'][seed_i] in fastq1_seq or refs[ref_name]['rc_seeds'][seed_i] in fastq2_seq:  # is rc
-                found_reverse_count += 1
-            seed_i += 1
+        found_forward_count = found_forward_counts[idx]
+        found_reverse_count = found_reverse_counts[idx]
         if found_forward_count > args.aln_seed_min and found_reverse_count == 0:
-            r1_fws1, r1_fws2, r1_fwscore = CRISPResso2Align.global_align(fastq1_seq, refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
-            r2_fws1, r2_fws2, r2_fwscore = CRISPResso2Align.global_align(fastq2_seq, refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
+            r1_fws1, r1_fws2, r1_fwscore = aligner.align(fastq1_seq, refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
+            r2_fws1, r2_fws2, r2_fwscore = aligner.align(fastq2_seq, refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
             s1, qual, s2, score, caching_is_ok = get_consensus_alignment_from_pairs(r1_fws1, r1_fws2, r1_fwscore, fastq1_qual, r2_fws1, r2_fws2, r2_fwscore, fastq2_qual)
         elif found_forward_count == 0 and found_reverse_count > args.aln_seed_min:
-            r1_rvs1, r1_rvs2, r1_rvscore = CRISPResso2Align.global_align(CRISPRessoShared.reverse_complement(fastq1_seq), refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
-            r2_rvs1, r2_rvs2, r2_rvscore = CRISPResso2Align.global_align(CRISPRessoShared.reverse_complement(fastq2_seq), refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
+            r1_rvs1, r1_rvs2, r1_rvscore = aligner.align(CRISPRessoShared.reverse_complement(fastq1_seq), refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
+            r2_rvs1, r2_rvs2, r2_rvscore = aligner.align(CRISPRessoShared.reverse_complement(fastq2_seq), refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
             rvs1, rvqual, rvs2, rvscore, caching_is_ok = get_consensus_alignment_from_pairs(r1_rvs1, r1_rvs2, r1_rvscore, fastq1_qual, r2_rvs1, r2_rvs2, r2_rvscore, fastq2_qual)
             s1 = rvs1
             qual = rvqual
             s2 = rvs2
             score = rvscore
         else:
-            r1_fws1, r1_fws2, r1_fwscore = CRISPResso2Align.global_align(fastq1_seq, refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
-            r2_fws1, r2_fws2, r2_fwscore = CRISPResso2Align.global_align(fastq2_seq, refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
+            r1_fws1, r1_fws2, r1_fwscore = aligner.align(fastq1_seq, refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
+            r2_fws1, r2_fws2, r2_fwscore = aligner.align(fastq2_seq, refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
             fws1, fwqual, fws2, fwscore, caching_is_ok = get_consensus_alignment_from_pairs(r1_fws1, r1_fws2, r1_fwscore, fastq1_qual, r2_fws1, r2_fws2, r2_fwscore, fastq2_qual)
-            r1_rvs1, r1_rvs2, r1_rvscore = CRISPResso2Align.global_align(CRISPRessoShared.reverse_complement(fastq1_seq), refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
-            r2_rvs1, r2_rvs2, r2_rvscore = CRISPResso2Align.global_align(CRISPRessoShared.reverse_complement(fastq2_seq), refs[ref_name]['sequence'], matrix=aln_matrix, gap_incentive=refs[ref_name]['gap_incentive'], gap_open=args.needleman_wunsch_gap_open, gap_extend=args.needleman_wunsch_gap_extend,)
+            r1_rvs1, r1_rvs2, r1_rvscore = aligner.align(CRISPRessoShared.reverse_complement(fastq1_seq), refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
+            r2_rvs1, r2_rvs2, r2_rvscore = aligner.align(CRISPRessoShared.reverse_complement(fastq2_seq), refs[ref_name]['sequence'], refs[ref_name]['gap_incentive'])
             rvs1, rvqual, rvs2, rvscore, caching_is_ok = get_consensus_alignment_from_pairs(r1_rvs1, r1_rvs2, r1_rvscore, fastq1_qual, r2_rvs1, r2_rvs2, r2_rvscore, fastq2_qual)
 
             s1 = fws1
@@ -1093,7 +1450,7 @@ def get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual
             if args.use_legacy_insertion_quantification:
                 payload = CRISPRessoCOREResources.find_indels_substitutions_legacy(best_match_s1s[idx], best_match_s2s[idx], refs[best_match_name]['include_idxs'])
             else:
-                payload = CRISPRessoCOREResources.find_indels_substitutions(best_match_s1s[idx], best_match_s2s[idx], refs[best_match_name]['include_idxs'])
+                payload = CRISPRessoCOREResources.find_indels_substitutions(best_match_s1s[idx], best_match_s2s[idx], refs[best_match_name]['include_idxs'], include_masks[best_match_name])
 
             payload['ref_name'] = best_match_name
             payload['aln_scores'] = aln_scores
@@ -1169,6 +1526,124 @@ def get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual
     return new_variant
 
 
+def count_fastq_partition(fastq1_filename, fastq2_filename=None, n_partitions=1, partition=0, start=0, end=None):
+    """Counts the reads of one partition of a fastq file (or the read pairs of two fastq files)
+
+    Parameters
+    ----------
+        fastq1_filename: the fastq file (or the R1 fastq file)
+        fastq2_filename: the R2 fastq file, or None for single-end reads
+        n_partitions: the number of hash partitions
+        partition: the index of the hash partition to count
+        start, end: the byte range of the records to count, for uncompressed single-end reads
+
+    Returns
+    -------
+    counts: the dict of the reads of this partition, as in count_fastq_reads
+    first_reads: the index of the read where each key of counts was first seen
+    num_reads: the number of reads read
+    same_length: False if the fastq files don't have the same number of reads
+
+    """
+    counts = {}
+    first_reads = []
+    with CRISPRessoCOREResources.FastqReader(fastq1_filename, start=start, end=end) as fastq1_reader:
+        if fastq2_filename is None:
+            num_reads = fastq1_reader.count_sequences(counts, first_reads, n_partitions, partition, pack=True)
+            same_length = True
+        else:
+            with CRISPRessoCOREResources.FastqReader(fastq2_filename, reverse_complement=True) as fastq2_reader:
+                num_reads = fastq1_reader.count_pairs(fastq2_reader, counts, first_reads, n_partitions, partition, pack=True)
+                same_length = fastq1_reader.at_end() and fastq2_reader.at_end()
+    return counts, first_reads, num_reads, same_length
+
+
+def count_fastq_reads(variantCache, fastq1_filename, fastq2_filename=None, n_processes=1):
+    """Counts the unique reads of a fastq file (or the unique read pairs of two fastq files) into variantCache
+
+    For single-end reads, the keys are the sequences and the values the number of reads.
+    For paired-end reads, the keys are the R1 sequence + '+' + the reverse complemented R2 sequence, and the values
+    a list of the number of read pairs and the qualities of the first pair (R1 qualities + ' ' + reversed R2 qualities).
+    Keys are packed with CRISPRessoCOREResources.pack_sequence (as are all the keys of variantCache), so they take about a
+    quarter of the memory of the sequences.
+
+    With several processes, uncompressed single-end files are split into byte ranges that are counted in parallel.
+    Other inputs can't be split, so each process reads the whole input and counts the reads whose sequences hash to its partition.
+    Either way, the keys of variantCache are in the order they were first seen, as when counting in a single process.
+
+    Parameters
+    ----------
+        variantCache: the dict to count the reads into, which must be empty when counting with several processes
+        fastq1_filename: the fastq file (or the R1 fastq file)
+        fastq2_filename: the R2 fastq file, or None for single-end reads
+        n_processes: the number of processes to count with
+
+    Returns
+    -------
+    num_reads: the number of reads (or read pairs) in the input
+    same_length: False if the fastq files don't have the same number of reads
+
+    """
+    if n_processes <= 1:
+        with CRISPRessoCOREResources.FastqReader(fastq1_filename) as fastq1_reader:
+            if fastq2_filename is None:
+                return fastq1_reader.count_sequences(variantCache, pack=True), True
+            with CRISPRessoCOREResources.FastqReader(fastq2_filename, reverse_complement=True) as fastq2_reader:
+                num_reads = fastq1_reader.count_pairs(fastq2_reader, variantCache, pack=True)
+                return num_reads, fastq1_reader.at_end() and fastq2_reader.at_end()
+
+    split_by_range = fastq2_filename is None and not fastq1_filename.endswith('.gz')
+    with ProcessPoolExecutor(n_processes) as executor:
+        if split_by_range:
+            file_size = os.path.getsize(fastq1_filename)
+            bounds = [file_size * i // n_processes for i in range(n_processes + 1)]
+            futures = [executor.submit(count_fastq_partition, fastq1_filename, start=bounds[i], end=bounds[i + 1]) for i in range(n_processes)]
+        else:
+            futures = [executor.submit(count_fastq_partition, fastq1_filename, fastq2_filename, n_processes, i) for i in range(n_processes)]
+        partitions = [future.result() for future in futures]
+
+    if split_by_range:
+        # each range has its keys in the order they were first seen in it, so merging the ranges in order keeps the input order
+        for counts, _, _, _ in partitions:
+            for key, count in counts.items():
+                variantCache[key] = variantCache.get(key, 0) + count
+        return sum(partition[2] for partition in partitions), True
+
+    partition_items = [zip(first_reads, counts.items()) for counts, first_reads, _, _ in partitions]
+    for _, (key, value) in heapq.merge(*partition_items, key=lambda item: item[0]):
+        variantCache[key] = value
+    return partitions[0][2], partitions[0][3]
+
+
+# approximate memory used by the variant object of a unique read, per base of the read
+VARIANT_BYTES_PER_BASE = 32
+
+
+def get_n_memory_partitions(fastq_filename, n_reads, max_memory):
+    """Determines how many partitions the unique reads of a fastq file must be split into to fit in a memory budget
+
+    The estimate assumes that every read is unique, so it's an upper bound.
+
+    Parameters
+    ----------
+        fastq_filename: the fastq file
+        n_reads: the number of reads in the fastq file
+        max_memory: the memory budget in megabytes, or 0 for no limit
+
+    Returns
+    -------
+    n_partitions: the number of partitions, 1 if the reads fit in max_memory
+
+    """
+    if max_memory <= 0 or n_reads == 0:
+        return 1
+    with CRISPRessoCOREResources.FastqReader(fastq_filename) as fastq_reader:
+        read_lengths = [len(fastq_seq) for _, fastq_seq, _, _ in islice(fastq_reader, 10000)]
+    avg_read_length = sum(read_lengths) / max(1, len(read_lengths))
+    estimated_memory = n_reads * avg_read_length * VARIANT_BYTES_PER_BASE
+    return max(1, int(-(-estimated_memory // (max_memory * 1024 * 1024))))
+
+
 def get_variant_cache_equal_boundaries(num_unique_sequences, n_processes):
     """Determines the boundaries for the number of unique sequences to be processed by each process
 
@@ -1195,12 +1670,137 @@ def get_variant_cache_equal_boundaries(num_unique_sequences, n_processes):
     return boundaries
 
 
-def variant_file_generator_process(seq_list, get_new_variant_object, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, process_id, variants_dir, quals_list=None):
-    """The target of the multiprocessing.Process object, generates the new variants for a subset of the reads in the fastq file and stores them in tsv files
+# each batch of records in a variant file is preceded by the index of its chunk of reads and its length in bytes
+VARIANT_RECORD_HEADER = struct.Struct('<QQ')
+# the unique reads are split into about this many chunks per process, so that processes that finish early take more chunks
+CHUNKS_PER_PROCESS = 16
+MAX_READS_PER_CHUNK = 10000
+# number of reads read by align_fastq_streaming before the new unique reads are queued for alignment
+STREAMING_BLOCK_READS = 10000
+# number of randomly drawn reads analyzed by align_fastq_to_convergence between checks of the confidence intervals
+CONVERGENCE_BLOCK_READS = 10000
+# z score of the 95% confidence intervals of the modified frequencies
+CONVERGENCE_Z = 1.959963984540054
+# reads are drawn in the same random order in every run so results are reproducible
+CONVERGENCE_RANDOM_SEED = 0
+
+
+def get_variant_file_path(variants_dir, process_id):
+    """Returns the path of the variant file written by the process process_id of variant_file_generator_process"""
+    return os.path.join(variants_dir, f"variants_{process_id}.bin")
+
+
+def write_variant_records(file, variant_records, chunk_index=0):
+    """Writes a batch of (read, variant object) records to a variant file opened in binary mode
+
+    Each batch is written as one length-prefixed pickle, so the variant objects are read back exactly as they were
+    computed (e.g. numpy arrays are stored as their raw buffers) without converting them to and from JSON.
+
+    Parameters
+    ----------
+        file: the variant file, opened with 'wb'
+        variant_records: list of (read, variant object) tuples
+        chunk_index: the index of the chunk of reads the records belong to, batches are read back in this order
+
+    Returns
+    -------
+    Nothing
+
+    """
+    if not variant_records:
+        return
+    data = pickle.dumps(variant_records, protocol=pickle.HIGHEST_PROTOCOL)
+    file.write(VARIANT_RECORD_HEADER.pack(chunk_index, len(data)))
+    file.write(data)
+
+
+def read_variant_files(variant_file_paths):
+    """Reads the (read, variant object) records of variant files written with write_variant_records
+
+    Parameters
+    ----------
+        variant_file_paths: list of paths to the variant files
+
+    Returns
+    -------
+    A generator of (read, variant object) tuples, ordered by the chunk index of their batch (and then by the order they were written)
+
+    """
+    batches = []
+    for file_index, variant_file_path in enumerate(variant_file_paths):
+        file_size = os.path.getsize(variant_file_path)
+        with open(variant_file_path, 'rb') as file:
+            offset = 0
+            while offset < file_size:
+                header = file.read(VARIANT_RECORD_HEADER.size)
+                if len(header) != VARIANT_RECORD_HEADER.size:
+                    raise CRISPRessoShared.OutputFolderIncompleteException("Could not parse variants from file " + variant_file_path)
+                chunk_index, length = VARIANT_RECORD_HEADER.unpack(header)
+                offset += VARIANT_RECORD_HEADER.size
+                if offset + length > file_size:
+                    raise CRISPRessoShared.OutputFolderIncompleteException("Could not parse variants from file " + variant_file_path)
+                batches.append((chunk_index, file_index, offset, length))
+                offset += length
+                file.seek(offset)
+
+    files = {}
+    try:
+        for _, file_index, offset, length in sorted(batches):
+            if file_index not in files:
+                files[file_index] = open(variant_file_paths[file_index], 'rb')
+            file = files[file_index]
+            file.seek(offset)
+            yield from pickle.loads(file.read(length))
+    finally:
+        for file in files.values():
+            file.close()
+
+
+def get_weighted_chunks(seq_list, n_refs, n_processes):
+    """Splits the unique reads into chunks of roughly equal alignment work
+
+    The work of a read is estimated as its length (or the length of its packed key, which is proportional to it)
+    times the number of references it may be aligned to.
+    There are several chunks per process, so that processes that get faster chunks take more of them.
 
     Parameters
     ----------
-        seq_list: list of reads to process
+        seq_list: list of unique reads, or of their packed keys
+        n_refs: number of references each read may be aligned to
+        n_processes: number of processes the chunks are shared by
+
+    Returns
+    -------
+    chunks: list of (start, end) indexes in seq_list
+
+    """
+    if not seq_list:
+        return []
+    n_chunks = max(n_processes * CHUNKS_PER_PROCESS, -(-len(seq_list) // MAX_READS_PER_CHUNK))
+    target_weight = sum(len(seq) for seq in seq_list) * n_refs / n_chunks
+    chunks = []
+    start = 0
+    chunk_weight = 0
+    for index, seq in enumerate(seq_list):
+        chunk_weight += len(seq) * n_refs
+        if chunk_weight >= target_weight or index + 1 - start >= MAX_READS_PER_CHUNK:
+            chunks.append((start, index + 1))
+            start = index + 1
+            chunk_weight = 0
+    if start < len(seq_list):
+        chunks.append((start, len(seq_list)))
+    return chunks
+
+
+def variant_file_generator_process(task_queue, stats_queue, get_new_variant_object, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, process_id, variants_dir, alignment_cache=None):
+    """The target of the multiprocessing.Process objects started by get_new_variant_objects_in_processes,
+    takes chunks of reads from a queue shared by all processes until it is empty, generates the new variants of the reads
+    and stores them in a variant file (see write_variant_records)
+
+    Parameters
+    ----------
+        task_queue: queue of (chunk index, list of packed reads, list of quality scores for the reads or None) tasks, ended by None
+        stats_queue: queue the utilisation stats of the process are put in when it is done
         get_new_variant_object: function to generate the new variant object
         args: CRISPResso2 args
         refs: dict with info for all refs
@@ -1211,35 +1811,379 @@ def variant_file_generator_process(seq_list, get_new_variant_object, args, refs,
         shortest dna sequence to identify scaffold sequence
         )
         process_id: the id of the process to print out debug information
-        variants_dir: the directory to store the tsv files
+        variants_dir: the directory to store the variant files
+        alignment_cache: the persistent alignment cache from get_alignment_cache, or None
+
+    Returns
+    -------
+    Nothing
+
+    """
+    start_time = time.perf_counter()
+    busy_time = 0
+    n_chunks = 0
+    n_reads = 0
+    weight = 0
+    variant_file_path = get_variant_file_path(variants_dir, process_id)
+    aligner = get_aligner(args, aln_matrix)
+    seed_matcher = get_seed_matcher(args, refs, ref_names)
+    include_masks = get_include_masks(refs, ref_names)
+    kmer_index = None if args.crispresso_merge else get_kmer_index(args, refs, ref_names)
+    with open(variant_file_path, 'wb') as file:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            chunk_start_time = time.perf_counter()
+            chunk_index, seq_list, quals_list = task
+            variant_records = []
+            for index, seq_key in enumerate(seq_list):
+                fastq_seq = CRISPRessoCOREResources.unpack_sequence(seq_key)
+                if args.crispresso_merge:  # If using CRISPResso to merge the passed in function is get_new_variant_object_from_paired
+                    fastq1_seq, fastq2_seq = fastq_seq.split('+')
+                    fastq1_qual, fastq2_qual = quals_list[index].split(' ')
+                    new_variant = get_new_variant_object(args, fastq1_seq, fastq2_seq, fastq1_qual, fastq2_qual, refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, seed_matcher=seed_matcher, alignment_cache=alignment_cache, include_masks=include_masks)
+                else:
+                    new_variant = get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, kmer_index=kmer_index, seed_matcher=seed_matcher, alignment_cache=alignment_cache, include_masks=include_masks)
+                variant_records.append((seq_key, new_variant))
+                weight += len(fastq_seq) * len(ref_names)
+            write_variant_records(file, variant_records, chunk_index)
+            if (n_reads + len(seq_list)) // 10000 > n_reads // 10000:
+                info(f"Process {process_id + 1} has processed {n_reads + len(seq_list)} unique reads", {'percent_complete': 10})
+            n_reads += len(seq_list)
+            n_chunks += 1
+            busy_time += time.perf_counter() - chunk_start_time
+    if alignment_cache is not None:
+        alignment_cache.flush()
+
+    info(f"Process {process_id + 1} has finished processing {n_reads} unique reads", {'percent_complete': 10})
+    stats_queue.put({
+        'process_id': process_id,
+        'chunks': n_chunks,
+        'reads': n_reads,
+        'weight': weight,
+        'busy_time': busy_time,
+        'total_time': time.perf_counter() - start_time,
+    })
+
+
+def get_new_variant_objects_in_processes(seq_list, get_new_variant_object, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, n_processes, variants_dir, quals_list=None, alignment_cache=None):
+    """Generates the new variants for a list of unique reads in n_processes processes
+
+    The reads are split into chunks of roughly equal work (see get_weighted_chunks) that are put in a queue shared by the processes,
+    so each process takes a new chunk as soon as it is done with the previous one.
+    The variants are written to one variant file per process and the utilisation of each process is written to the log.
+
+    Parameters
+    ----------
+        seq_list: list of the packed keys of the reads to process (see CRISPRessoCOREResources.pack_sequence)
+        get_new_variant_object: function to generate the new variant object
+        args: CRISPResso2 args
+        refs: dict with info for all refs
+        ref_names: list of ref names
+        aln_matrix: alignment matrix for needleman wunsch
+        pe_scaffold_dna_info: tuple of(
+        index of location in ref to find scaffold seq if it exists
+        shortest dna sequence to identify scaffold sequence
+        )
+        n_processes: the number of processes to use
+        variants_dir: the directory to store the variant files
         quals_list: list of quality scores for the reads
+        alignment_cache: the persistent alignment cache from get_alignment_cache, or None
+
+    Returns
+    -------
+    variant_file_list: list of the variant files, read them with read_variant_files to get the variants in the order of seq_list
+
+    """
+    task_queue = mp.Queue()
+    stats_queue = mp.Queue()
+    processes = []  # list to hold the processes so we can wait for them to complete with join()
+    info("Spinning up %d parallel processes to analyze unique reads..." % (n_processes))
+    for i in range(n_processes):
+        process = Process(
+            target=variant_file_generator_process,
+            args=(
+                  task_queue,
+                  stats_queue,
+                  get_new_variant_object,
+                  args,
+                  refs,
+                  ref_names,
+                  aln_matrix,
+                  pe_scaffold_dna_info,
+                  i,
+                  variants_dir,
+                ),
+            kwargs={'alignment_cache': alignment_cache},
+        )
+        process.start()
+        processes.append(process)
+
+    chunks = get_weighted_chunks(seq_list, len(ref_names), n_processes)
+    for chunk_index, (start, end) in enumerate(chunks):
+        task_queue.put((chunk_index, seq_list[start:end], None if quals_list is None else quals_list[start:end]))
+    for _ in processes:
+        task_queue.put(None)
+
+    process_stats = []
+    while len(process_stats) < n_processes:
+        try:
+            process_stats.append(stats_queue.get(timeout=1))
+        except queue.Empty:
+            if any(process.exitcode not in (None, 0) for process in processes):
+                break
+    for p in processes:
+        p.join()  # pauses the main thread until the processes are finished
+    for i, process in enumerate(processes):
+        if process.exitcode != 0:
+            raise CRISPRessoShared.AlignmentException(f"Process {i + 1} analyzing unique reads exited with code {process.exitcode}, try reducing the number of processes (-p) and rerunning CRISPResso")
+
+    log_process_utilisation(process_stats, len(chunks))
+    return [get_variant_file_path(variants_dir, i) for i in range(n_processes)]
+
+
+def log_process_utilisation(process_stats, n_chunks):
+    """Writes the utilisation of the processes started by get_new_variant_objects_in_processes to the log
+
+    Parameters
+    ----------
+        process_stats: list of the stats dicts put in the stats queue by variant_file_generator_process
+        n_chunks: the number of chunks the reads were split into
 
     Returns
     -------
     Nothing
 
     """
-    variant_file_path = os.path.join(variants_dir, f"variants_{process_id}.tsv")
-    variant_lines = ""
-    with open(variant_file_path, 'w') as file:
-        file.truncate()  # Ensures tsv file is empty before writing to it
-        for index, fastq_seq in enumerate(seq_list):
-            if args.crispresso_merge:  # If using CRISPResso to merge the passed in function is get_new_variant_object_from_paired
-                fastq1_seq, fastq2_seq = fastq_seq.split('+')
-                fastq1_qual, fastq2_qual = quals_list[index].split(' ')
-                new_variant = get_new_variant_object(args, fastq1_seq, fastq2_seq, fastq1_qual, fastq2_qual, refs, ref_names, aln_matrix, pe_scaffold_dna_info)
-            else:
-                new_variant = get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaffold_dna_info)
-            # Convert the complex object to a JSON string
-            json_string = json.dumps(new_variant, cls=CRISPRessoShared.CRISPRessoJSONEncoder)
-            variant_lines += f"{fastq_seq}\t{json_string}\n"
-            if index % 10000 == 0 and index != 0:
-                info(f"Process {process_id + 1} has processed {index} unique reads", {'percent_complete': 10})
-                file.write(variant_lines)
-                variant_lines = ""
-        file.write(variant_lines)
+    if not process_stats:
+        return
+    wall_time = max(stats['total_time'] for stats in process_stats)
+    for stats in sorted(process_stats, key=lambda stats: stats['process_id']):
+        utilisation = 100 * stats['busy_time'] / wall_time if wall_time > 0 else 100
+        info("Process %d aligned %d unique reads in %d of %d chunks (work %d), busy for %.2fs of %.2fs (%.1f%% utilisation)" % (
+            stats['process_id'] + 1, stats['reads'], stats['chunks'], n_chunks, stats['weight'], stats['busy_time'], wall_time, utilisation))
+    mean_busy_time = sum(stats['busy_time'] for stats in process_stats) / len(process_stats)
+    if mean_busy_time > 0:
+        info("Mean process utilisation %.1f%%, load imbalance (max / mean busy time) %.2f" % (
+            100 * mean_busy_time / wall_time, max(stats['busy_time'] for stats in process_stats) / mean_busy_time))
+
+
+def get_new_variant_objects_threaded(seq_list, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, n_threads, alignment_cache=None):
+    """Generates the new variants for a list of unique reads using a pool of threads
+    The reads are split into chunks and each chunk is analyzed by a thread with its own aligner. Alignments are computed without
+    holding the GIL, so they run in parallel without forking processes or writing the variants to files.
+
+    Parameters
+    ----------
+        seq_list: list of the packed keys of the reads to process (see CRISPRessoCOREResources.pack_sequence)
+        args: CRISPResso2 args
+        refs: dict with info for all refs
+        ref_names: list of ref names
+        aln_matrix: alignment matrix for needleman wunsch
+        pe_scaffold_dna_info: tuple of(
+        index of location in ref to find scaffold seq if it exists
+        shortest dna sequence to identify scaffold sequence
+        )
+        n_threads: the number of threads to use
+        alignment_cache: the persistent alignment cache from get_alignment_cache, or None
+
+    Returns
+    -------
+    generator of the new variant for each read in seq_list, in the same order as seq_list
+
+    """
+    kmer_index = get_kmer_index(args, refs, ref_names)
+    seed_matcher = get_seed_matcher(args, refs, ref_names)
+    include_masks = get_include_masks(refs, ref_names)
+
+    def get_chunk_variants(chunk):
+        aligner = get_aligner(args, aln_matrix)
+        return [get_new_variant_object(args, CRISPRessoCOREResources.unpack_sequence(seq_key), refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, kmer_index=kmer_index, seed_matcher=seed_matcher, alignment_cache=alignment_cache, include_masks=include_masks) for seq_key in chunk]
+
+    # use several chunks per thread so that threads that get faster chunks don't sit idle
+    chunk_size = max(1, -(-len(seq_list) // (n_threads * 4)))
+    chunks = [seq_list[i:i + chunk_size] for i in range(0, len(seq_list), chunk_size)]
+    with ThreadPoolExecutor(n_threads) as executor:
+        for chunk_variants in executor.map(get_chunk_variants, chunks):
+            yield from chunk_variants
+
+
+def align_fastq_streaming(variantCache, fastq_filename, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_threads):
+    """Counts the unique reads of a fastq file into variantCache while a pool of threads aligns them
+
+    The file is read in blocks of STREAMING_BLOCK_READS reads. The new unique reads of each block are put in a bounded queue of chunks
+    that are aligned by the threads while the next blocks are read, so reading and alignment overlap.
+    When the queue is full, reading waits for the oldest chunk to be aligned.
+
+    Parameters
+    ----------
+        variantCache: the dict to count the reads into, as in count_fastq_reads
+        fastq_filename: the fastq file, gzipped or plain text
+        args: CRISPResso2 args
+        refs: dict with info for all refs
+        ref_names: list of ref names
+        aln_matrix: alignment matrix for needleman wunsch
+        pe_scaffold_dna_info: tuple of(
+        index of location in ref to find scaffold seq if it exists
+        shortest dna sequence to identify scaffold sequence
+        )
+        alignment_cache: the persistent alignment cache from get_alignment_cache, or None
+        n_threads: the number of threads to align with
+
+    Returns
+    -------
+    num_reads: the number of reads read
+    new_variants: list of the new variant objects of the unique reads, in the order of variantCache
+
+    """
+    kmer_index = get_kmer_index(args, refs, ref_names)
+    seed_matcher = get_seed_matcher(args, refs, ref_names)
+    include_masks = get_include_masks(refs, ref_names)
+
+    def get_chunk_variants(chunk):
+        aligner = get_aligner(args, aln_matrix)
+        return [get_new_variant_object(args, CRISPRessoCOREResources.unpack_sequence(seq_key), refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, kmer_index=kmer_index, seed_matcher=seed_matcher, alignment_cache=alignment_cache, include_masks=include_masks) for seq_key in chunk]
+
+    max_pending_chunks = 2 * max(1, n_threads)
+    num_reads = 0
+    new_variants = []
+    pending_chunks = deque()
+    with ThreadPoolExecutor(max(1, n_threads)) as executor, CRISPRessoCOREResources.FastqReader(fastq_filename) as fastq_reader:
+        while True:
+            num_unique_reads = len(variantCache)
+            block_reads = fastq_reader.count_sequences(variantCache, max_reads=STREAMING_BLOCK_READS, pack=True)
+            num_reads += block_reads
+            if len(variantCache) > num_unique_reads:
+                # new keys are added at the end of variantCache
+                chunk = list(islice(reversed(variantCache), len(variantCache) - num_unique_reads))[::-1]
+                pending_chunks.append(executor.submit(get_chunk_variants, chunk))
+            while pending_chunks and (pending_chunks[0].done() or len(pending_chunks) > max_pending_chunks):
+                new_variants.extend(pending_chunks.popleft().result())
+            if block_reads < STREAMING_BLOCK_READS:
+                break
+            if num_reads % 100000 == 0:
+                info("Read %d reads; %d unique reads found, %d analyzed" % (num_reads, len(variantCache), len(new_variants)))
+        while pending_chunks:
+            new_variants.extend(pending_chunks.popleft().result())
+    return num_reads, new_variants
+
+
+def get_frequency_interval(n_modified, n_total, z=CONVERGENCE_Z):
+    """Computes the Wilson score confidence interval of a modified frequency
+
+    Parameters
+    ----------
+        n_modified: number of modified reads
+        n_total: number of reads
+        z: z score of the confidence level
+
+    Returns
+    -------
+    (low, high) bounds of the interval, (0, 1) if there are no reads
+
+    """
+    if n_total <= 0:
+        return (0.0, 1.0)
+    frequency = n_modified / n_total
+    denominator = 1 + z * z / n_total
+    center = (frequency + z * z / (2 * n_total)) / denominator
+    half_width = z * math.sqrt(frequency * (1 - frequency) / n_total + z * z / (4 * n_total * n_total)) / denominator
+    return (max(0.0, center - half_width), min(1.0, center + half_width))
+
+
+def add_modified_counts(variant, variant_count, counts_total, counts_modified, args):
+    """Adds the reads of an aligned variant to the per-reference read counts, as they are counted in main
+
+    Parameters
+    ----------
+        variant: the variant object of an aligned read
+        variant_count: the number of reads of the variant
+        counts_total: dict of reference name to number of reads
+        counts_modified: dict of reference name to number of modified reads
+        args: CRISPResso2 args
 
-    info(f"Process {process_id + 1} has finished processing {index} unique reads", {'percent_complete': 10})
+    """
+    if variant['class_name'] == 'AMBIGUOUS':
+        return
+    for ref_name in variant['aln_ref_names']:
+        variant_payload = variant['variant_' + ref_name]
+        if args.discard_indel_reads and (variant_payload['deletion_n'] > 0 or variant_payload['insertion_n'] > 0):
+            continue
+        counts_total[ref_name] += variant_count
+        if variant_payload['classification'] == 'MODIFIED':
+            counts_modified[ref_name] += variant_count
+
+
+def align_fastq_to_convergence(variantCache, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_threads):
+    """Aligns reads of variantCache drawn in random order until the modified frequency of every reference is estimated to within args.convergence_precision
+
+    Reads are drawn without replacement in blocks of CONVERGENCE_BLOCK_READS reads. After each block, the 95% confidence interval
+    of counts_modified / counts_total is computed for each reference that reads aligned to, and drawing stops once all intervals
+    are within +/- args.convergence_precision or args.convergence_max_reads reads have been drawn.
+
+    Parameters
+    ----------
+        variantCache: dict of unique read to number of reads, as counted by count_fastq_reads
+            When this returns, it only contains the drawn reads with the number of times they were drawn
+        args: CRISPResso2 args
+        refs: dict with info for all refs
+        ref_names: list of ref names
+        aln_matrix: alignment matrix for needleman wunsch
+        pe_scaffold_dna_info: tuple of(
+        index of location in ref to find scaffold seq if it exists
+        shortest dna sequence to identify scaffold sequence
+        )
+        alignment_cache: the persistent alignment cache from get_alignment_cache, or None
+        n_threads: the number of threads to align with
+
+    Returns
+    -------
+    new_variants: list of the variant objects of the reads left in variantCache, in the order of variantCache
+    convergence: dict with the number of reads drawn ('n_reads_analyzed') out of the number of reads ('n_reads'),
+        the precision that was requested and whether it was reached ('converged')
+
+    """
+    seq_list = list(variantCache.keys())
+    read_ends = np.cumsum(np.fromiter(variantCache.values(), dtype=np.int64, count=len(seq_list)))
+    n_reads = int(read_ends[-1]) if len(seq_list) > 0 else 0
+    max_reads = n_reads if args.convergence_max_reads <= 0 else min(n_reads, args.convergence_max_reads)
+    # the unique read of each drawn read, in the order they are drawn
+    drawn_seqs = np.searchsorted(read_ends, np.random.default_rng(CONVERGENCE_RANDOM_SEED).choice(n_reads, size=max_reads, replace=False), side='right')
+
+    drawn_counts = np.zeros(len(seq_list), dtype=np.int64)
+    variants = {}
+    counts_total = {ref_name: 0 for ref_name in ref_names}
+    counts_modified = {ref_name: 0 for ref_name in ref_names}
+    n_reads_analyzed = 0
+    converged = False
+    while n_reads_analyzed < max_reads and not converged:
+        block_seqs, block_counts = np.unique(drawn_seqs[n_reads_analyzed:n_reads_analyzed + CONVERGENCE_BLOCK_READS], return_counts=True)
+        n_reads_analyzed = min(max_reads, n_reads_analyzed + CONVERGENCE_BLOCK_READS)
+        new_seqs = [seq_index for seq_index in block_seqs if seq_index not in variants]
+        new_variants = get_new_variant_objects_threaded([seq_list[seq_index] for seq_index in new_seqs], args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, max(1, n_threads), alignment_cache)
+        variants.update(zip(new_seqs, new_variants))
+        drawn_counts[block_seqs] += block_counts
+        for seq_index, variant_count in zip(block_seqs, block_counts):
+            if variants[seq_index]['best_match_score'] > 0:
+                add_modified_counts(variants[seq_index], int(variant_count), counts_total, counts_modified, args)
+
+        half_widths = [(high - low) / 2 for low, high in (get_frequency_interval(counts_modified[ref_name], counts_total[ref_name]) for ref_name in ref_names if counts_total[ref_name] > 0)]
+        converged = len(half_widths) > 0 and max(half_widths) <= args.convergence_precision
+        info("Analyzed %d randomly drawn reads of %d; widest 95%% confidence interval of the modified frequencies: +/-%s" % (n_reads_analyzed, n_reads, "%.4f" % max(half_widths) if half_widths else 'NA'))
+
+    variantCache.clear()
+    new_variants = []
+    for seq_index in np.flatnonzero(drawn_counts):
+        variantCache[seq_list[seq_index]] = int(drawn_counts[seq_index])
+        new_variants.append(variants[seq_index])
+    convergence = {
+        'n_reads_analyzed': n_reads_analyzed,
+        'n_reads': n_reads,
+        'precision': args.convergence_precision,
+        'converged': converged,
+    }
+    return new_variants, convergence
 
 
 def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_names, refs, args, files_to_remove, output_directory, fastq_write_out_file=None):
@@ -1277,10 +2221,14 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
     aln_matrix_loc = os.path.join(_ROOT, args.needleman_wunsch_aln_matrix_loc)
     CRISPRessoShared.check_file(aln_matrix_loc)
     aln_matrix = CRISPResso2Align.read_matrix(aln_matrix_loc)
+    aligner = get_aligner(args, aln_matrix)
+    seed_matcher = get_seed_matcher(args, refs, ref_names)
+    include_masks = get_include_masks(refs, ref_names)
 
     pe_scaffold_dna_info = (0, None)  # scaffold start loc, scaffold seq to search
     if args.prime_editing_pegRNA_scaffold_seq != "":
         pe_scaffold_dna_info = CRISPRessoPlotData.get_pe_scaffold_search(refs['Prime-edited']['sequence'], args.prime_editing_pegRNA_extension_seq, args.prime_editing_pegRNA_scaffold_seq, args.prime_editing_pegRNA_scaffold_min_match_length)
+    alignment_cache = get_alignment_cache(args, refs, ref_names, aln_matrix, pe_scaffold_dna_info)
 
     n_processes = 1
     if args.n_processes == "max":
@@ -1293,144 +2241,61 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
         info("The number of processes is set to 1 because fastq write out is enabled.")
 
     if n_processes > 1:
-        if fastq1_filename.endswith('.gz'):
-            fastq1_file = gzip.open(fastq1_filename, 'rt')
-        else:
-            fastq1_file = open(fastq1_filename)
-
-        if fastq2_filename.endswith('.gz'):
-            fastq2_file = gzip.open(fastq2_filename, 'rt')
-        else:
-            fastq2_file = open(fastq2_filename)
-        # Reading through the fastq file and enriching variantCache as a dictionary with the following:
-            # Key: the unique DNA sequence from the fastq file
-            # Value: an integer that represents how many times we've seen this specific read
-
-        num_reads = 0
-        fastq1_id = fastq1_file.readline()
-        fastq2_id = fastq2_file.readline()
-        while (fastq1_id and fastq2_id):
-            if num_reads % 50000 == 0 and num_reads != 0:
-                info("Iterating over fastq file to identify reads; %d reads identified." % (num_reads))
-            # read through fastq in sets of 4
-            fastq1_seq = fastq1_file.readline().strip()
-            fastq1_plus = fastq1_file.readline()
-            fastq1_qual = fastq1_file.readline().strip()
-
-            fastq2_seq = CRISPRessoShared.reverse_complement(fastq2_file.readline().strip())
-            fastq2_plus = fastq2_file.readline()
-            fastq2_qual = fastq2_file.readline().strip()[::-1]
-            fastq_read_key = fastq1_seq + '+' + fastq2_seq
-            fastq_quals = fastq1_qual + ' ' + fastq2_qual
-            if fastq_read_key in variantCache:
-                # if the read has already been seen, we increment its value by 1 to track number of copies
-                variantCache[fastq_read_key][0] += 1
-            # If the sequence is not in the cache, we create it and set its value to 1
-            elif fastq_read_key not in variantCache:
-                variantCache[fastq_read_key] = [1, fastq_quals]
-            fastq1_id = fastq1_file.readline()
-            fastq2_id = fastq2_file.readline()
-            num_reads += 1
-
-        if fastq1_id is not None or fastq2_id is not None:
+        # Reading through the fastq files and enriching variantCache as a dictionary with the following:
+            # Key: the unique R1 sequence + '+' + reverse complemented R2 sequence, packed by CRISPRessoCOREResources.pack_sequence
+            # Value: a list of how many times we've seen this specific read pair and the qualities of the first pair
+        info("Iterating over fastq files to identify reads...")
+        num_reads, same_length = count_fastq_reads(variantCache, fastq1_filename, fastq2_filename, n_processes)
+        if not same_length:
             error("The two fastq files are not the same length. Please check your input files.")
 
-        fastq1_file.close()
-        fastq2_file.close()
-
         num_unique_reads = len(variantCache.keys())
         info("Finished reading fastq files; %d unique reads found of %d total reads found " % (num_unique_reads, num_reads))
 
-        boundaries = get_variant_cache_equal_boundaries(num_unique_reads, n_processes)
-        processes = []  # list to hold the processes so we can wait for them to complete with join()
-
-        info("Spinning up %d parallel processes to analyze unique reads..." % (n_processes))
-        # We create n_processes, sending each a weighted sublist of the sequences for variant generation
         variants_dir = output_directory
-        for i in range(n_processes):
-            left_sublist_index = boundaries[i]
-            right_sublist_index = boundaries[i + 1]
-            seq_list = list(variantCache.keys())[left_sublist_index:right_sublist_index]
-            qual_list = []
-            for seq in seq_list:
-                qual_list.append(variantCache[seq][1])
-            process = Process(
-                target=variant_file_generator_process,
-                args=(
-                      seq_list,
-                      get_new_variant_object_from_paired,
-                      args,
-                      refs,
-                      ref_names,
-                      aln_matrix,
-                      pe_scaffold_dna_info,
-                      i,
-                      variants_dir,
-                      qual_list,
-                    )
-            )
-            process.start()
-            processes.append(process)
-        for p in processes:
-            p.join()  # pauses the main thread until the processes are finished
+        seq_list = list(variantCache.keys())
+        qual_list = [variantCache[seq][1] for seq in seq_list]
+        variant_file_list = get_new_variant_objects_in_processes(seq_list, get_new_variant_object_from_paired, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, n_processes, variants_dir, qual_list, alignment_cache)
+        del seq_list, qual_list
         info("Merging and aligning non processable reads.", {'percent_complete': 12})
 
         re_aln = {}  # cache for reads that have discrepancies and need to be processed individually
         not_aln = {}  # cache for reads that don't align
         if os.path.exists(variants_dir):
-            variant_file_list = []
-            for n_processes in range(n_processes):
-                variant_file_list.append(os.path.join(variants_dir, f"variants_{n_processes}.tsv"))
-            # List all files in the directory
-            for file_path in variant_file_list:
-                # Ensure the file is a .tsv before processing
-                if file_path.endswith(".tsv"):
-                    try:
-                        with open(file_path, 'r') as file:
-                            for index, line in enumerate(file):
-                                # Each line contains a sequence followed by a JSON string
-                                parts = line.strip().split('\t')
-                                variant_dict = {}
-                                if len(parts) == 2:
-                                    seq = parts[0]
-                                    json_data = parts[1]
-                                    variant_dict = json.loads(json_data, cls=CRISPRessoShared.CRISPRessoJSONDecoder)
-                                    if variantCache[seq][0] > 1 and not variant_dict["caching_is_ok"]:
-                                        re_aln[seq] = variant_dict
-                                        del variantCache[seq]
-                                        continue
-                                else:
-                                    if args.debug:
-                                        error(f"Could not parse variant from line: {line}")
-                                    raise CRISPRessoShared.OutputFolderIncompleteException("Could not parse variant from file")
-                                variant_count = variantCache[seq][0]
-                                N_TOT_READS += variant_count
-                                variant = variant_dict
-                                variant['count'] = variant_count
-                                if variant['best_match_score'] <= 0:
-                                    N_COMPUTED_NOTALN += 1
-                                    N_CACHED_NOTALN += (variant_count - 1)
-                                    not_aln[seq] = variant
-                                elif variant['best_match_score'] > 0:
-                                    variantCache[seq] = variant
-                                    N_COMPUTED_ALN += 1
-                                    N_CACHED_ALN += (variant_count - 1)
-                                    if len(variant['aln_ref_names']) == 1 or args.expand_ambiguous_alignments:
-                                        for name in variant['aln_ref_names']:
-                                            match_name = "variant_" + name
-                                            if READ_LENGTH == 0:
-                                                READ_LENGTH = len(variant[match_name]['aln_seq'])
-                                            N_GLOBAL_SUBS += (variant[match_name]['substitution_n'] + variant[match_name]['substitutions_outside_window']) * variant_count
-                                            N_SUBS_OUTSIDE_WINDOW += variant[match_name]['substitutions_outside_window'] * variant_count
-                                            N_MODS_IN_WINDOW += variant[match_name]['mods_in_window'] * variant_count
-                                            N_MODS_OUTSIDE_WINDOW += variant[match_name]['mods_outside_window'] * variant_count
-                                            if variant[match_name]['irregular_ends']:
-                                                N_READS_IRREGULAR_ENDS += variant_count
-                                if (index % 50000 == 0 and index > 0):
-                                    info("Calculating statistics; %d completed out of %d unique reads" % (index, num_unique_reads))
-                    except FileNotFoundError:
-                        raise CRISPRessoShared.OutputFolderIncompleteException("Could not find generated variants file, try deleting output folder, checking input files, and rerunning CRISPResso")
-                files_to_remove.append(file_path)
+            try:
+                for index, (seq, variant_dict) in enumerate(read_variant_files(variant_file_list)):
+                    if variantCache[seq][0] > 1 and not variant_dict["caching_is_ok"]:
+                        re_aln[seq] = variant_dict
+                        del variantCache[seq]
+                        continue
+                    variant_count = variantCache[seq][0]
+                    N_TOT_READS += variant_count
+                    variant = variant_dict
+                    variant['count'] = variant_count
+                    if variant['best_match_score'] <= 0:
+                        N_COMPUTED_NOTALN += 1
+                        N_CACHED_NOTALN += (variant_count - 1)
+                        not_aln[seq] = variant
+                    elif variant['best_match_score'] > 0:
+                        variantCache[seq] = variant
+                        N_COMPUTED_ALN += 1
+                        N_CACHED_ALN += (variant_count - 1)
+                        if len(variant['aln_ref_names']) == 1 or args.expand_ambiguous_alignments:
+                            for name in variant['aln_ref_names']:
+                                match_name = "variant_" + name
+                                if READ_LENGTH == 0:
+                                    READ_LENGTH = len(variant[match_name]['aln_seq'])
+                                N_GLOBAL_SUBS += (variant[match_name]['substitution_n'] + variant[match_name]['substitutions_outside_window']) * variant_count
+                                N_SUBS_OUTSIDE_WINDOW += variant[match_name]['substitutions_outside_window'] * variant_count
+                                N_MODS_IN_WINDOW += variant[match_name]['mods_in_window'] * variant_count
+                                N_MODS_OUTSIDE_WINDOW += variant[match_name]['mods_outside_window'] * variant_count
+                                if variant[match_name]['irregular_ends']:
+                                    N_READS_IRREGULAR_ENDS += variant_count
+                    if (index % 50000 == 0 and index > 0):
+                        info("Calculating statistics; %d completed out of %d unique reads" % (index, num_unique_reads))
+            except FileNotFoundError:
+                raise CRISPRessoShared.OutputFolderIncompleteException("Could not find generated variants file, try deleting output folder, checking input files, and rerunning CRISPResso")
+            files_to_remove.extend(variant_file_list)
             info("Finished merging and aligning paired reads, now generating statistics...", {'percent_complete': 15})
         else:
             raise CRISPRessoShared.OutputFolderIncompleteException("Could not find output folder, try deleting output folder and rerunning CRISPResso")
@@ -1439,9 +2304,9 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
             del variantCache[seq]
 
         for key in list(variantCache.keys()):
-            if '+' in key:
+            if '+' in CRISPRessoCOREResources.unpack_sequence(key):
                 variant = variantCache[key]
-                new_key = variant["variant_" + variant['aln_ref_names'][0]]['aln_seq']
+                new_key = CRISPRessoCOREResources.pack_sequence(variant["variant_" + variant['aln_ref_names'][0]]['aln_seq'])
                 if new_key in variantCache.keys():
                     variantCache[new_key]['count'] += variant['count']
                     variantCache.pop(key)
@@ -1450,37 +2315,20 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
                     variantCache.pop(key)
 
         if len(re_aln.keys()) > 0:
-            if fastq1_filename.endswith('.gz'):
-                fastq1_file = gzip.open(fastq1_filename, 'rt')
-            else:
-                fastq1_file = open(fastq1_filename)
-
-            if fastq2_filename.endswith('.gz'):
-                fastq2_file = gzip.open(fastq2_filename, 'rt')
-            else:
-                fastq2_file = open(fastq2_filename)
-
-            fastq1_id = fastq1_file.readline()
-            fastq2_id = fastq2_file.readline()
-            while (fastq1_id and fastq2_id):
-                # read through fastq in sets of 4
-                fastq1_seq = fastq1_file.readline().strip()
-                fastq1_plus = fastq1_file.readline()
-                fastq1_qual = fastq1_file.readline().strip()
-
-                fastq2_seq = CRISPRessoShared.reverse_complement(fastq2_file.readline().strip())
-                fastq2_plus = fastq2_file.readline()
-                fastq2_qual = fastq2_file.readline().strip()[::-1]
-                fastq_read_key = fastq1_seq + '+' + fastq2_seq
+            fastq1_reader = CRISPRessoCOREResources.FastqReader(fastq1_filename)
+            fastq2_reader = CRISPRessoCOREResources.FastqReader(fastq2_filename, reverse_complement=True)
+            for (fastq1_id, fastq1_seq, fastq1_plus, fastq1_qual), (fastq2_id, fastq2_seq, fastq2_plus, fastq2_qual) in zip(fastq1_reader, fastq2_reader):
+                fastq_read_key = CRISPRessoCOREResources.pack_sequence(fastq1_seq + '+' + fastq2_seq)
                 if fastq_read_key in re_aln:
-                    variant = get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual, fastq2_qual, refs, ref_names, aln_matrix, pe_scaffold_dna_info)
+                    variant = get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual, fastq2_qual, refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, seed_matcher=seed_matcher, alignment_cache=alignment_cache, include_masks=include_masks)
                     if variant['best_match_score'] <= 0:
                         N_TOT_READS += 1
                         N_COMPUTED_NOTALN += 1
                     else:
                         match_name = "variant_" + variant['aln_ref_names'][0]
-                        if variant[match_name]['aln_seq'] in variantCache:
-                            variantCache[variant[match_name]['aln_seq']]['count'] += 1
+                        alignment_key = CRISPRessoCOREResources.pack_sequence(variant[match_name]['aln_seq'])
+                        if alignment_key in variantCache:
+                            variantCache[alignment_key]['count'] += 1
                             N_TOT_READS += 1
                             N_COMPUTED_ALN += 1
                             if len(variant['aln_ref_names']) == 1 or args.expand_ambiguous_alignments:
@@ -1497,7 +2345,7 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
                         else:
                             N_TOT_READS += 1
                             N_COMPUTED_ALN += 1
-                            variantCache[variant[match_name]['aln_seq']] = variant
+                            variantCache[alignment_key] = variant
                             if len(variant['aln_ref_names']) == 1 or args.expand_ambiguous_alignments:
                                 for name in variant['aln_ref_names']:
                                     match_name = "variant_" + name
@@ -1510,45 +2358,27 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
                                     if variant[match_name]['irregular_ends']:
                                         N_READS_IRREGULAR_ENDS += 1
 
-                fastq1_id = fastq1_file.readline()
-                fastq2_id = fastq2_file.readline()
-
-        if fastq1_id is not None or fastq2_id is not None:
-            error("The two fastq files are not the same length. Please check your input files.")
-
-        fastq1_file.close()
-        fastq2_file.close()
+            fastq1_reader.close()
+            fastq2_reader.close()
 
     else:
-        if fastq1_filename.endswith('.gz'):
-            fastq1_handle = gzip.open(fastq1_filename, 'rt')
-        else:
-            fastq1_handle = open(fastq1_filename)
-
-        if fastq2_filename.endswith('.gz'):
-            fastq2_handle = gzip.open(fastq2_filename, 'rt')
-        else:
-            fastq2_handle = open(fastq2_filename)
+        fastq1_reader = CRISPRessoCOREResources.FastqReader(fastq1_filename)
+        fastq2_reader = CRISPRessoCOREResources.FastqReader(fastq2_filename, reverse_complement=True)
 
         if args.fastq_output:
             fastq_write_out_handle = open(fastq_write_out_file, 'w')
 
         not_aln = {}  # cache for reads that don't align
-        while (True):
+        for fastq1_record, fastq2_record in zip_longest(fastq1_reader, fastq2_reader, fillvalue=('', '', '', '')):
             # read through fastq in sets of 4
-            fastq1_id = fastq1_handle.readline().strip()
-            fastq2_id = fastq2_handle.readline().strip()
+            fastq1_id, fastq1_seq, fastq1_plus, fastq1_qual = fastq1_record
+            fastq2_id, fastq2_seq, fastq2_plus, fastq2_qual = fastq2_record
+            fastq1_id = fastq1_id.strip()
+            fastq2_id = fastq2_id.strip()
             if not fastq1_id and not fastq2_id:
                 break
             elif not fastq1_id or not fastq2_id:
                 error("The two fastq files are not the same length. Please check your input files.")
-            fastq1_seq = fastq1_handle.readline().strip()
-            fastq1_plus = fastq1_handle.readline()
-            fastq1_qual = fastq1_handle.readline().strip()
-
-            fastq2_seq = CRISPRessoShared.reverse_complement(fastq2_handle.readline().strip())
-            fastq2_plus = fastq2_handle.readline()
-            fastq2_qual = fastq2_handle.readline().strip()[::-1]
 
             if (N_TOT_READS % 10000 == 0):
                 info("Processing reads; N_TOT_READS: %d N_COMPUTED_ALN: %d N_CACHED_ALN: %d N_COMPUTED_NOTALN: %d N_CACHED_NOTALN: %d" % (N_TOT_READS, N_COMPUTED_ALN, N_CACHED_ALN, N_COMPUTED_NOTALN, N_CACHED_NOTALN))
@@ -1556,7 +2386,7 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
             N_TOT_READS += 1
             # if the sequence has been seen and can't be aligned, skip it
             # cache the sequence of both r1 and r2 sequences as lookup_fastq_seq
-            lookup_fastq_seq = fastq1_seq + "+" + fastq2_seq
+            lookup_fastq_seq = CRISPRessoCOREResources.pack_sequence(fastq1_seq + "+" + fastq2_seq)
             if lookup_fastq_seq in not_aln:
                 N_CACHED_NOTALN += 1
                 if args.fastq_output:
@@ -1606,7 +2436,7 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
 
             # otherwise, create a new variant object, and put it in the cache
             else:
-                new_variant = get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual, fastq2_qual, refs, ref_names, aln_matrix, pe_scaffold_dna_info)
+                new_variant = get_new_variant_object_from_paired(args, fastq1_seq, fastq2_seq, fastq1_qual, fastq2_qual, refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, seed_matcher=seed_matcher, alignment_cache=alignment_cache, include_masks=include_masks)
                 # Edge case where merged alignments are different because of differences in base quality that prefer t
                 #    R1                  R1
                 # ------A--         --G----------           ----A----
@@ -1668,7 +2498,7 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
                                 N_MODS_OUTSIDE_WINDOW += new_variant[match_name]['mods_outside_window']
                                 if new_variant[match_name]['irregular_ends']:
                                     N_READS_IRREGULAR_ENDS += 1
-                        alignment_key = new_variant['variant_' + new_variant['aln_ref_names'][0]]['aln_seq']
+                        alignment_key = CRISPRessoCOREResources.pack_sequence(new_variant['variant_' + new_variant['aln_ref_names'][0]]['aln_seq'])
                         if alignment_key in variantCache:
                             variantCache[alignment_key]['count'] += 1
                         else:
@@ -1683,21 +2513,21 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
                     if new_variant['caching_is_ok']:
                         not_aln[lookup_fastq_seq] = new_variant
                     else:
-                        alignment_key = new_variant['ref_aln_details'][0][2]
+                        alignment_key = CRISPRessoCOREResources.pack_sequence(new_variant['ref_aln_details'][0][2])
                         if alignment_key in not_aln:
                             not_aln[alignment_key]['count'] += 1
                         else:
                             not_aln[alignment_key] = new_variant
 
-        fastq1_handle.close()
-        fastq2_handle.close()
+        fastq1_reader.close()
+        fastq2_reader.close()
         if args.fastq_output:
             fastq_write_out_handle.close()
 
         for key in list(variantCache.keys()):
-            if '+' in key:
+            if '+' in CRISPRessoCOREResources.unpack_sequence(key):
                 variant = variantCache[key]
-                alignment_key = variant["variant_" + variant['aln_ref_names'][0]]['aln_seq']
+                alignment_key = CRISPRessoCOREResources.pack_sequence(variant["variant_" + variant['aln_ref_names'][0]]['aln_seq'])
                 if len(variant['aln_ref_names']) == 1 or args.expand_ambiguous_alignments:
                     for name in variant['aln_ref_names']:
                         match_name = "variant_" + name
@@ -1729,6 +2559,7 @@ def process_paired_fastq(fastq1_filename, fastq2_filename, variantCache, ref_nam
         "N_READS_IRREGULAR_ENDS": N_READS_IRREGULAR_ENDS,
         "READ_LENGTH": READ_LENGTH,
         }
+    add_alignment_cache_stats(alignment_cache, aln_stats)
     return aln_stats, not_aln
 
 
@@ -1740,7 +2571,7 @@ def process_fastq(fastq_filename, variantCache, ref_names, refs, args, files_to_
         fastq_filename: name of fastq (e.g. output of fastp)
             This file can be gzipped or plain text
 
-        variantCache: dict with keys: sequence
+        variantCache: dict with keys: sequence (or a CRISPRessoVariantStore.VariantStore, if the reads don't fit in --max_memory)
             dict with keys:
                 'count' : number of time sequence was observed
                 'aln_ref_names' : names of reference it was aligned to
@@ -1814,45 +2645,82 @@ def process_fastq(fastq_filename, variantCache, ref_names, refs, args, files_to_
     pe_scaffold_dna_info = (0, None)  # scaffold start loc, scaffold seq to search
     if args.prime_editing_pegRNA_scaffold_seq != "" and args.prime_editing_pegRNA_extension_seq != "":
         pe_scaffold_dna_info = CRISPRessoPlotData.get_pe_scaffold_search(refs['Prime-edited']['sequence'], args.prime_editing_pegRNA_extension_seq, args.prime_editing_pegRNA_scaffold_seq, args.prime_editing_pegRNA_scaffold_min_match_length)
+    alignment_cache = get_alignment_cache(args, refs, ref_names, aln_matrix, pe_scaffold_dna_info)
 
-    not_aligned_variants = {}
+    n_processes = 1
+    if args.n_processes == "max":
+        n_processes = CRISPRessoMultiProcessing.get_max_processes()
+    elif args.n_processes.isdigit():
+        n_processes = int(args.n_processes)
 
-    if fastq_filename.endswith('.gz'):
-        fastq_input_opener = lambda x: gzip.open(x, 'rt')
+    if isinstance(variantCache, CRISPRessoVariantStore.VariantStore):
+        aln_stats, not_aligned_variants = align_fastq_partitions(fastq_filename, variantCache, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_processes, output_directory, files_to_remove)
+    elif args.convergence_precision > 0:
+        info("Iterating over fastq file to identify reads...")
+        num_reads, _ = count_fastq_reads(variantCache, fastq_filename, n_processes=1 if args.use_threads else n_processes)
+        info("Finished reading fastq file; %d unique reads found of %d total reads found " % (len(variantCache.keys()), num_reads))
+
+        info("Analyzing randomly drawn reads until the modified frequencies are estimated to within +/-%s..." % (args.convergence_precision))
+        new_variants, convergence = align_fastq_to_convergence(variantCache, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_processes)
+        aln_stats, not_aligned_variants, _ = align_unique_reads(variantCache, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_processes, output_directory, files_to_remove, new_variants)
+        aln_stats['convergence'] = convergence
+    elif args.streaming:
+        info("Iterating over fastq file to identify reads and analyzing unique reads with %d threads..." % (n_processes))
+        num_reads, new_variants = align_fastq_streaming(variantCache, fastq_filename, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_processes)
+        info("Finished reading fastq file; %d unique reads found of %d total reads found " % (len(variantCache.keys()), num_reads))
+
+        aln_stats, not_aligned_variants, _ = align_unique_reads(variantCache, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_processes, output_directory, files_to_remove, new_variants)
     else:
-        fastq_input_opener = open
-
-    with fastq_input_opener(fastq_filename) as fastq_handle:
-
         # Reading through the fastq file and enriching variantCache as a dictionary with the following:
             # Key: the unique DNA sequence from the fastq file
             # Value: an integer that represents how many times we've seen this specific read
-        num_reads = 0
-        fastq_id = fastq_handle.readline()
-        while (fastq_id):
-            if num_reads % 50000 == 0 and num_reads != 0:
-                info("Iterating over fastq file to identify reads; %d reads identified." % (num_reads))
-            # read through fastq in sets of 4
-            fastq_seq = fastq_handle.readline().strip()
-            fastq_plus = fastq_handle.readline().strip()
-            fastq_qual = fastq_handle.readline()
-            if fastq_seq in variantCache:
-                # if the read has already been seen, we increment its value by 1 to track number of copies
-                variantCache[fastq_seq] += 1
-            # If the sequence is not in the cache, we create it and set its value to 1
-            elif fastq_seq not in variantCache:
-                variantCache[fastq_seq] = 1
-            fastq_id = fastq_handle.readline()
-            num_reads += 1
+        info("Iterating over fastq file to identify reads...")
+        num_reads, _ = count_fastq_reads(variantCache, fastq_filename, n_processes=1 if args.use_threads else n_processes)
+        info("Finished reading fastq file; %d unique reads found of %d total reads found " % (len(variantCache.keys()), num_reads))
 
-        num_unique_reads = len(variantCache.keys())
-        info("Finished reading fastq file; %d unique reads found of %d total reads found " % (num_unique_reads, num_reads))
+        aln_stats, not_aligned_variants, _ = align_unique_reads(variantCache, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_processes, output_directory, files_to_remove)
 
-    n_processes = 1
-    if args.n_processes == "max":
-        n_processes = CRISPRessoMultiProcessing.get_max_processes()
-    elif args.n_processes.isdigit():
-        n_processes = int(args.n_processes)
+    add_alignment_cache_stats(alignment_cache, aln_stats)
+    return aln_stats, not_aligned_variants
+
+
+def align_unique_reads(variantCache, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_processes, output_directory, files_to_remove, new_variants=None):
+    """Aligns the unique reads counted in variantCache and replaces their counts with their variant objects
+
+    Parameters
+    ----------
+        variantCache: dict of unique read (packed by CRISPRessoCOREResources.pack_sequence) to number of reads
+            The entries of the reads that align are replaced by their variant objects (stored in a CRISPRessoVariantStore.VariantColumns
+            and read through its views), and the other entries are removed
+        args: CRISPResso2 args
+        refs: dict with info for all refs
+        ref_names: list of ref names
+        aln_matrix: alignment matrix for needleman wunsch
+        pe_scaffold_dna_info: tuple of(
+            index of location in ref to find scaffold seq if it exists
+            shortest dna sequence to identify scaffold sequence
+            )
+        alignment_cache: the persistent alignment cache from get_alignment_cache, or None
+        n_processes: the number of processes (or threads, with --use_threads) to align with
+        output_directory: the directory for the variant files of the alignment processes
+        files_to_remove: list of intermediate files to remove at the end of the run
+        new_variants: the variant objects of the reads of variantCache, in the order of variantCache, if they were already computed
+            (e.g. by align_fastq_streaming), or None to align the reads
+
+    Returns
+    -------
+    aln_stats: dict of the alignment statistics of the reads
+    not_aligned_variants: dict of the variant objects of the reads that didn't align
+    read_length_seq: the key of the read READ_LENGTH in aln_stats was taken from (None if no read aligned)
+
+    """
+    aligner = get_aligner(args, aln_matrix)
+    kmer_index = get_kmer_index(args, refs, ref_names)
+    seed_matcher = get_seed_matcher(args, refs, ref_names)
+    include_masks = get_include_masks(refs, ref_names)
+    not_aligned_variants = {}
+    variant_columns = CRISPRessoVariantStore.VariantColumns()
+    num_unique_reads = len(variantCache.keys())
 
     N_TOT_READS = 0
     N_CACHED_ALN = 0  # number of copies of all aligned reads
@@ -1865,99 +2733,62 @@ def process_fastq(fastq_filename, variantCache, ref_names, refs, args, files_to_
     N_MODS_OUTSIDE_WINDOW = 0  # number of modifications found outside the quantification window
     N_READS_IRREGULAR_ENDS = 0  # number of reads with modifications at the 0 or -1 position
     READ_LENGTH = 0
+    read_length_seq = None  # the read READ_LENGTH was taken from
     unaligned_reads = []
 
-    if n_processes > 1 and num_unique_reads > n_processes:
-        boundaries = get_variant_cache_equal_boundaries(num_unique_reads, n_processes)
-
-        processes = []  # list to hold the processes so we can wait for them to complete with join()
-
-        info("Spinning up %d parallel processes to analyze unique reads..." % (n_processes))
-        # We create n_processes, sending each a weighted sublist of the sequences for variant generation
+    if new_variants is None and n_processes > 1 and num_unique_reads > n_processes and not args.use_threads:
         variants_dir = output_directory
-        for i in range(n_processes):
-            left_sublist_index = boundaries[i]
-            right_sublist_index = boundaries[i + 1]
-            process = Process(
-                target=variant_file_generator_process,
-                args=(
-                      (list(variantCache.keys())[left_sublist_index:right_sublist_index]),
-                      get_new_variant_object,
-                      args,
-                      refs,
-                      ref_names,
-                      aln_matrix,
-                      pe_scaffold_dna_info,
-                      i,
-                      variants_dir
-                    )
-            )
-            process.start()
-            processes.append(process)
-        for p in processes:
-            p.join()  # pauses the main thread until the processes are finished
+        variant_file_list = get_new_variant_objects_in_processes(list(variantCache.keys()), get_new_variant_object, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, n_processes, variants_dir, alignment_cache=alignment_cache)
         info("Finished processing unique reads, now generating statistics...", {'percent_complete': 15})
         if os.path.exists(variants_dir):
-            variant_file_list = []
-            for n_processes in range(n_processes):
-                variant_file_list.append(os.path.join(variants_dir, f"variants_{n_processes}.tsv"))
-            # List all files in the directory
-            for file_path in variant_file_list:
-                # Ensure the file is a .tsv before processing
-                if file_path.endswith(".tsv"):
-                    try:
-                        with open(file_path, 'r') as file:
-                            for index, line in enumerate(file):
-                                # Each line contains a sequence followed by a JSON string
-                                parts = line.strip().split('\t')
-                                if len(parts) == 2:
-                                    seq = parts[0]
-                                    json_data = parts[1]
-                                    variant_dict = json.loads(json_data, cls=CRISPRessoShared.CRISPRessoJSONDecoder)
-                                else:
-                                    if args.debug:
-                                        error(f"Could not parse variant from line: {line}")
-                                    raise CRISPRessoShared.OutputFolderIncompleteException("Could not parse variant from file")
-                                variant_count = variantCache[seq]
-                                N_TOT_READS += variant_count
-                                variant = variant_dict
-                                variant['count'] = variant_count
-                                if variant['best_match_score'] <= 0:
-                                    N_COMPUTED_NOTALN += 1
-                                    N_CACHED_NOTALN += (variant_count - 1)
-                                    not_aligned_variants[seq] = variant
-                                    # remove the unaligned reads from the cache
-                                    unaligned_reads.append(seq)
-                                elif variant['best_match_score'] > 0:
-                                    variantCache[seq] = variant
-                                    N_COMPUTED_ALN += 1
-                                    N_CACHED_ALN += (variant_count - 1)
-                                    if len(variant['aln_ref_names']) == 1 or args.expand_ambiguous_alignments:
-                                        for name in variant['aln_ref_names']:
-                                            match_name = "variant_" + name
-                                            if READ_LENGTH == 0:
-                                                READ_LENGTH = len(variant[match_name]['aln_seq'])
-                                            N_GLOBAL_SUBS += (variant[match_name]['substitution_n'] + variant[match_name]['substitutions_outside_window']) * variant_count
-                                            N_SUBS_OUTSIDE_WINDOW += variant[match_name]['substitutions_outside_window'] * variant_count
-                                            N_MODS_IN_WINDOW += variant[match_name]['mods_in_window'] * variant_count
-                                            N_MODS_OUTSIDE_WINDOW += variant[match_name]['mods_outside_window'] * variant_count
-                                            if variant[match_name]['irregular_ends']:
-                                                N_READS_IRREGULAR_ENDS += variant_count
-                                if (index % 50000 == 0 and index > 0):
-                                    info("Calculating statistics; %d completed out of %d unique reads" % (index, num_unique_reads))
-                    except FileNotFoundError:
-                        raise CRISPRessoShared.OutputFolderIncompleteException("Could not find generated variants file, try deleting output folder, checking input files, and rerunning CRISPResso")
-                files_to_remove.append(file_path)
+            try:
+                for index, (seq, variant_dict) in enumerate(read_variant_files(variant_file_list)):
+                    variant_count = variantCache[seq]
+                    N_TOT_READS += variant_count
+                    variant = variant_dict
+                    variant['count'] = variant_count
+                    if variant['best_match_score'] <= 0:
+                        N_COMPUTED_NOTALN += 1
+                        N_CACHED_NOTALN += (variant_count - 1)
+                        not_aligned_variants[seq] = variant
+                        # remove the unaligned reads from the cache
+                        unaligned_reads.append(seq)
+                    elif variant['best_match_score'] > 0:
+                        variantCache[seq] = variant_columns.add(variant)
+                        N_COMPUTED_ALN += 1
+                        N_CACHED_ALN += (variant_count - 1)
+                        if len(variant['aln_ref_names']) == 1 or args.expand_ambiguous_alignments:
+                            for name in variant['aln_ref_names']:
+                                match_name = "variant_" + name
+                                if READ_LENGTH == 0:
+                                    READ_LENGTH = len(variant[match_name]['aln_seq'])
+                                    read_length_seq = seq
+                                N_GLOBAL_SUBS += (variant[match_name]['substitution_n'] + variant[match_name]['substitutions_outside_window']) * variant_count
+                                N_SUBS_OUTSIDE_WINDOW += variant[match_name]['substitutions_outside_window'] * variant_count
+                                N_MODS_IN_WINDOW += variant[match_name]['mods_in_window'] * variant_count
+                                N_MODS_OUTSIDE_WINDOW += variant[match_name]['mods_outside_window'] * variant_count
+                                if variant[match_name]['irregular_ends']:
+                                    N_READS_IRREGULAR_ENDS += variant_count
+                    if (index % 50000 == 0 and index > 0):
+                        info("Calculating statistics; %d completed out of %d unique reads" % (index, num_unique_reads))
+            except FileNotFoundError:
+                raise CRISPRessoShared.OutputFolderIncompleteException("Could not find generated variants file, try deleting output folder, checking input files, and rerunning CRISPResso")
+            files_to_remove.extend([file_path for file_path in variant_file_list if file_path not in files_to_remove])
         else:
             raise CRISPRessoShared.OutputFolderIncompleteException("Could not find output folder, try deleting output folder and rerunning CRISPResso")
 
         if N_COMPUTED_ALN + N_COMPUTED_NOTALN != num_unique_reads:
             raise CRISPRessoShared.OutputFolderIncompleteException("Number of unique reads processed by parallel processes does not match the number of unique reads found in the fastq file. Try rerunning CRISPResso.")
     else:
-        for index, fastq_seq in enumerate(variantCache.keys()):
+        seq_list = list(variantCache.keys())
+        if new_variants is None and n_processes > 1 and args.use_threads:
+            info("Analyzing unique reads with %d threads..." % (n_processes))
+            new_variants = get_new_variant_objects_threaded(seq_list, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, n_processes, alignment_cache)
+        elif new_variants is None:
+            new_variants = (get_new_variant_object(args, CRISPRessoCOREResources.unpack_sequence(seq_key), refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, kmer_index=kmer_index, seed_matcher=seed_matcher, alignment_cache=alignment_cache, include_masks=include_masks) for seq_key in seq_list)
+        for index, (fastq_seq, variant) in enumerate(zip(seq_list, new_variants)):
             variant_count = variantCache[fastq_seq]
             N_TOT_READS += variant_count
-            variant = get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaffold_dna_info)
             variant['count'] = variant_count
             if variant['best_match_score'] <= 0:
                 N_COMPUTED_NOTALN += 1
@@ -1965,12 +2796,13 @@ def process_fastq(fastq_filename, variantCache, ref_names, refs, args, files_to_
                 unaligned_reads.append(fastq_seq)
                 not_aligned_variants[fastq_seq] = variant
             elif variant['best_match_score'] > 0:
-                variantCache[fastq_seq] = variant
+                variantCache[fastq_seq] = variant_columns.add(variant)
                 N_COMPUTED_ALN += 1
                 N_CACHED_ALN += (variant_count - 1)
                 match_name = "variant_" + variant['best_match_name']
                 if READ_LENGTH == 0:
                     READ_LENGTH = len(variant[match_name]['aln_seq'])
+                    read_length_seq = fastq_seq
                 N_GLOBAL_SUBS += (variant[match_name]['substitution_n'] + variant[match_name]['substitutions_outside_window']) * variant_count
                 N_SUBS_OUTSIDE_WINDOW += variant[match_name]['substitutions_outside_window'] * variant_count
                 N_MODS_IN_WINDOW += variant[match_name]['mods_in_window'] * variant_count
@@ -1997,7 +2829,59 @@ def process_fastq(fastq_filename, variantCache, ref_names, refs, args, files_to_
             "N_READS_IRREGULAR_ENDS": N_READS_IRREGULAR_ENDS,
             "READ_LENGTH": READ_LENGTH,
             }
-    return aln_stats, not_aligned_variants
+    return aln_stats, not_aligned_variants, read_length_seq
+
+
+def align_fastq_partitions(fastq_filename, variantStore, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_processes, output_directory, files_to_remove):
+    """Counts and aligns the unique reads of a fastq file one hash partition at a time, and stores their variant objects in variantStore
+
+    Only the unique reads of one partition and their variant objects are in memory at a time. The variant objects are
+    added to variantStore in the order their reads were first seen in the fastq file, so the store iterates like the
+    variantCache of a run that keeps all reads in memory, and the statistics are the same.
+
+    Parameters
+    ----------
+        fastq_filename: the fastq file
+        variantStore: the CRISPRessoVariantStore.VariantStore to fill, with the number of partitions to split the reads into
+        other parameters: as in align_unique_reads
+
+    Returns
+    -------
+    aln_stats: dict of the alignment statistics of the reads
+    not_aligned_variants: dict of the variant objects of the reads that didn't align
+
+    """
+    aln_stats = None
+    read_length_order = None
+    not_aligned_items = []
+    n_partitions = variantStore.n_partitions
+    for partition in range(n_partitions):
+        info("Iterating over fastq file to identify the reads of partition %d of %d..." % (partition + 1, n_partitions))
+        partition_cache = {}
+        first_reads = []
+        with CRISPRessoCOREResources.FastqReader(fastq_filename) as fastq_reader:
+            num_reads = fastq_reader.count_sequences(partition_cache, first_reads, n_partitions, partition, pack=True)
+        info("Finished reading fastq file; %d unique reads of partition %d found of %d total reads found " % (len(partition_cache), partition + 1, num_reads))
+        first_read_by_seq = dict(zip(partition_cache, first_reads))
+        del first_reads
+
+        partition_stats, partition_not_aligned, read_length_seq = align_unique_reads(partition_cache, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, alignment_cache, n_processes, output_directory, files_to_remove)
+        variantStore.add_all((first_read_by_seq[seq], seq, variant) for seq, variant in partition_cache.items())
+        not_aligned_items.extend((first_read_by_seq[seq], seq, variant) for seq, variant in partition_not_aligned.items())
+
+        if aln_stats is None:
+            aln_stats = partition_stats
+        else:
+            for stat in aln_stats:
+                if stat != 'READ_LENGTH':
+                    aln_stats[stat] += partition_stats[stat]
+        # READ_LENGTH is taken from the first aligned read of the file, as when aligning all reads at once
+        if read_length_seq is not None and (read_length_order is None or first_read_by_seq[read_length_seq] < read_length_order):
+            read_length_order = first_read_by_seq[read_length_seq]
+            aln_stats['READ_LENGTH'] = partition_stats['READ_LENGTH']
+
+    not_aligned_items.sort(key=lambda item: item[0])
+    return aln_stats, {seq: variant for _, seq, variant in not_aligned_items}
 
 
 def process_bam(bam_filename, bam_chr_loc, output_bam, variantCache, ref_names, refs, args, files_to_remove, output_directory):
@@ -2017,40 +2901,41 @@ def process_bam(bam_filename, bam_chr_loc, output_bam, variantCache, ref_names,
     aln_matrix_loc = os.path.join(_ROOT, args.needleman_wunsch_aln_matrix_loc)
     CRISPRessoShared.check_file(aln_matrix_loc)
     aln_matrix = CRISPResso2Align.read_matrix(aln_matrix_loc)
+    aligner = get_aligner(args, aln_matrix)
+    kmer_index = get_kmer_index(args, refs, ref_names)
+    seed_matcher = get_seed_matcher(args, refs, ref_names)
+    include_masks = get_include_masks(refs, ref_names)
 
     pe_scaffold_dna_info = (0, None)  # scaffold start loc, scaffold sequence
     if args.prime_editing_pegRNA_scaffold_seq != "" and args.prime_editing_pegRNA_extension_seq != "":
         pe_scaffold_dna_info = CRISPRessoPlotData.get_pe_scaffold_search(refs['Prime-edited']['sequence'], args.prime_editing_pegRNA_extension_seq, args.prime_editing_pegRNA_scaffold_seq, args.prime_editing_pegRNA_scaffold_min_match_length)
-
-    output_sam = output_bam + ".sam"
-    with open(output_sam, "w") as sam_out:
-        # first, write header to sam
-        proc = sb.Popen(['samtools', 'view', '-H', bam_filename], stdout=sb.PIPE, stderr=sb.PIPE, encoding='utf-8')
-        for line in proc.stdout:
-            sam_out.write(line)
-
+    alignment_cache = get_alignment_cache(args, refs, ref_names, aln_matrix, pe_scaffold_dna_info)
+
+    exclude_flags = CRISPRessoBAM.parse_flags(args.samtools_exclude_flags)
+    with CRISPRessoBAM.BamReader(bam_filename) as bam_reader:
+        # the header of the output bam is the header of the input bam with a line for this run
+        header_text = bam_reader.header_text
+        if header_text and not header_text.endswith('\n'):
+            header_text += '\n'
         crispresso_cmd_to_write = ' '.join(sys.argv)
-        sam_out.write('@PG\tID:crispresso2\tPN:crispresso2\tVN:' + CRISPRessoShared.__version__ + '\tCL:"' + crispresso_cmd_to_write + '"\n')
-        if bam_chr_loc != "":
-            proc = sb.Popen(['samtools', 'view', '-F', args.samtools_exclude_flags, bam_filename, bam_chr_loc], stdout=sb.PIPE, encoding='utf-8')
-        else:
-            proc = sb.Popen(['samtools', 'view', '-F', args.samtools_exclude_flags, bam_filename], stdout=sb.PIPE, encoding='utf-8')
+        header_text += '@PG\tID:crispresso2\tPN:crispresso2\tVN:' + CRISPRessoShared.__version__ + '\tCL:"' + crispresso_cmd_to_write + '"\n'
         num_reads = 0
 
         # Reading through the bam file and enriching variantCache as a dictionary with the following:
-        # Key: the unique DNA sequence from the fastq file
+        # Key: the unique DNA sequence from the fastq file, packed by CRISPRessoCOREResources.pack_sequence
         # Value: an integer that represents how many times we've seen this specific read
-        for sam_line in proc.stdout:
+        for bam_record in bam_reader.fetch(bam_chr_loc):
+            if bam_record.flag & exclude_flags:
+                continue
             if num_reads % 50000 == 0 and num_reads != 0:
-                info("Iterating over sam file to identify reads; %d reads identified." % (num_reads))
-            sam_line_els = sam_line.rstrip().split("\t")
-            fastq_seq = sam_line_els[9]
-            if fastq_seq in variantCache:
+                info("Iterating over bam file to identify reads; %d reads identified." % (num_reads))
+            seq_key = CRISPRessoCOREResources.pack_sequence(bam_record.seq)
+            if seq_key in variantCache:
                 # if the read has already been seen, we increment its value by 1 to track number of copies
-                variantCache[fastq_seq] += 1
+                variantCache[seq_key] += 1
             # If the sequence is not in the cache, we create it and set its value to 1
             else:
-                variantCache[fastq_seq] = 1
+                variantCache[seq_key] = 1
             num_reads += 1
         num_unique_reads = len(variantCache.keys())
         info("Finished reading bam file; %d unique reads found of %d total reads found " % (num_unique_reads, num_reads))
@@ -2073,124 +2958,87 @@ def process_bam(bam_filename, bam_chr_loc, output_bam, variantCache, ref_names,
         READ_LENGTH = 0
         not_aln = {}
 
-        if n_processes > 1 and num_unique_reads > n_processes:
-            boundaries = get_variant_cache_equal_boundaries(num_unique_reads, n_processes)
-            processes = []  # list to hold the processes so we can wait for them to complete with join()
+        if n_processes > 1 and num_unique_reads > n_processes and not args.use_threads:
             variants_dir = output_directory
-
-            info("Spinning up %d parallel processes to analyze unique reads..." % (n_processes))
-            for i in range(n_processes):
-                left_sublist_index = boundaries[i]
-                right_sublist_index = boundaries[i + 1]
-                process = Process(
-                    target=variant_file_generator_process,
-                    args=(
-                        (list(variantCache.keys())[left_sublist_index:right_sublist_index]),
-                        get_new_variant_object,
-                        args,
-                        refs,
-                        ref_names,
-                        aln_matrix,
-                        pe_scaffold_dna_info,
-                        i,
-                        variants_dir
-                        )
-                )
-                process.start()
-                processes.append(process)
-            for p in processes:
-                p.join()  # pauses the main thread until the processes are finished
+            variant_file_list = get_new_variant_objects_in_processes(list(variantCache.keys()), get_new_variant_object, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, n_processes, variants_dir, alignment_cache=alignment_cache)
 
             info("Finished processing unique reads, now generating statistics...", {'percent_complete': 15})
-            variant_file_list = []
-            if os.path.exists(variants_dir):
-                for n_processes in range(n_processes):
-                    variant_file_list.append(os.path.join(variants_dir, f"variants_{n_processes}.tsv"))
-            for file_path in variant_file_list:
-                # Ensure the file is a .tsv before processing
-                if file_path.endswith(".tsv"):
-                    try:
-                        with open(file_path, 'r') as file:
-                            for index, line in enumerate(file):
-                                # Each line contains a sequence followed by a JSON string
-                                parts = line.strip().split('\t')
-                                if len(parts) == 2:
-                                    seq = parts[0]
-                                    json_data = parts[1]
-                                    new_variant = json.loads(json_data, cls=CRISPRessoShared.CRISPRessoJSONDecoder)
-                                else:
-                                    if args.debug:
-                                        error(f"Could not parse variant from line: {line}")
-                                    raise CRISPRessoShared.OutputFolderIncompleteException("Could not parse variant from file")
-                                variant_count = variantCache[seq]
-                                new_variant['count'] = variant_count
-                                N_TOT_READS += variant_count
-                                if new_variant['best_match_score'] <= 0:
-                                    N_COMPUTED_NOTALN += 1
-                                    N_CACHED_NOTALN += (variant_count - 1)
-                                    crispresso_sam_optional_fields = "c2:Z:ALN=NA" +\
-                                            " ALN_SCORES=" + ('&'.join([str(x) for x in new_variant['aln_scores']])) +\
-                                            " ALN_DETAILS=" + ('&'.join([','.join([str(y) for y in x]) for x in new_variant['ref_aln_details']]))
-                                    not_aln[seq] = new_variant
-                                    not_aln[seq]['crispresso_sam_optional_fields'] = crispresso_sam_optional_fields
-                                else:
-                                    class_names = []
-                                    ins_inds = []
-                                    del_inds = []
-                                    sub_inds = []
-                                    edit_strings = []
-                                    for idx, best_match_name in enumerate(new_variant['aln_ref_names']):
-                                        payload = new_variant['variant_' + best_match_name]
-
-                                        del_inds.append([str(x[0][0]) + "(" + str(x[1]) + ")" for x in zip(payload['deletion_coordinates'], payload['deletion_sizes'])])
-
-                                        ins_vals = []
-                                        for ins_coord, ins_size in zip(payload['insertion_coordinates'], payload['insertion_sizes']):
-                                            ins_start = payload['ref_positions'].index(ins_coord[0])
-                                            ins_vals.append(payload['aln_seq'][ins_start + 1:ins_start + 1 + ins_size])
-                                        ins_inds.append([str(x[0][0]) + "(" + str(x[1]) + "+" + x[2] + ")" for x in zip(payload['insertion_coordinates'], payload['insertion_sizes'], ins_vals)])
-
-                                        sub_inds.append(payload['substitution_positions'])
-                                        edit_strings.append('D' + str(int(payload['deletion_n'])) + ';I' + str(int(payload['insertion_n'])) + ';S' + str(int(payload['substitution_n'])))
-
-                                    crispresso_sam_optional_fields = "c2:Z:ALN=" + ("&".join(new_variant['aln_ref_names'])) +\
-                                            " CLASS=" + new_variant['class_name'] +\
-                                            " MODS=" + ("&".join(edit_strings)) +\
-                                            " DEL=" + ("&".join([';'.join(x) for x in del_inds])) +\
-                                            " INS=" + ("&".join([';'.join(x) for x in ins_inds])) +\
-                                            " SUB=" + ("&".join([';'.join([str(y) for y in x]) for x in sub_inds])) +\
-                                            " ALN_REF=" + ('&'.join([new_variant['variant_' + name]['aln_ref'] for name in new_variant['aln_ref_names']])) +\
-                                            " ALN_SEQ=" + ('&'.join([new_variant['variant_' + name]['aln_seq'] for name in new_variant['aln_ref_names']]))
-                                    # cigar strings are in reference to the given amplicon, not to the genomic sequence to which this read is aligned..
-                                    # first_variant = new_variant['variant_'+new_variant['aln_ref_names'][0]]
-                                    # sam_cigar = ''.join(CRISPRessoShared.unexplode_cigar(''.join([CRISPRessoShared.CIGAR_LOOKUP[x] for x in zip(first_variant['aln_seq'],first_variant['aln_ref'])])))
-                                    # sam_line_els[5] = sam_cigar
-                                    # new_variant['sam_cigar'] = sam_cigar
-                                    new_variant['crispresso2_annotation'] = crispresso_sam_optional_fields
-                                    variantCache[seq] = new_variant
-                                    N_COMPUTED_ALN += 1
-                                    N_CACHED_ALN += (variant_count - 1)
-                                    match_name = 'variant_' + new_variant['best_match_name']
-                                    if READ_LENGTH == 0:
-                                        READ_LENGTH = len(new_variant[match_name]['aln_seq'])
-                                    N_GLOBAL_SUBS += new_variant[match_name]['substitution_n'] + new_variant[match_name]['substitutions_outside_window'] * variant_count
-                                    N_SUBS_OUTSIDE_WINDOW += new_variant[match_name]['substitutions_outside_window'] * variant_count
-                                    N_MODS_IN_WINDOW += new_variant[match_name]['mods_in_window'] * variant_count
-                                    N_MODS_OUTSIDE_WINDOW += new_variant[match_name]['mods_outside_window'] * variant_count
-                                    if new_variant[match_name]['irregular_ends']:
-                                        N_READS_IRREGULAR_ENDS += variant_count
-
-                    except FileNotFoundError:
-                        raise CRISPRessoShared.OutputFolderIncompleteException("Could not find generated variants file, try deleting output folder, checking input files, and rerunning CRISPResso")
-                files_to_remove.append(file_path)
+            try:
+                for index, (seq, new_variant) in enumerate(read_variant_files(variant_file_list)):
+                    variant_count = variantCache[seq]
+                    new_variant['count'] = variant_count
+                    N_TOT_READS += variant_count
+                    if new_variant['best_match_score'] <= 0:
+                        N_COMPUTED_NOTALN += 1
+                        N_CACHED_NOTALN += (variant_count - 1)
+                        crispresso_sam_optional_fields = "c2:Z:ALN=NA" +\
+                                " ALN_SCORES=" + ('&'.join([str(x) for x in new_variant['aln_scores']])) +\
+                                " ALN_DETAILS=" + ('&'.join([','.join([str(y) for y in x]) for x in new_variant['ref_aln_details']]))
+                        not_aln[seq] = new_variant
+                        not_aln[seq]['crispresso_sam_optional_fields'] = crispresso_sam_optional_fields
+                    else:
+                        class_names = []
+                        ins_inds = []
+                        del_inds = []
+                        sub_inds = []
+                        edit_strings = []
+                        for idx, best_match_name in enumerate(new_variant['aln_ref_names']):
+                            payload = new_variant['variant_' + best_match_name]
+
+                            del_inds.append([str(x[0][0]) + "(" + str(x[1]) + ")" for x in zip(payload['deletion_coordinates'], payload['deletion_sizes'])])
+
+                            ins_vals = []
+                            for ins_coord, ins_size in zip(payload['insertion_coordinates'], payload['insertion_sizes']):
+                                ins_start = payload['ref_positions'].index(ins_coord[0])
+                                ins_vals.append(payload['aln_seq'][ins_start + 1:ins_start + 1 + ins_size])
+                            ins_inds.append([str(x[0][0]) + "(" + str(x[1]) + "+" + x[2] + ")" for x in zip(payload['insertion_coordinates'], payload['insertion_sizes'], ins_vals)])
+
+                            sub_inds.append(payload['substitution_positions'])
+                            edit_strings.append('D' + str(int(payload['deletion_n'])) + ';I' + str(int(payload['insertion_n'])) + ';S' + str(int(payload['substitution_n'])))
+
+                        crispresso_sam_optional_fields = "c2:Z:ALN=" + ("&".join(new_variant['aln_ref_names'])) +\
+                                " CLASS=" + new_variant['class_name'] +\
+                                " MODS=" + ("&".join(edit_strings)) +\
+                                " DEL=" + ("&".join([';'.join(x) for x in del_inds])) +\
+                                " INS=" + ("&".join([';'.join(x) for x in ins_inds])) +\
+                                " SUB=" + ("&".join([';'.join([str(y) for y in x]) for x in sub_inds])) +\
+                                " ALN_REF=" + ('&'.join([new_variant['variant_' + name]['aln_ref'] for name in new_variant['aln_ref_names']])) +\
+                                " ALN_SEQ=" + ('&'.join([new_variant['variant_' + name]['aln_seq'] for name in new_variant['aln_ref_names']]))
+                        # cigar strings are in reference to the given amplicon, not to the genomic sequence to which this read is aligned..
+                        # first_variant = new_variant['variant_'+new_variant['aln_ref_names'][0]]
+                        # sam_cigar = ''.join(CRISPRessoShared.unexplode_cigar(''.join([CRISPRessoShared.CIGAR_LOOKUP[x] for x in zip(first_variant['aln_seq'],first_variant['aln_ref'])])))
+                        # sam_line_els[5] = sam_cigar
+                        # new_variant['sam_cigar'] = sam_cigar
+                        new_variant['crispresso2_annotation'] = crispresso_sam_optional_fields
+                        variantCache[seq] = new_variant
+                        N_COMPUTED_ALN += 1
+                        N_CACHED_ALN += (variant_count - 1)
+                        match_name = 'variant_' + new_variant['best_match_name']
+                        if READ_LENGTH == 0:
+                            READ_LENGTH = len(new_variant[match_name]['aln_seq'])
+                        N_GLOBAL_SUBS += new_variant[match_name]['substitution_n'] + new_variant[match_name]['substitutions_outside_window'] * variant_count
+                        N_SUBS_OUTSIDE_WINDOW += new_variant[match_name]['substitutions_outside_window'] * variant_count
+                        N_MODS_IN_WINDOW += new_variant[match_name]['mods_in_window'] * variant_count
+                        N_MODS_OUTSIDE_WINDOW += new_variant[match_name]['mods_outside_window'] * variant_count
+                        if new_variant[match_name]['irregular_ends']:
+                            N_READS_IRREGULAR_ENDS += variant_count
+
+            except FileNotFoundError:
+                raise CRISPRessoShared.OutputFolderIncompleteException("Could not find generated variants file, try deleting output folder, checking input files, and rerunning CRISPResso")
+            files_to_remove.extend(variant_file_list)
             if N_COMPUTED_ALN + N_COMPUTED_NOTALN != num_unique_reads:
                 raise CRISPRessoShared.OutputFolderIncompleteException("Number of unique reads processed by parallel processes does not match the number of unique reads found in the bam file. Try rerunning CRISPResso.")
         else:
         # Single process mode
-            for idx, fastq_seq in enumerate(variantCache.keys()):
+            seq_list = list(variantCache.keys())
+            if n_processes > 1 and args.use_threads:
+                info("Analyzing unique reads with %d threads..." % (n_processes))
+                new_variants = get_new_variant_objects_threaded(seq_list, args, refs, ref_names, aln_matrix, pe_scaffold_dna_info, n_processes, alignment_cache)
+            else:
+                new_variants = (get_new_variant_object(args, CRISPRessoCOREResources.unpack_sequence(seq_key), refs, ref_names, aln_matrix, pe_scaffold_dna_info, aligner=aligner, kmer_index=kmer_index, seed_matcher=seed_matcher, alignment_cache=alignment_cache, include_masks=include_masks) for seq_key in seq_list)
+            for idx, (fastq_seq, new_variant) in enumerate(zip(seq_list, new_variants)):
                 variant_count = variantCache[fastq_seq]
                 N_TOT_READS += variant_count
-                new_variant = get_new_variant_object(args, fastq_seq, refs, ref_names, aln_matrix, pe_scaffold_dna_info)
                 new_variant['count'] = variant_count
                 if new_variant['best_match_score'] <= 0:
                     N_CACHED_NOTALN += (variant_count - 1)
@@ -2198,7 +3046,6 @@ def process_bam(bam_filename, bam_chr_loc, output_bam, variantCache, ref_names,
                     crispresso_sam_optional_fields = "c2:Z:ALN=NA" +\
                             " ALN_SCORES=" + ('&'.join([str(x) for x in new_variant['aln_scores']])) +\
                             " ALN_DETAILS=" + ('&'.join([','.join([str(y) for y in x]) for x in new_variant['ref_aln_details']]))
-                    sam_line_els.append(crispresso_sam_optional_fields)
                     not_aln[fastq_seq] = new_variant
                     not_aln[fastq_seq]['crispresso_sam_optional_fields'] = crispresso_sam_optional_fields
                 else:
@@ -2248,22 +3095,16 @@ def process_bam(bam_filename, bam_chr_loc, output_bam, variantCache, ref_names,
                 info("Processing Reads; %d Completed out of %d Unique Reads" % (idx, num_unique_reads))
 
         # Now that we've enriched variantCache with the unique reads, we read through the bam file again to write variants to the output file
-        if bam_chr_loc != "":
-            new_proc = sb.Popen(['samtools', 'view', bam_filename, bam_chr_loc], stdout=sb.PIPE, encoding='utf-8')
-        else:
-            new_proc = sb.Popen(['samtools', 'view', bam_filename], stdout=sb.PIPE, encoding='utf-8')
-
-        for sam_line in new_proc.stdout:
-            sam_line_els = sam_line.rstrip().split("\t")
-            fastq_seq = sam_line_els[9]
-            if fastq_seq in not_aln:
-                sam_line_els.append(not_aln[fastq_seq]['crispresso_sam_optional_fields'])  # Crispresso2 alignment: NA
-                sam_out.write("\t".join(sam_line_els) + "\n")
-            elif fastq_seq in variantCache:
-                sam_line_els.append(variantCache[fastq_seq]['crispresso2_annotation'])
-                sam_out.write("\t".join(sam_line_els) + "\n")
-    for fastq_seq in not_aln.keys():
-        del variantCache[fastq_seq]
+        # The annotations are written as the c2 tag of the records (they start with 'c2:Z:' as in a sam file)
+        with CRISPRessoBAM.BamWriter(output_bam, header_text, bam_reader.references) as bam_out:
+            for bam_record in bam_reader.fetch(bam_chr_loc):
+                seq_key = CRISPRessoCOREResources.pack_sequence(bam_record.seq)
+                if seq_key in not_aln:
+                    bam_out.write(bam_record.data, {'c2': not_aln[seq_key]['crispresso_sam_optional_fields'][5:]})  # Crispresso2 alignment: NA
+                elif seq_key in variantCache:
+                    bam_out.write(bam_record.data, {'c2': variantCache[seq_key]['crispresso2_annotation'][5:]})
+    for seq_key in not_aln.keys():
+        del variantCache[seq_key]
     info("Finished reads; N_TOT_READS: %d N_COMPUTED_ALN: %d N_CACHED_ALN: %d N_COMPUTED_NOTALN: %d N_CACHED_NOTALN: %d" % (N_TOT_READS, N_COMPUTED_ALN, N_CACHED_ALN, N_COMPUTED_NOTALN, N_CACHED_NOTALN))
     aln_stats = {"N_TOT_READS": N_TOT_READS,
             "N_CACHED_ALN": N_CACHED_ALN,
@@ -2277,6 +3118,7 @@ def process_bam(bam_filename, bam_chr_loc, output_bam, variantCache, ref_names,
             "N_READS_IRREGULAR_ENDS": N_READS_IRREGULAR_ENDS,
             "READ_LENGTH": READ_LENGTH,
             }
+    add_alignment_cache_stats(alignment_cache, aln_stats)
     return aln_stats, not_aln
 
 
@@ -2285,31 +3127,20 @@ def process_fastq_write_out(fastq_input, fastq_output, variantCache, ref_names,
     aln_stats, not_aln = process_fastq(fastq_input, variantCache, ref_names, refs, args, files_to_remove, output_directory)
     info("Reads processed, now annotating fastq_output file: %s" % (fastq_output))
 
-    if fastq_input.endswith('.gz'):
-        fastq_input_opener = lambda x: gzip.open(x, 'rt')
-    else:
-        fastq_input_opener = open
-
-    with gzip.open(fastq_output, 'wt') as fastq_out_handle, fastq_input_opener(fastq_input) as fastq_input_handle:
+    with gzip.open(fastq_output, 'wt') as fastq_out_handle, CRISPRessoCOREResources.FastqReader(fastq_input) as fastq_reader:
 
-        fastq_id = fastq_input_handle.readline()
-        while (fastq_id):
-            # read through fastq in sets of 4
-            fastq_seq = fastq_input_handle.readline().strip()
-            fastq_plus = fastq_input_handle.readline().strip()
-            fastq_qual = fastq_input_handle.readline()
-
-            if fastq_seq in not_aln:
-                new_variant = not_aln[fastq_seq]
+        for fastq_id, fastq_seq, fastq_plus, fastq_qual in fastq_reader:
+            seq_key = CRISPRessoCOREResources.pack_sequence(fastq_seq)
+            if seq_key in not_aln:
+                new_variant = not_aln[seq_key]
                 crispresso2_annotation = " ALN=NA" +\
                             " ALN_SCORES=" + ('&'.join([str(x) for x in new_variant['aln_scores']])) +\
                             " ALN_DETAILS=" + ('&'.join([','.join([str(y) for y in x]) for x in new_variant['ref_aln_details']]))
-                fastq_out_handle.write(fastq_id + fastq_seq + "\n" + fastq_plus + crispresso2_annotation + "\n" + fastq_qual)
-                fastq_id = fastq_input_handle.readline()
+                fastq_out_handle.write(fastq_id + "\n" + fastq_seq + "\n" + fastq_plus + crispresso2_annotation + "\n" + fastq_qual + "\n")
                 continue
 
-            if fastq_seq in variantCache:
-                new_variant = variantCache[fastq_seq]
+            if seq_key in variantCache:
+                new_variant = variantCache[seq_key]
 
             ins_inds = []
             del_inds = []
@@ -2341,9 +3172,7 @@ def process_fastq_write_out(fastq_input, fastq_output, variantCache, ref_names,
                     " ALN_REF=" + ('&'.join([new_variant['variant_' + name]['aln_ref'] for name in new_variant['aln_ref_names']])) +\
                     " ALN_SEQ=" + ('&'.join([new_variant['variant_' + name]['aln_seq'] for name in new_variant['aln_ref_names']]))
             new_variant['crispresso2_annotation'] = crispresso2_annotation
-            fastq_out_handle.write(fastq_id + fastq_seq + "\n" + fastq_plus + crispresso2_annotation + "\n" + fastq_qual)
-            # last step of loop = read next line
-            fastq_id = fastq_input_handle.readline()
+            fastq_out_handle.write(fastq_id + "\n" + fastq_seq + "\n" + fastq_plus + crispresso2_annotation + "\n" + fastq_qual + "\n")
 
     return aln_stats, not_aln
 
@@ -2377,27 +3206,21 @@ def process_single_fastq_write_bam_out(fastq_input, bam_output, bam_header, vari
     CRISPRessoShared.check_file(aln_matrix_loc)
     aln_matrix = CRISPResso2Align.read_matrix(aln_matrix_loc)
 
-    if fastq_input.endswith('.gz'):
-        fastq_input_opener = lambda x: gzip.open(x, 'rt')
-    else:
-        fastq_input_opener = open
-
     sam_out = bam_output + ".sam"
 
-    with open(sam_out, 'wt') as sam_out_handle, fastq_input_opener(fastq_input) as fastq_input_handle:
+    with open(sam_out, 'wt') as sam_out_handle, CRISPRessoCOREResources.FastqReader(fastq_input) as fastq_reader:
         # write sam output header
         sam_out_handle.write(bam_header)
 
-        fastq_id = fastq_input_handle.readline().strip()[1:]
-        while (fastq_id):
-            # read through fastq in sets of 4
-            fastq_seq = fastq_input_handle.readline().strip()
-            fastq_plus = fastq_input_handle.readline().strip()
-            fastq_qual = fastq_input_handle.readline().strip()
+        for fastq_id, fastq_seq, fastq_plus, fastq_qual in fastq_reader:
+            fastq_id = fastq_id.strip()[1:]
+            if not fastq_id:
+                break
 
             # if the sequence has been seen and can't be aligned, skip it
-            if fastq_seq in not_aln:
-                new_variant = not_aln[fastq_seq]
+            seq_key = CRISPRessoCOREResources.pack_sequence(fastq_seq)
+            if seq_key in not_aln:
+                new_variant = not_aln[seq_key]
                 new_sam_entry = [
                     fastq_id,  # read id
                     '4',             # flag = unmapped 0x4
@@ -2417,8 +3240,8 @@ def process_single_fastq_write_bam_out(fastq_input, bam_output, bam_header, vari
                 new_sam_entry.append(crispresso_sam_optional_fields)
                 sam_out_handle.write("\t".join(new_sam_entry) + "\n")  # write cached alignment with modified read id and qual
 
-            if fastq_seq in variantCache:
-                new_variant = variantCache[fastq_seq]
+            if seq_key in variantCache:
+                new_variant = variantCache[seq_key]
                 ins_inds = []
                 del_inds = []
                 sub_inds = []
@@ -2497,9 +3320,6 @@ def process_single_fastq_write_bam_out(fastq_input, bam_output, bam_header, vari
                 new_variant['sam_entry'] = new_sam_entry
 
                 sam_out_handle.write("\t".join(new_sam_entry) + "\n")  # write cached alignment with modified read id and qual
-
-            # last step of loop = read next line
-            fastq_id = fastq_input_handle.readline().strip()[1:]
     sort_and_index_cmd = 'samtools sort ' + sam_out + ' -o ' + bam_output + ' && samtools index ' + bam_output
     sort_bam_status = sb.call(sort_and_index_cmd, shell=True)
     if sort_bam_status:
@@ -2557,11 +3377,13 @@ def get_scores_and_counts(variant_dict):
     alleles_homology_scores_and_counts = []
     for seq, variant in variant_dict.items():
         if len(variant) > 1:
-            homology_scores.append(max(variant['aln_scores']))
+            # references pruned with --aln_prune_references have no score, but score lower than the best match
+            homology_score = max(score for score in variant['aln_scores'] if score is not None)
+            homology_scores.append(homology_score)
             counts.append(variant['count'])
             alleles_homology_scores_and_counts.append({
                 'sequence': seq,
-                'homology_score': max(variant['aln_scores']),
+                'homology_score': homology_score,
                 'count': variant['count']
             })
     return homology_scores, counts, alleles_homology_scores_and_counts
@@ -2573,6 +3395,8 @@ def get_and_save_homology_scores(variantCache, not_aln_variant_objects, alleles_
     not_aln_homology_scores, not_aln_counts, not_aln_alleles_homology_scores_and_counts = get_scores_and_counts(not_aln_variant_objects)
 
     alleles_homology_scores_and_counts = aln_alleles_homology_scores_and_counts + not_aln_alleles_homology_scores_and_counts
+    for allele in alleles_homology_scores_and_counts:
+        allele['sequence'] = CRISPRessoCOREResources.unpack_sequence(allele['sequence'])
     homology_scores = aln_homology_scores + not_aln_homology_scores
     counts = aln_counts + not_aln_counts
 
@@ -2764,8 +3588,6 @@ def main():
             crispresso2_info['running_info']['bam_input'] = args.bam_input
             bam_output = _jp('CRISPResso_output.bam')
             crispresso2_info['running_info']['bam_output'] = bam_output
-            output_sam = bam_output + ".sam"
-            files_to_remove.append(output_sam)
 
             if args.fastq_output:
                 raise CRISPRessoShared.BadParameterException('bam_input is not compatable with fastq_output! Please either use bam_input or fastq_output.')
@@ -3732,6 +4554,20 @@ def main():
 
         # INITIALIZE CACHE####
         variantCache = {}
+        if args.max_memory > 0:
+            if args.bam_input or args.crispresso_merge or (args.bam_output and not args.fastq_output):
+                warn('--max_memory is only applied to single-end or merged fastq input that is not written to a bam file, so all reads will be kept in memory.')
+            else:
+                n_memory_partitions = get_n_memory_partitions(processed_output_filename, N_READS_AFTER_PREPROCESSING, args.max_memory)
+                if n_memory_partitions > 1:
+                    info('The reads may not fit in --max_memory %d MB, so they will be aligned in %d partitions and their alignments stored on disk.' % (args.max_memory, n_memory_partitions))
+                    variantCache = CRISPRessoVariantStore.VariantStore(OUTPUT_DIRECTORY, n_memory_partitions)
+
+        # reads are only drawn in random order from single-end or merged fastq input whose alignments are kept in memory
+        reads_annotated = args.bam_input or args.fastq_output or args.bam_output
+        if args.convergence_precision > 0 and (reads_annotated or args.crispresso_merge or isinstance(variantCache, CRISPRessoVariantStore.VariantStore)):
+            warn('--convergence_precision is only applied to single-end or merged fastq input that is not written to a fastq or bam file or split by --max_memory, so all reads will be analyzed.')
+            args.convergence_precision = 0
 
         # operates on variantCache
         if args.bam_input:
@@ -3750,7 +4586,7 @@ def main():
             aln_stats, not_aln_variant_objects = process_fastq(processed_output_filename, variantCache, ref_names, refs, args, files_to_remove, OUTPUT_DIRECTORY)
 
         # put empty sequence into cache
-        cache_fastq_seq = ''
+        cache_fastq_seq = CRISPRessoCOREResources.pack_sequence('')
         variantCache[cache_fastq_seq] = {}
         variantCache[cache_fastq_seq]['count'] = 0
 
@@ -3814,7 +4650,9 @@ def main():
         all_substitution_count_vectors = {}
         all_indelsub_count_vectors = {}
         all_substitution_base_vectors = {}
+        all_substitution_base_matrices = {}
         all_base_count_vectors = {}  # number of times each base is seen
+        all_base_count_matrices = {}
 
         insertion_count_vectors = {}  # insertions that are in the quantification window
         deletion_count_vectors = {}
@@ -3877,19 +4715,14 @@ def main():
             deletion_count_vectors_noncoding[ref_name] = np.zeros(this_len_amplicon)
             substitution_count_vectors_noncoding[ref_name] = np.zeros(this_len_amplicon)
 
-            # count times substitutions occur
-            all_substitution_base_vectors[ref_name + "_A"] = np.zeros(this_len_amplicon)
-            all_substitution_base_vectors[ref_name + "_C"] = np.zeros(this_len_amplicon)
-            all_substitution_base_vectors[ref_name + "_G"] = np.zeros(this_len_amplicon)
-            all_substitution_base_vectors[ref_name + "_T"] = np.zeros(this_len_amplicon)
-            all_substitution_base_vectors[ref_name + "_N"] = np.zeros(this_len_amplicon)
+            # count times substitutions occur (the vectors are the rows of a matrix tallied by CRISPRessoCOREResources.tally_bases)
+            all_substitution_base_matrices[ref_name] = np.zeros((len(CRISPRessoCOREResources.TALLY_NUCS), this_len_amplicon))
+            for nuc in ['A', 'C', 'G', 'T', 'N']:
+                all_substitution_base_vectors[ref_name + "_" + nuc] = all_substitution_base_matrices[ref_name][CRISPRessoCOREResources.TALLY_NUCS.index(nuc)]
 
-            all_base_count_vectors[ref_name + "_A"] = np.zeros(this_len_amplicon)
-            all_base_count_vectors[ref_name + "_C"] = np.zeros(this_len_amplicon)
-            all_base_count_vectors[ref_name + "_G"] = np.zeros(this_len_amplicon)
-            all_base_count_vectors[ref_name + "_T"] = np.zeros(this_len_amplicon)
-            all_base_count_vectors[ref_name + "_N"] = np.zeros(this_len_amplicon)
-            all_base_count_vectors[ref_name + "_-"] = np.zeros(this_len_amplicon)
+            all_base_count_matrices[ref_name] = np.zeros((len(CRISPRessoCOREResources.TALLY_NUCS), this_len_amplicon))
+            for nuc in ['A', 'C', 'G', 'T', 'N', '-']:
+                all_base_count_vectors[ref_name + "_" + nuc] = all_base_count_matrices[ref_name][CRISPRessoCOREResources.TALLY_NUCS.index(nuc)]
 
             # length by position in amplicon
             insertion_length_vectors[ref_name] = np.zeros(this_len_amplicon)
@@ -3968,7 +4801,7 @@ def main():
                 continue
 
             # check to see if this sequence's reverse complement is in the variant
-            rc_variant = CRISPRessoShared.reverse_complement(variant)
+            rc_variant = CRISPRessoCOREResources.pack_sequence(CRISPRessoShared.reverse_complement(CRISPRessoCOREResources.unpack_sequence(variant)))
             if rc_variant in variantCache and variantCache[rc_variant]['count'] > 0:
                 variant_count += variantCache[rc_variant]['count']
                 variantCache[rc_variant]['count'] = 0
@@ -4013,22 +4846,22 @@ def main():
                 this_effective_len = refs[ref_name]['sequence_length']  # how long is this alignment (insertions increase length, deletions decrease length)
 
                 this_has_insertions = False
-                all_insertion_count_vectors[ref_name][variant_payload['all_insertion_positions']] += variant_count
-                all_insertion_left_count_vectors[ref_name][variant_payload['all_insertion_left_positions']] += variant_count
+                CRISPRessoCOREResources.tally_positions(all_insertion_count_vectors[ref_name], variant_payload['all_insertion_positions'], variant_count)
+                CRISPRessoCOREResources.tally_positions(all_insertion_left_count_vectors[ref_name], variant_payload['all_insertion_left_positions'], variant_count)
 
                 if not args.ignore_insertions:
                     inserted_n_dicts[ref_name][variant_payload['insertion_n']] += variant_count
-                    insertion_count_vectors[ref_name][variant_payload['insertion_positions']] += variant_count
+                    CRISPRessoCOREResources.tally_positions(insertion_count_vectors[ref_name], variant_payload['insertion_positions'], variant_count)
                     this_effective_len = this_effective_len + variant_payload['insertion_n']
                     if variant_payload['insertion_n'] > 0:
                          counts_insertion[ref_name] += variant_count
                          this_has_insertions = True
 
                 this_has_deletions = False
-                all_deletion_count_vectors[ref_name][variant_payload['all_deletion_positions']] += variant_count
+                CRISPRessoCOREResources.tally_positions(all_deletion_count_vectors[ref_name], variant_payload['all_deletion_positions'], variant_count)
                 if not args.ignore_deletions:
                     deleted_n_dicts[ref_name][variant_payload['deletion_n']] += variant_count
-                    deletion_count_vectors[ref_name][variant_payload['deletion_positions']] += variant_count
+                    CRISPRessoCOREResources.tally_positions(deletion_count_vectors[ref_name], variant_payload['deletion_positions'], variant_count)
                     this_effective_len = this_effective_len - variant_payload['deletion_n']
                     if variant_payload['deletion_n'] > 0:
                          counts_deletion[ref_name] += variant_count
@@ -4037,21 +4870,17 @@ def main():
                 effective_len_dicts[ref_name][this_effective_len] += variant_count
 
                 this_has_substitutions = False
-                all_substitution_count_vectors[ref_name][variant_payload['all_substitution_positions']] += variant_count
+                all_substitution_positions = variant_payload['all_substitution_positions']
+                CRISPRessoCOREResources.tally_positions(all_substitution_count_vectors[ref_name], all_substitution_positions, variant_count)
 
                 if not args.ignore_substitutions:
                     substituted_n_dicts[ref_name][variant_payload['substitution_n']] += variant_count
-                    substitution_count_vectors[ref_name][variant_payload['substitution_positions']] += variant_count
+                    CRISPRessoCOREResources.tally_positions(substitution_count_vectors[ref_name], variant_payload['substitution_positions'], variant_count)
                     if variant_payload['substitution_n'] > 0:
                          counts_substitution[ref_name] += variant_count
                          this_has_substitutions = True
 
-                    nucs = ['A', 'T', 'C', 'G', 'N']
-                    for nuc in nucs:
-                        isNuc = [n == nuc for n in variant_payload['all_substitution_values']]
-                        if (np.sum(isNuc) > 0):
-                            locs = np.array(variant_payload['all_substitution_positions'])[isNuc]
-                            all_substitution_base_vectors[ref_name + "_" + nuc][locs] += variant_count
+                    CRISPRessoCOREResources.tally_bases(all_substitution_base_matrices[ref_name], ''.join(variant_payload['all_substitution_values']), all_substitution_positions, variant_count)
 
                 if this_has_deletions:
                     if this_has_insertions:
@@ -4072,13 +4901,7 @@ def main():
                     counts_only_substitution[ref_name] += variant_count
 
                 # set all_base_count_vectors
-                aln_seq = variant_payload['aln_seq']
-                ref_pos = variant_payload['ref_positions']
-                for i in range(len(aln_seq)):
-                    if ref_pos[i] < 0:
-                        continue
-                    nuc = aln_seq[i]
-                    all_base_count_vectors[ref_name + "_" + nuc][ref_pos[i]] += variant_count
+                CRISPRessoCOREResources.tally_bases(all_base_count_matrices[ref_name], variant_payload['aln_seq'], variant_payload['ref_positions'], variant_count)
 
                 exon_len_mods = refs[ref_name]['exon_len_mods']  # for each exon, how much length did this reference modify it?
                 tot_exon_len_mod = sum(exon_len_mods)  # for all exons, how much length was modified?
@@ -4094,25 +4917,21 @@ def main():
                     deletion_sizes = variant_payload['deletion_sizes']
                     all_deletion_positions = variant_payload['all_deletion_positions']
                     deletion_positions = variant_payload['deletion_positions']
-                    all_substitution_positions = variant_payload['all_substitution_positions']
                     substitution_positions = variant_payload['substitution_positions']
 
                     length_modified_positions_exons = []
                     current_read_exons_modified = False
                     current_read_spliced_modified = False
 
+                    CRISPRessoCOREResources.tally_lengths(insertion_length_vectors[ref_name], insertion_coordinates, insertion_sizes, variant_count, False)
                     for idx_ins, (ins_start, ins_end) in enumerate(insertion_coordinates):
-                        insertion_length_vectors[ref_name][ins_start] += (insertion_sizes[idx_ins] * variant_count)
-                        insertion_length_vectors[ref_name][ins_end] += (insertion_sizes[idx_ins] * variant_count)
-
                         if refs[ref_name]['contains_coding_seq']:
                             if set(exon_positions).intersection((ins_start, ins_end)):  # check that we are inserting in one exon
                                 current_read_exons_modified = True
                                 set1 = set(exon_positions).intersection((ins_start, ins_end))
                                 length_modified_positions_exons.append((insertion_sizes[idx_ins]))
 
-                    for idx_del, (del_start, del_end) in enumerate(deletion_coordinates):
-                        deletion_length_vectors[ref_name][list(range(del_start, del_end))] += (deletion_sizes[idx_del] * variant_count)
+                    CRISPRessoCOREResources.tally_lengths(deletion_length_vectors[ref_name], deletion_coordinates, deletion_sizes, variant_count, True)
 
                     if refs[ref_name]['contains_coding_seq']:
                         del_positions_to_append = sorted(set(exon_positions).intersection(set(deletion_positions)))
@@ -4165,9 +4984,9 @@ def main():
                         # the indels and subtitutions are outside the exon/s  so we don't care!
                         else:
                             counts_non_modified_non_frameshift[ref_name] += variant_count
-                            insertion_count_vectors_noncoding[ref_name][insertion_positions] += variant_count
-                            deletion_count_vectors_noncoding[ref_name][deletion_positions] += variant_count
-                            substitution_count_vectors_noncoding[ref_name][substitution_positions] += variant_count
+                            CRISPRessoCOREResources.tally_positions(insertion_count_vectors_noncoding[ref_name], insertion_positions, variant_count)
+                            CRISPRessoCOREResources.tally_positions(deletion_count_vectors_noncoding[ref_name], deletion_positions, variant_count)
+                            CRISPRessoCOREResources.tally_positions(substitution_count_vectors_noncoding[ref_name], substitution_positions, variant_count)
                             hists_inframe[ref_name][0] += variant_count
                 # if unmodified but the tot_exon_len_mod is != 0
                 elif tot_exon_len_mod != 0:
@@ -4195,6 +5014,7 @@ def main():
         if args.expected_hdr_amplicon_seq != "" or args.prime_editing_pegRNA_extension_seq != "":
             ref1_name = ref_names[0]
             ref1_len = refs[ref1_name]['sequence_length']
+            ref1_include_mask = CRISPRessoCOREResources.get_include_mask(refs[ref1_name]['include_idxs'], ref1_len)
 
             ref1_all_insertion_count_vectors = {}  # all insertions (including quantification window bases) with respect to ref1
             ref1_all_insertion_left_count_vectors = {}  # 'all_insertion_left_positions' #arr with 1's to the left of where the insertion occurs
@@ -4202,6 +5022,7 @@ def main():
             ref1_all_substitution_count_vectors = {}
             ref1_all_indelsub_count_vectors = {}
             ref1_all_base_count_vectors = {}
+            ref1_all_base_count_matrices = {}
 
             for ref_name in ref_names:
                 ref1_all_insertion_count_vectors[ref_name] = np.zeros(ref1_len)
@@ -4210,8 +5031,9 @@ def main():
                 ref1_all_substitution_count_vectors[ref_name] = np.zeros(ref1_len)
                 ref1_all_indelsub_count_vectors[ref_name] = np.zeros(ref1_len)
 
+                ref1_all_base_count_matrices[ref_name] = np.zeros((len(CRISPRessoCOREResources.TALLY_NUCS), ref1_len))
                 for nuc in ['A', 'C', 'G', 'T', 'N', '-']:
-                    ref1_all_base_count_vectors[ref_name + "_" + nuc] = np.zeros(ref1_len)
+                    ref1_all_base_count_vectors[ref_name + "_" + nuc] = ref1_all_base_count_matrices[ref_name][CRISPRessoCOREResources.TALLY_NUCS.index(nuc)]
 
             # for ref1 we will add all other indels to indels that have already been found..
             ref1_all_insertion_count_vectors[ref_names[0]] = all_insertion_count_vectors[ref_names[0]].copy()
@@ -4244,7 +5066,7 @@ def main():
                 if args.use_legacy_insertion_quantification:
                     payload = CRISPRessoCOREResources.find_indels_substitutions_legacy(s1, s2, refs[ref1_name]['include_idxs'])
                 else:
-                    payload = CRISPRessoCOREResources.find_indels_substitutions(s1, s2, refs[ref1_name]['include_idxs'])
+                    payload = CRISPRessoCOREResources.find_indels_substitutions(s1, s2, refs[ref1_name]['include_idxs'], ref1_include_mask)
 
                 # indels in this alignment against ref1 should be recorded for each ref it was originally assigned to, as well as for ref1
                 # for example, if this read aligned to ref3, align this read to ref1, and add the resulting indels to ref1_all_insertion_count_vectors[ref3] as well as ref1_all_insertion_count_vectors[ref1]
@@ -4253,23 +5075,17 @@ def main():
                 for ref_name in aln_ref_names:
                     if ref_name == ref_names[0]:
                         continue
-                    ref1_all_insertion_count_vectors[ref_name][payload['all_insertion_positions']] += variant_count
-                    ref1_all_insertion_left_count_vectors[ref_name][payload['all_insertion_left_positions']] += variant_count
-                    ref1_all_indelsub_count_vectors[ref_name][payload['all_insertion_positions']] += variant_count
+                    CRISPRessoCOREResources.tally_positions(ref1_all_insertion_count_vectors[ref_name], payload['all_insertion_positions'], variant_count)
+                    CRISPRessoCOREResources.tally_positions(ref1_all_insertion_left_count_vectors[ref_name], payload['all_insertion_left_positions'], variant_count)
+                    CRISPRessoCOREResources.tally_positions(ref1_all_indelsub_count_vectors[ref_name], payload['all_insertion_positions'], variant_count)
 
-                    ref1_all_deletion_count_vectors[ref_name][payload['all_deletion_positions']] += variant_count
-                    ref1_all_indelsub_count_vectors[ref_name][payload['all_deletion_positions']] += variant_count
+                    CRISPRessoCOREResources.tally_positions(ref1_all_deletion_count_vectors[ref_name], payload['all_deletion_positions'], variant_count)
+                    CRISPRessoCOREResources.tally_positions(ref1_all_indelsub_count_vectors[ref_name], payload['all_deletion_positions'], variant_count)
 
-                    ref1_all_substitution_count_vectors[ref_name][payload['all_substitution_positions']] += variant_count
-                    ref1_all_indelsub_count_vectors[ref_name][payload['all_substitution_positions']] += variant_count
+                    CRISPRessoCOREResources.tally_positions(ref1_all_substitution_count_vectors[ref_name], payload['all_substitution_positions'], variant_count)
+                    CRISPRessoCOREResources.tally_positions(ref1_all_indelsub_count_vectors[ref_name], payload['all_substitution_positions'], variant_count)
 
-                    aln_seq = s1
-                    ref_pos = payload['ref_positions']
-                    for i in range(len(aln_seq)):
-                        if ref_pos[i] < 0:
-                            continue
-                        nuc = aln_seq[i]
-                        ref1_all_base_count_vectors[ref_name + "_" + nuc][ref_pos[i]] += variant_count
+                    CRISPRessoCOREResources.tally_bases(ref1_all_base_count_matrices[ref_name], s1, payload['ref_positions'], variant_count)
 
         info('Done!', {'percent_complete': 30})
 
@@ -4802,6 +5618,8 @@ def main():
             variantCache, not_aln_variant_objects,
             alleles_homology_scores_filename,
         )
+        if isinstance(variantCache, CRISPRessoVariantStore.VariantStore):
+            variantCache.close()
 
         # --- Pre-compute alternate allele counts (for plots 10b/10c) ---
         alt_nuc_counts_by_ref = {}
@@ -5572,6 +6390,19 @@ def main():
         crispresso2_info['results']['alignment_stats']['counts_non_modified_non_frameshift'] = counts_non_modified_non_frameshift
         crispresso2_info['results']['alignment_stats']['counts_splicing_sites_modified'] = counts_splicing_sites_modified
         crispresso2_info['results']['alignment_stats']['class_counts'] = class_counts
+        if 'convergence' in aln_stats:
+            convergence = aln_stats['convergence']
+            convergence['modified_frequency_intervals'] = {ref_name: get_frequency_interval(counts_modified[ref_name], counts_total[ref_name]) for ref_name in ref_names if counts_total[ref_name] > 0}
+            if convergence['n_reads_analyzed'] < convergence['n_reads']:
+                convergence['message'] = 'These results are an estimate from %d randomly drawn reads of the %d reads after preprocessing.' % (convergence['n_reads_analyzed'], convergence['n_reads'])
+                if convergence['converged']:
+                    convergence['message'] += ' The 95%% confidence interval of the modified frequency of each amplicon is within +/-%s.' % (convergence['precision'])
+                else:
+                    convergence['message'] += ' The maximum number of reads (--convergence_max_reads) was reached before the 95%% confidence interval of the modified frequency of each amplicon was within +/-%s.' % (convergence['precision'])
+                warn(convergence['message'])
+            else:
+                convergence['message'] = 'All %d reads after preprocessing were analyzed.' % (convergence['n_reads'])
+            crispresso2_info['results']['alignment_stats']['convergence'] = convergence
 
         end_time = datetime.now()
         end_time_string = end_time.strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,2 @@
+cdef object find_edits(const unsigned char* read_seq_al, const unsigned char* ref_seq_al, Py_ssize_t seq_len, Py_ssize_t step,
+                       const unsigned char[::1] include_mask)
@@ -1,7 +1,10 @@
 import cython
 import numpy as np
 cimport numpy as np
+import gzip
 import re
+from array import array
+from libc.limits cimport LLONG_MIN, LLONG_MAX
 
 cdef extern from "stdlib.h":
     ctypedef unsigned int size_t
@@ -15,61 +18,250 @@ cdef extern from "Python.h":
 
 re_find_indels = re.compile("(-*-)")
 
-class ResultsSlotsDict():
-    __slots__ = (
-        'all_insertion_positions',
-        'all_insertion_left_positions',
-        'insertion_positions',
-        'insertion_coordinates',
-        'insertion_sizes',
-        'insertion_n',
-        'all_deletion_positions',
-        'all_deletion_coordinates',
-        'deletion_positions',
-        'deletion_coordinates',
-        'deletion_sizes',
-        'deletion_n',
-        'all_substitution_positions',
-        'substitution_positions',
-        'all_substitution_values',
-        'substitution_values',
-        'substitution_n',
-        'ref_positions',
-        'ref_name',
-        'aln_scores',
-        'classification',
-        'aln_seq',
-        'aln_ref',
-        'aln_strand',
-        'irregular_ends',
-        'insertions_outside_window',
-        'deletions_outside_window',
-        'substitutions_outside_window',
-        'total_mods',
-        'mods_in_window',
-        'mods_outside_window',
-    )
+RESULTS_FIELDS = (
+    'all_insertion_positions',
+    'all_insertion_left_positions',
+    'insertion_positions',
+    'insertion_coordinates',
+    'insertion_sizes',
+    'insertion_n',
+    'all_deletion_positions',
+    'all_deletion_coordinates',
+    'deletion_positions',
+    'deletion_coordinates',
+    'deletion_sizes',
+    'deletion_n',
+    'all_substitution_positions',
+    'substitution_positions',
+    'all_substitution_values',
+    'substitution_values',
+    'substitution_n',
+    'ref_positions',
+    'ref_name',
+    'aln_scores',
+    'classification',
+    'aln_seq',
+    'aln_ref',
+    'aln_strand',
+    'irregular_ends',
+    'insertions_outside_window',
+    'deletions_outside_window',
+    'substitutions_outside_window',
+    'total_mods',
+    'mods_in_window',
+    'mods_outside_window',
+)
+#counts that are always integers, kept as C integers (the other counts of paired reads may be floats)
+COUNT_FIELDS = ('insertion_n', 'deletion_n', 'substitution_n', 'deletions_outside_window', 'substitutions_outside_window', 'mods_in_window')
+#fields of integer lists and of (start, end) tuple lists, pickled as int32 bytes, and of substitution value arrays, pickled as strings
+PICKLED_INT_LIST_FIELDS = (
+    'all_insertion_positions', 'all_insertion_left_positions', 'insertion_positions', 'insertion_sizes',
+    'all_deletion_positions', 'deletion_positions', 'deletion_sizes',
+    'all_substitution_positions', 'substitution_positions', 'ref_positions',
+)
+PICKLED_COORDINATE_FIELDS = ('insertion_coordinates', 'all_deletion_coordinates', 'deletion_coordinates')
+PICKLED_VALUE_FIELDS = ('all_substitution_values', 'substitution_values')
+
+cdef enum:
+    N_RESULTS_FIELDS = 31
+    FIELD_OBJECT = 0
+    FIELD_COUNT = 1
+    FIELD_INT_LIST = 2
+    FIELD_COORDINATES = 3
+    FIELD_VALUES = 4
+
+cdef dict _RESULTS_FIELD_INDEX = {field: idx for idx, field in enumerate(RESULTS_FIELDS)}
+cdef int _RESULTS_FIELD_KINDS[N_RESULTS_FIELDS]
+for _idx, _field in enumerate(RESULTS_FIELDS):
+    _RESULTS_FIELD_KINDS[_idx] = (FIELD_COUNT if _field in COUNT_FIELDS else FIELD_INT_LIST if _field in PICKLED_INT_LIST_FIELDS
+                                  else FIELD_COORDINATES if _field in PICKLED_COORDINATE_FIELDS else FIELD_VALUES if _field in PICKLED_VALUE_FIELDS
+                                  else FIELD_OBJECT)
+
+
+cdef class ResultsSlotsDict:
+    """
+    Modifications of the alignment of a read to a reference, read and written like a dict with the keys of RESULTS_FIELDS.
+    Fields that haven't been set raise AttributeError, and __dict__ holds the fields that have been set.
+    The counts of COUNT_FIELDS are kept as C integers if they are ints, and all other values as Python objects.
+    Pickles store the integer lists and coordinates as int32 bytes and the substitution values as strings.
+    """
+    __slots__ = RESULTS_FIELDS
+
+    cdef list _values
+    cdef long long _counts[N_RESULTS_FIELDS]
+    cdef unsigned long long _set_fields
+    cdef unsigned long long _native_counts
+
+    def __cinit__(self):
+        self._values = [None] * N_RESULTS_FIELDS
+        self._set_fields = 0
+        self._native_counts = 0
 
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
-            setattr(self, key, value)
+            self._set(self._index(key), value)
+
+    cdef inline Py_ssize_t _index(self, key) except -1:
+        idx = _RESULTS_FIELD_INDEX.get(key)
+        if idx is None:
+            raise AttributeError("'ResultsSlotsDict' object has no attribute '%s'" % (key,))
+        return idx
+
+    cdef int _set(self, Py_ssize_t idx, value) except -1:
+        if _RESULTS_FIELD_KINDS[idx] == FIELD_COUNT and type(value) is int and LLONG_MIN <= value <= LLONG_MAX:
+            self._counts[idx] = value
+            self._values[idx] = None
+            self._native_counts |= 1ULL << idx
+        else:
+            self._values[idx] = value
+            self._native_counts &= ~(1ULL << idx)
+        self._set_fields |= 1ULL << idx
+        return 0
+
+    cdef object _get(self, Py_ssize_t idx):
+        if not (self._set_fields >> idx) & 1:
+            raise AttributeError(RESULTS_FIELDS[idx])
+        if (self._native_counts >> idx) & 1:
+            return self._counts[idx]
+        return self._values[idx]
 
     def __getitem__(self, key):
-        return getattr(self, key)
+        return self._get(self._index(key))
 
     def __setitem__(self, key, value):
-        setattr(self, key, value)
+        self._set(self._index(key), value)
+
+    def __getattr__(self, key):
+        return self._get(self._index(key))
 
     @property
     def __dict__(self):
-        return {key: getattr(self, key) for key in self.__slots__ if hasattr(self, key)}
+        return {RESULTS_FIELDS[idx]: self._get(idx) for idx in range(N_RESULTS_FIELDS) if (self._set_fields >> idx) & 1}
+
+    def __reduce__(self):
+        cdef Py_ssize_t idx
+        values = []
+        for idx in range(N_RESULTS_FIELDS):
+            if not (self._set_fields >> idx) & 1:
+                values.append(None)
+            elif (self._native_counts >> idx) & 1:
+                values.append(self._counts[idx])
+            elif _RESULTS_FIELD_KINDS[idx] == FIELD_INT_LIST:
+                values.append(_pack_int_list(self._values[idx]))
+            elif _RESULTS_FIELD_KINDS[idx] == FIELD_COORDINATES:
+                values.append(_pack_coordinates(self._values[idx]))
+            elif _RESULTS_FIELD_KINDS[idx] == FIELD_VALUES:
+                values.append(_pack_values(self._values[idx]))
+            else:
+                values.append(self._values[idx])
+        return (_unpickle_results_slots_dict, (self._set_fields, tuple(values)))
+
+
+cdef object _pack_int_list(value):
+    """
+    Pack a list of integers as int32 bytes for pickling, or return any other value unchanged.
+    """
+    if type(value) is not list:
+        return value
+    try:
+        return array('i', value).tobytes()
+    except (TypeError, OverflowError):
+        return value
+
+
+cdef object _pack_coordinates(value):
+    """
+    Pack a list of (start, end) tuples of integers as int32 bytes for pickling, or return any other value unchanged.
+    """
+    if type(value) is not list:
+        return value
+    for coordinates in value:
+        if type(coordinates) is not tuple or len(<tuple> coordinates) != 2:
+            return value
+    try:
+        return array('i', [position for coordinates in value for position in coordinates]).tobytes()
+    except (TypeError, OverflowError):
+        return value
+
+
+cdef object _pack_values(value):
+    """
+    Pack a one-dimensional array of one-letter strings (or an empty array) as a tuple of its dtype and its letters for
+    pickling, or return any other value unchanged.
+    """
+    if type(value) is not np.ndarray or value.ndim != 1:
+        return value
+    if value.dtype.str == '<U1':
+        return (value.dtype.str, ''.join(value.tolist()))
+    if value.shape[0] == 0:
+        return (value.dtype.str, '')
+    return value
+
+
+def _unpickle_results_slots_dict(unsigned long long set_fields, tuple values):
+    """
+    Rebuild a pickled ResultsSlotsDict from the fields that were set and their values (see ResultsSlotsDict.__reduce__).
+    """
+    cdef ResultsSlotsDict results = ResultsSlotsDict.__new__(ResultsSlotsDict)
+    cdef Py_ssize_t idx
+    for idx in range(N_RESULTS_FIELDS):
+        if not (set_fields >> idx) & 1:
+            continue
+        value = values[idx]
+        if type(value) is bytes and _RESULTS_FIELD_KINDS[idx] in (FIELD_INT_LIST, FIELD_COORDINATES):
+            positions = array('i')
+            positions.frombytes(value)
+            value = positions.tolist()
+            if _RESULTS_FIELD_KINDS[idx] == FIELD_COORDINATES:
+                value = list(zip(value[::2], value[1::2]))
+        elif type(value) is tuple and _RESULTS_FIELD_KINDS[idx] == FIELD_VALUES:
+            value = np.array(list(value[1]), dtype=value[0])
+        results._set(idx, value)
+    return results
+
+
+def get_include_mask(include_idxs, length):
+    """
+    Return the window mask of include_idxs: a uint8 array of length values that are 1 at the positions in include_idxs
+    (positions outside of [0, length) are left out).
+    """
+    include_mask = np.zeros(length, dtype=np.uint8)
+    positions = np.asarray(include_idxs, dtype=np.int64)
+    include_mask[positions[(positions >= 0) & (positions < length)]] = 1
+    return include_mask
+
+
+cdef inline bint _in_window(const unsigned char* include_mask, Py_ssize_t mask_length, Py_ssize_t position):
+    return 0 <= position < mask_length and include_mask[position]
+
+
+def find_indels_substitutions_arrays(const unsigned char[::1] read_seq_al, const unsigned char[::1] ref_seq_al, const unsigned char[::1] include_mask):
+    """
+    Find the insertions, deletions and substitutions of an alignment, as find_indels_substitutions does, in one pass over
+    the aligned sequences as bytes, with the quantification window given as a mask (see get_include_mask).
+
+    Returns a ResultsSlotsDict with the same fields as find_indels_substitutions, where the position and size fields are
+    int32 arrays, the coordinate fields are int32 arrays of (start, end) rows, and the substitution values are arrays of
+    one-letter strings.
+    """
+    cdef Py_ssize_t seq_len = ref_seq_al.shape[0]
+    if read_seq_al.shape[0] != seq_len:
+        raise ValueError('The aligned sequences must have the same length')
+    if seq_len == 0:
+        return find_edits(NULL, NULL, 0, 1, include_mask)
+    return find_edits(&read_seq_al[0], &ref_seq_al[0], seq_len, 1, include_mask)
 
 
 @cython.boundscheck(False)
 @cython.nonecheck(False)
 @cython.wraparound(False)
-def find_indels_substitutions(read_seq_al, ref_seq_al, _include_indx):
-
+cdef object find_edits(const unsigned char* read_seq_al, const unsigned char* ref_seq_al, Py_ssize_t seq_len, Py_ssize_t step,
+                       const unsigned char[::1] include_mask):
+    """
+    Find the modifications of the alignment of seq_len positions in read_seq_al and ref_seq_al, reading position k of the
+    alignment at offset k * step, so that the reversed alignments written by a traceback can be read with a step of -1.
+    Returns the ResultsSlotsDict of find_indels_substitutions_arrays.
+    """
     #ref_positions holds the indices for which positions map back to the original reference
     # for example,
     #     1 2 3 4 5 6 7 8
@@ -79,114 +271,193 @@ def find_indels_substitutions(read_seq_al, ref_seq_al, _include_indx):
     # ref A A T T - G G C C
     # aln A - T T T G G C C
     #     1 2 3 4-4 5 6 7 8 <ref positions. Note that the negative values/indices represent places that don't map back to the original reference
-    ref_positions=[]
-    all_substitution_positions=[]
-    substitution_positions=[]
-    all_substitution_values=[]
-    substitution_values=[]
+    cdef const unsigned char* mask = &include_mask[0] if include_mask.shape[0] > 0 else NULL
+    cdef Py_ssize_t mask_length = include_mask.shape[0]
 
-    all_deletion_positions = []
-    all_deletion_coordinates = []
-    deletion_positions = []
-    deletion_coordinates = []
-    deletion_sizes = []
-    cdef int start_deletion = -1  # the -1 value indicates that there currently isn't a deletion
+    ref_positions_array = np.empty(seq_len, dtype=np.int32)
+    all_substitution_positions_array = np.empty(seq_len, dtype=np.int32)
+    substitution_positions_array = np.empty(seq_len, dtype=np.int32)
+    all_substitution_values_array = np.empty(seq_len, dtype=np.uint8)
+    substitution_values_array = np.empty(seq_len, dtype=np.uint8)
+    all_deletion_positions_array = np.empty(seq_len, dtype=np.int32)
+    all_deletion_coordinates_array = np.empty((seq_len, 2), dtype=np.int32)
+    deletion_positions_array = np.empty(seq_len, dtype=np.int32)
+    deletion_coordinates_array = np.empty((seq_len, 2), dtype=np.int32)
+    deletion_sizes_array = np.empty(seq_len, dtype=np.int32)
+    all_insertion_positions_array = np.empty(2 * seq_len, dtype=np.int32)
+    all_insertion_left_positions_array = np.empty(seq_len, dtype=np.int32)
+    insertion_positions_array = np.empty(2 * seq_len, dtype=np.int32)
+    insertion_coordinates_array = np.empty((seq_len, 2), dtype=np.int32)
+    insertion_sizes_array = np.empty(seq_len, dtype=np.int32)
 
-    all_insertion_positions = []
-    all_insertion_left_positions = []
-    insertion_positions = []
-    insertion_coordinates = []
-    insertion_sizes = []
-    cdef int start_insertion = -1  # the -1 value indicates that there currently isn't an insertion
+    cdef int[::1] ref_positions = ref_positions_array
+    cdef int[::1] all_substitution_positions = all_substitution_positions_array
+    cdef int[::1] substitution_positions = substitution_positions_array
+    cdef unsigned char[::1] all_substitution_values = all_substitution_values_array
+    cdef unsigned char[::1] substitution_values = substitution_values_array
+    cdef int[::1] all_deletion_positions = all_deletion_positions_array
+    cdef int[:, ::1] all_deletion_coordinates = all_deletion_coordinates_array
+    cdef int[::1] deletion_positions = deletion_positions_array
+    cdef int[:, ::1] deletion_coordinates = deletion_coordinates_array
+    cdef int[::1] deletion_sizes = deletion_sizes_array
+    cdef int[::1] all_insertion_positions = all_insertion_positions_array
+    cdef int[::1] all_insertion_left_positions = all_insertion_left_positions_array
+    cdef int[::1] insertion_positions = insertion_positions_array
+    cdef int[:, ::1] insertion_coordinates = insertion_coordinates_array
+    cdef int[::1] insertion_sizes = insertion_sizes_array
 
-    cdef size_t seq_len = len(ref_seq_al)
-    include_indx_set = set(_include_indx)
-    nucSet = set(['A', 'T', 'C', 'G', 'N'])
+    cdef Py_ssize_t n_all_substitutions = 0, n_substitutions = 0
+    cdef Py_ssize_t n_all_deletion_positions = 0, n_all_deletions = 0, n_deletion_positions = 0, n_deletions = 0
+    cdef Py_ssize_t n_all_insertions = 0, n_insertions = 0
+    cdef Py_ssize_t deletion_n = 0, insertion_n = 0
+    cdef int start_deletion = -1  # the -1 value indicates that there currently isn't a deletion
+    cdef int start_insertion = -1  # the -1 value indicates that there currently isn't an insertion
+    cdef int end_deletion, position
     cdef int idx = 0
-    cdef int idx_c
     cdef int current_insertion_size = 0
-    for idx_c, c in enumerate(ref_seq_al):
-        if c != '-':
-            ref_positions.append(idx)
-            if ref_seq_al[idx_c]!=read_seq_al[idx_c] and read_seq_al[idx_c] != '-' and read_seq_al[idx_c] != 'N':
-                all_substitution_positions.append(idx)
-                all_substitution_values.append(read_seq_al[idx_c])
-                if idx in _include_indx:
-                    substitution_positions.append(idx)
-                    substitution_values.append(read_seq_al[idx_c])
+    cdef Py_ssize_t idx_c
+    cdef unsigned char c, read_c
+    cdef bint in_window
+
+    for idx_c in range(seq_len):
+        c = ref_seq_al[idx_c * step]
+        read_c = read_seq_al[idx_c * step]
+        if c != b'-':
+            ref_positions[idx_c] = idx
+            if c != read_c and read_c != b'-' and read_c != b'N':
+                all_substitution_positions[n_all_substitutions] = idx
+                all_substitution_values[n_all_substitutions] = read_c
+                n_all_substitutions += 1
+                if _in_window(mask, mask_length, idx):
+                    substitution_positions[n_substitutions] = idx
+                    substitution_values[n_substitutions] = read_c
+                    n_substitutions += 1
             if start_insertion != -1:  # this is the end of an insertion
-                all_insertion_left_positions.append(start_insertion)
-                all_insertion_positions.append(start_insertion)
-                all_insertion_positions.append(idx)
-                if start_insertion in include_indx_set and idx in include_indx_set:
-                    insertion_coordinates.append((start_insertion, idx))
-                    insertion_positions.append(start_insertion)
-                    insertion_positions.append(idx)
-                    insertion_sizes.append(current_insertion_size)
+                all_insertion_left_positions[n_all_insertions] = start_insertion
+                all_insertion_positions[2 * n_all_insertions] = start_insertion
+                all_insertion_positions[2 * n_all_insertions + 1] = idx
+                n_all_insertions += 1
+                if _in_window(mask, mask_length, start_insertion) and _in_window(mask, mask_length, idx):
+                    insertion_coordinates[n_insertions, 0] = start_insertion
+                    insertion_coordinates[n_insertions, 1] = idx
+                    insertion_positions[2 * n_insertions] = start_insertion
+                    insertion_positions[2 * n_insertions + 1] = idx
+                    insertion_sizes[n_insertions] = current_insertion_size
+                    insertion_n += current_insertion_size
+                    n_insertions += 1
                 start_insertion = -1
             current_insertion_size = 0
             idx += 1
         else:  # the current ref position is -
             if idx == 0:
-                ref_positions.append(-1)
+                ref_positions[idx_c] = -1
             else:
-                ref_positions.append(-idx)
+                ref_positions[idx_c] = -idx
             if idx > 0 and start_insertion == -1:  # this is the first index of an insertion
                 start_insertion = idx - 1
             current_insertion_size += 1
 
-        if read_seq_al[idx_c] == '-' and start_deletion == -1:  # this is the first part of a deletion
+        if read_c == b'-' and start_deletion == -1:  # this is the first part of a deletion
             if idx_c - 1 >= 0:
                 start_deletion = ref_positions[idx_c]
             else:
                 start_deletion = 0
-        elif read_seq_al[idx_c] != '-' and start_deletion != -1:  # this is the end of a deletion
+        elif read_c != b'-' and start_deletion != -1:  # this is the end of a deletion
             end_deletion = ref_positions[idx_c]
-            all_deletion_positions.extend(range(start_deletion, end_deletion))
-            all_deletion_coordinates.append((start_deletion, end_deletion))
-            if include_indx_set.intersection(range(start_deletion, end_deletion)):
-                deletion_positions.extend(range(start_deletion, end_deletion))
-                deletion_coordinates.append((start_deletion, end_deletion))
-                deletion_sizes.append(end_deletion - start_deletion)
+            _add_deletion(start_deletion, end_deletion, mask, mask_length, all_deletion_positions, all_deletion_coordinates,
+                          deletion_positions, deletion_coordinates, deletion_sizes, &n_all_deletion_positions, &n_all_deletions,
+                          &n_deletion_positions, &n_deletions, &deletion_n)
             start_deletion = -1
 
     if start_deletion != -1:
-        end_deletion = ref_positions[seq_len - 1]
-        all_deletion_positions.extend(range(start_deletion, end_deletion + 1))
-        all_deletion_coordinates.append((start_deletion, end_deletion + 1))
-        if include_indx_set.intersection(range(start_deletion, end_deletion + 1)):
-            deletion_positions.extend(range(start_deletion, end_deletion + 1))
-            deletion_coordinates.append((start_deletion, end_deletion + 1))
-            deletion_sizes.append((end_deletion + 1) - start_deletion)
-    cdef size_t substitution_n = len(substitution_positions)
-    cdef size_t deletion_n = sum(deletion_sizes)
-    cdef size_t insertion_n = sum(insertion_sizes)
+        end_deletion = ref_positions[seq_len - 1] + 1
+        _add_deletion(start_deletion, end_deletion, mask, mask_length, all_deletion_positions, all_deletion_coordinates,
+                      deletion_positions, deletion_coordinates, deletion_sizes, &n_all_deletion_positions, &n_all_deletions,
+                      &n_deletion_positions, &n_deletions, &deletion_n)
 
     return ResultsSlotsDict(
-        all_insertion_positions=all_insertion_positions,
-        all_insertion_left_positions=all_insertion_left_positions,
-        insertion_positions=insertion_positions,
-        insertion_coordinates=insertion_coordinates,
-        insertion_sizes=insertion_sizes,
+        all_insertion_positions=all_insertion_positions_array[:2 * n_all_insertions].copy(),
+        all_insertion_left_positions=all_insertion_left_positions_array[:n_all_insertions].copy(),
+        insertion_positions=insertion_positions_array[:2 * n_insertions].copy(),
+        insertion_coordinates=insertion_coordinates_array[:n_insertions].copy(),
+        insertion_sizes=insertion_sizes_array[:n_insertions].copy(),
         insertion_n=insertion_n,
 
-        all_deletion_positions=all_deletion_positions,
-        all_deletion_coordinates=all_deletion_coordinates,
-        deletion_positions=deletion_positions,
-        deletion_coordinates=deletion_coordinates,
-        deletion_sizes=deletion_sizes,
+        all_deletion_positions=all_deletion_positions_array[:n_all_deletion_positions].copy(),
+        all_deletion_coordinates=all_deletion_coordinates_array[:n_all_deletions].copy(),
+        deletion_positions=deletion_positions_array[:n_deletion_positions].copy(),
+        deletion_coordinates=deletion_coordinates_array[:n_deletions].copy(),
+        deletion_sizes=deletion_sizes_array[:n_deletions].copy(),
         deletion_n=deletion_n,
 
-        all_substitution_positions=all_substitution_positions,
-        substitution_positions=substitution_positions,
-        all_substitution_values=np.array(all_substitution_values),
-        substitution_values=np.array(substitution_values),
-        substitution_n=substitution_n,
+        all_substitution_positions=all_substitution_positions_array[:n_all_substitutions].copy(),
+        substitution_positions=substitution_positions_array[:n_substitutions].copy(),
+        all_substitution_values=all_substitution_values_array[:n_all_substitutions].view('S1').astype('U1'),
+        substitution_values=substitution_values_array[:n_substitutions].view('S1').astype('U1'),
+        substitution_n=n_substitutions,
 
-        ref_positions=ref_positions,
+        ref_positions=ref_positions_array,
     )
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _add_deletion(int start_deletion, int end_deletion, const unsigned char* mask, Py_ssize_t mask_length,
+                               int[::1] all_deletion_positions, int[:, ::1] all_deletion_coordinates,
+                               int[::1] deletion_positions, int[:, ::1] deletion_coordinates, int[::1] deletion_sizes,
+                               Py_ssize_t* n_all_deletion_positions, Py_ssize_t* n_all_deletions,
+                               Py_ssize_t* n_deletion_positions, Py_ssize_t* n_deletions, Py_ssize_t* deletion_n):
+    cdef int position
+    cdef bint in_window = False
+    for position in range(start_deletion, end_deletion):
+        all_deletion_positions[n_all_deletion_positions[0]] = position
+        n_all_deletion_positions[0] += 1
+        if _in_window(mask, mask_length, position):
+            in_window = True
+    all_deletion_coordinates[n_all_deletions[0], 0] = start_deletion
+    all_deletion_coordinates[n_all_deletions[0], 1] = end_deletion
+    n_all_deletions[0] += 1
+    if in_window:
+        for position in range(start_deletion, end_deletion):
+            deletion_positions[n_deletion_positions[0]] = position
+            n_deletion_positions[0] += 1
+        deletion_coordinates[n_deletions[0], 0] = start_deletion
+        deletion_coordinates[n_deletions[0], 1] = end_deletion
+        deletion_sizes[n_deletions[0]] = end_deletion - start_deletion
+        deletion_n[0] += end_deletion - start_deletion
+        n_deletions[0] += 1
+
+
+def find_indels_substitutions(read_seq_al, ref_seq_al, _include_indx, include_mask=None):
+    """
+    Find the insertions, deletions and substitutions of the alignment of a read (read_seq_al) to a reference (ref_seq_al).
+    Modifications at the positions of _include_indx (the quantification window) are also reported in the fields without 'all_'.
+    include_mask is the mask of _include_indx from get_include_mask, computed from _include_indx if not given.
+
+    Returns a ResultsSlotsDict of the positions, coordinates and sizes of the modifications as lists (see
+    find_indels_substitutions_arrays for the typed arrays).
+    """
+    if include_mask is None:
+        include_mask = get_include_mask(_include_indx, len(ref_seq_al))
+    return payload_to_lists(find_indels_substitutions_arrays(read_seq_al.encode('ascii'), ref_seq_al.encode('ascii'), include_mask))
+
+
+def payload_to_lists(payload):
+    """
+    Convert the typed arrays of a payload from find_indels_substitutions_arrays (or Aligner.align_edits) in place to the
+    lists and tuples returned by find_indels_substitutions, and return the payload.
+    """
+    for field in ('all_insertion_positions', 'all_insertion_left_positions', 'insertion_positions', 'insertion_sizes',
+                  'all_deletion_positions', 'deletion_positions', 'deletion_sizes',
+                  'all_substitution_positions', 'substitution_positions', 'ref_positions'):
+        payload[field] = payload[field].tolist()
+    for field in ('insertion_coordinates', 'all_deletion_coordinates', 'deletion_coordinates'):
+        payload[field] = [tuple(coordinates) for coordinates in payload[field].tolist()]
+    for field in ('all_substitution_values', 'substitution_values'):
+        payload[field] = np.array(payload[field].tolist())
+    return payload
+
+
 @cython.boundscheck(False)
 @cython.nonecheck(False)
 @cython.wraparound(False)
@@ -325,3 +596,737 @@ def calculate_homology(a, b):
         if al[i] == bl[i]:
             score+=1
     return score/l
+
+
+cdef class SeedMatcher:
+    """
+    Aho-Corasick automaton over the forward and reverse complement alignment seeds of several references.
+    count_seeds finds which seeds occur in a read in a single pass over the read, instead of one substring search per seed.
+
+    fw_seeds: list with the list of forward seeds of each reference
+    rc_seeds: list with the list of reverse complement seeds of each reference
+    """
+    cdef readonly list fw_seeds
+    cdef readonly list rc_seeds
+    cdef readonly int n_refs
+    cdef int n_codes
+    cdef int n_patterns
+    cdef np.ndarray char_codes_array
+    cdef np.ndarray transitions_array
+    cdef np.ndarray output_starts_array
+    cdef np.ndarray outputs_array
+    cdef np.ndarray hit_starts_array
+    cdef np.ndarray hits_array
+    cdef const unsigned char[:] char_codes
+    cdef const int[:] transitions
+    cdef const int[:] output_starts
+    cdef const int[:] outputs
+    cdef const int[:] hit_starts
+    cdef const int[:] hits
+
+    def __init__(self, fw_seeds, rc_seeds):
+        self.fw_seeds = [list(seeds) for seeds in fw_seeds]
+        self.rc_seeds = [list(seeds) for seeds in rc_seeds]
+        self.n_refs = len(self.fw_seeds)
+
+        # each distinct seed is one pattern; a pattern hits strand 2 * ref (forward) or 2 * ref + 1 (reverse complement) once per occurrence in the seed lists
+        pattern_ids = {}
+        pattern_hits = []
+        for ref_idx in range(self.n_refs):
+            for strand, seeds in ((0, self.fw_seeds[ref_idx]), (1, self.rc_seeds[ref_idx])):
+                for seed in seeds:
+                    if seed not in pattern_ids:
+                        pattern_ids[seed] = len(pattern_ids)
+                        pattern_hits.append([])
+                    pattern_hits[pattern_ids[seed]].append(2 * ref_idx + strand)
+        self.n_patterns = len(pattern_ids)
+
+        # characters that don't occur in any seed share code 0
+        codes = {}
+        for seed in pattern_ids:
+            for c in seed.encode('UTF-8'):
+                if c not in codes:
+                    codes[c] = len(codes) + 1
+        self.n_codes = len(codes) + 1
+        self.char_codes_array = np.zeros(256, dtype=np.uint8)
+        for c, code in codes.items():
+            self.char_codes_array[c] = code
+
+        # trie of the patterns
+        children = [{}]
+        state_patterns = [[]]
+        for seed, pattern_id in pattern_ids.items():
+            state = 0
+            for c in seed.encode('UTF-8'):
+                code = codes[c]
+                if code not in children[state]:
+                    children[state][code] = len(children)
+                    children.append({})
+                    state_patterns.append([])
+                state = children[state][code]
+            state_patterns[state].append(pattern_id)
+
+        # breadth-first, fill in the failure transitions and collect the patterns ending at each state
+        n_states = len(children)
+        transitions = np.zeros((n_states, self.n_codes), dtype=np.int32)
+        fail = [0] * n_states
+        state_outputs = [list(state_patterns[0])] + [None] * (n_states - 1)
+        queue = []
+        for code, child in children[0].items():
+            transitions[0, code] = child
+            queue.append(child)
+        queue_idx = 0
+        while queue_idx < len(queue):
+            state = queue[queue_idx]
+            queue_idx += 1
+            state_outputs[state] = state_patterns[state] + state_outputs[fail[state]]
+            for code in range(self.n_codes):
+                if code in children[state]:
+                    child = children[state][code]
+                    fail[child] = transitions[fail[state], code]
+                    transitions[state, code] = child
+                    queue.append(child)
+                else:
+                    transitions[state, code] = transitions[fail[state], code]
+        self.transitions_array = transitions.ravel()
+
+        self.output_starts_array = np.zeros(n_states + 1, dtype=np.int32)
+        self.output_starts_array[1:] = np.cumsum([len(patterns) for patterns in state_outputs])
+        self.outputs_array = np.array([p for patterns in state_outputs for p in patterns], dtype=np.int32)
+        self.hit_starts_array = np.zeros(self.n_patterns + 1, dtype=np.int32)
+        self.hit_starts_array[1:] = np.cumsum([len(hits) for hits in pattern_hits])
+        self.hits_array = np.array([h for hits in pattern_hits for h in hits], dtype=np.int32)
+
+        self.char_codes = self.char_codes_array
+        self.transitions = self.transitions_array
+        self.output_starts = self.output_starts_array
+        self.outputs = self.outputs_array
+        self.hit_starts = self.hit_starts_array
+        self.hits = self.hits_array
+
+    def __reduce__(self):
+        return (SeedMatcher, (self.fw_seeds, self.rc_seeds))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _mark_seeds(self, bytes read, unsigned char* seen):
+        """
+        Mark the patterns that occur in read in seen.
+        """
+        cdef const unsigned char* seq = read
+        cdef Py_ssize_t i, k, n = len(read)
+        cdef int state = 0
+        for k in range(self.output_starts[0], self.output_starts[1]):
+            seen[self.outputs[k]] = 1
+        for i in range(n):
+            state = self.transitions[state * self.n_codes + self.char_codes[seq[i]]]
+            for k in range(self.output_starts[state], self.output_starts[state + 1]):
+                seen[self.outputs[k]] = 1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def count_seeds(self, str read1, str read2=None):
+        """
+        Count the seeds of each reference that occur in read1 (or in read2, if given).
+        Returns a list of the number of forward seeds found for each reference and a list of the number of reverse complement seeds found.
+        """
+        cdef np.ndarray[np.uint8_t, ndim=1] seen = np.zeros(self.n_patterns, dtype=np.uint8)
+        cdef np.ndarray[np.int32_t, ndim=1] counts = np.zeros(2 * self.n_refs, dtype=np.int32)
+        cdef int p, k
+        self._mark_seeds(read1.encode('UTF-8'), <unsigned char*> seen.data)
+        if read2 is not None:
+            self._mark_seeds(read2.encode('UTF-8'), <unsigned char*> seen.data)
+        for p in range(self.n_patterns):
+            if seen[p]:
+                for k in range(self.hit_starts[p], self.hit_starts[p + 1]):
+                    counts[self.hits[k]] += 1
+        return counts[0::2].tolist(), counts[1::2].tolist()
+
+
+cdef extern from "string.h":
+    void* memchr(const void* s, int c, size_t n)
+
+cdef extern from "stdlib.h":
+    void* malloc(size_t size)
+    void free(void* ptr)
+
+
+cdef inline bint _is_space(char c):
+    return c == b' ' or c == b'\t' or c == b'\n' or c == b'\r' or c == b'\x0b' or c == b'\x0c'
+
+
+cdef extern from "string.h":
+    void* memcpy(void* dest, const void* src, size_t n)
+
+
+cdef unsigned long long _HASH_SEED = 0x9E3779B97F4A7C15ULL
+
+
+cdef inline unsigned long long _hash_bytes(const char* seq, Py_ssize_t n, unsigned long long h):
+    """
+    Hash of seq, continuing from h, computed 8 bytes at a time. Unlike the Python hash, it is the same in every process.
+    """
+    cdef unsigned long long word
+    cdef Py_ssize_t i = 0
+    while i + 8 <= n:
+        memcpy(&word, seq + i, 8)
+        h = (h ^ word) * 0xFF51AFD7ED558CCDULL
+        h ^= h >> 32
+        i += 8
+    word = 0
+    memcpy(&word, seq + i, n - i)
+    h = (h ^ word ^ (<unsigned long long> n << 56)) * 0xC4CEB9FE1A85EC53ULL
+    return h ^ (h >> 29)
+
+
+cdef class FastqReader:
+    """
+    Reader of the records of a fastq file (gzipped if the filename ends with .gz) that decompresses and splits the file in large blocks.
+    Iterating over the reader yields (id, seq, plus, qual) for each record: the id line without its line ending and the other lines stripped.
+    Lines missing from a truncated last record are returned as ''.
+
+    filename: the fastq file
+    reverse_complement: if True, the sequences are reverse complemented and the qualities reversed (as for the R2 reads of paired-end runs)
+    block_size: number of bytes read from the file at a time
+    start, end: if given (for uncompressed files only), only the records that start at a byte offset in [start, end) are read.
+      Readers of consecutive ranges of a file read each record exactly once.
+    """
+    cdef object handle
+    cdef bytes data
+    cdef const char* buf
+    cdef Py_ssize_t size
+    cdef Py_ssize_t pos
+    cdef Py_ssize_t offset
+    cdef Py_ssize_t mark
+    cdef Py_ssize_t end
+    cdef Py_ssize_t block_size
+    cdef bint eof
+    cdef readonly bint reverse_complement
+
+    def __init__(self, str filename, bint reverse_complement=False, Py_ssize_t block_size=1 << 22, Py_ssize_t start=0, end=None):
+        if filename.endswith('.gz'):
+            if start != 0 or end is not None:
+                raise ValueError('Byte ranges can only be read from uncompressed fastq files')
+            self.handle = gzip.open(filename, 'rb')
+        else:
+            self.handle = open(filename, 'rb')
+        self._set_data(b'')
+        self.pos = 0
+        self.offset = 0
+        self.mark = -1
+        self.end = -1 if end is None else end
+        self.block_size = block_size
+        self.eof = False
+        self.reverse_complement = reverse_complement
+        if start > 0:
+            self.handle.seek(start - 1)
+            self.offset = start - 1
+            # skip the end of the line that contains start - 1, then the lines before the first record
+            self._skip_line()
+            self._skip_to_record()
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    cdef void _set_data(self, bytes data):
+        self.data = data
+        self.buf = data
+        self.size = len(data)
+
+    cdef bint _fill(self) except -1:
+        """
+        Read the next block of the file into the buffer, dropping the lines before pos (or before mark, if set).
+        Returns False at the end of the file.
+        """
+        cdef Py_ssize_t cut
+        if self.eof:
+            return False
+        block = self.handle.read(self.block_size)
+        if not block:
+            self.eof = True
+            return False
+        cut = self.pos if self.mark < 0 else self.mark
+        self._set_data(self.data[cut:] + block)
+        self.offset += cut
+        self.pos -= cut
+        if self.mark >= 0:
+            self.mark -= cut
+        return True
+
+    cdef bint _next_line(self, Py_ssize_t* start, Py_ssize_t* end) except -1:
+        """
+        Find the next line in the buffer, reading the next block of the file when needed.
+        Sets start and end (the position of the line ending) and returns True, or returns False at the end of the file.
+        """
+        cdef const char* newline
+        while True:
+            newline = <const char*> memchr(self.buf + self.pos, b'\n', self.size - self.pos)
+            if newline != NULL:
+                start[0] = self.pos
+                end[0] = newline - self.buf
+                self.pos = end[0] + 1
+                return True
+            if not self._fill():
+                if self.pos < self.size:
+                    start[0] = self.pos
+                    end[0] = self.size
+                    self.pos = self.size
+                    return True
+                return False
+
+    cdef bint _next_record(self, Py_ssize_t* start, Py_ssize_t* end) except -1:
+        """
+        Find the first line of the next record, or return False if there are no more records in the range of this reader.
+        """
+        if self.end >= 0 and self.offset + self.pos >= self.end:
+            return False
+        return self._next_line(start, end)
+
+    cdef void _skip_to_record(self) except *:
+        """
+        Move to the first line that starts a record: a line starting with '@' followed by a line starting with '+' two lines later.
+        (A quality line starting with '@' is followed by the id and the sequence of the next record, so it never matches.)
+        """
+        cdef Py_ssize_t start, end
+        cdef bint found
+        while True:
+            self.mark = self.pos
+            found = self._next_line(&start, &end) and start < end and self.buf[start] == b'@'
+            found = found and self._next_line(&start, &end)
+            found = found and self._next_line(&start, &end) and start < end and self.buf[start] == b'+'
+            self.pos = self.mark
+            self.mark = -1
+            if found or not self._next_line(&start, &end):
+                break
+        if not found:
+            self.pos = self.size
+
+    cdef bint _next_stripped_line(self, Py_ssize_t* start, Py_ssize_t* end) except -1:
+        """
+        Find the next line without surrounding whitespace. At the end of the file, sets an empty line and returns False.
+        """
+        if not self._next_line(start, end):
+            start[0] = end[0] = self.pos
+            return False
+        while start[0] < end[0] and _is_space(self.buf[start[0]]):
+            start[0] += 1
+        while end[0] > start[0] and _is_space(self.buf[end[0] - 1]):
+            end[0] -= 1
+        return True
+
+    cdef str _decode(self, Py_ssize_t start, Py_ssize_t end, bint is_seq):
+        """
+        Return the line between start and end, reverse complemented (if is_seq) or reversed (otherwise) if this reader reverse complements.
+        """
+        if self.reverse_complement:
+            return _reverse(self.buf + start, end - start, is_seq)
+        return self.buf[start:end].decode('UTF-8')
+
+    cdef str _read_stripped(self, bint is_seq):
+        """
+        Return the next line stripped (and transformed as in _decode), or '' at the end of the file.
+        """
+        cdef Py_ssize_t start, end
+        self._next_stripped_line(&start, &end)
+        return self._decode(start, end, is_seq)
+
+    cdef str _read_plus(self):
+        """
+        Return the next line stripped, or '' at the end of the file.
+        """
+        cdef Py_ssize_t start, end
+        self._next_stripped_line(&start, &end)
+        return self.buf[start:end].decode('UTF-8')
+
+    cdef bint _skip_line(self) except -1:
+        cdef Py_ssize_t start, end
+        return self._next_line(&start, &end)
+
+    def __next__(self):
+        cdef Py_ssize_t start, end
+        if not self._next_record(&start, &end):
+            raise StopIteration
+        fastq_id = self.buf[start:end].decode('UTF-8')
+        fastq_seq = self._read_stripped(True)
+        fastq_plus = self._read_plus()
+        fastq_qual = self._read_stripped(False)
+        return fastq_id, fastq_seq, fastq_plus, fastq_qual
+
+    def count_sequences(self, dict counts, list first_reads=None, int n_partitions=1, int partition=0, long max_reads=-1, bint pack=False):
+        """
+        Count the sequences of the remaining records into counts (a dict of sequence to number of reads).
+        If n_partitions > 1, only the sequences whose hash modulo n_partitions is partition are counted,
+        so that several processes can each count one partition of the file.
+        If first_reads is given, the index of the record where each new sequence was first seen is appended to it.
+        If max_reads >= 0, at most max_reads records are read, so the file can be counted in blocks.
+        If pack is set, the keys of counts are the sequences packed by pack_sequence.
+        Returns the number of records read.
+        """
+        cdef long n_reads = 0
+        cdef Py_ssize_t start, end
+        while n_reads != max_reads and self._next_record(&start, &end):
+            n_reads += 1
+            self._next_stripped_line(&start, &end)
+            if n_partitions > 1 and _hash_bytes(self.buf + start, end - start, _HASH_SEED) % n_partitions != partition:
+                self._skip_line()
+                self._skip_line()
+                continue
+            if pack and not self.reverse_complement:
+                fastq_seq = _pack(<const unsigned char*> self.buf + start, end - start)
+            elif pack:
+                fastq_seq = pack_sequence(self._decode(start, end, True))
+            else:
+                fastq_seq = self._decode(start, end, True)
+            self._skip_line()
+            self._skip_line()
+            count = counts.get(fastq_seq)
+            if count is None:
+                counts[fastq_seq] = 1
+                if first_reads is not None:
+                    first_reads.append(n_reads - 1)
+            else:
+                counts[fastq_seq] = count + 1
+        return n_reads
+
+    def count_pairs(self, FastqReader reads2, dict counts, list first_reads=None, int n_partitions=1, int partition=0, bint pack=False):
+        """
+        Count the read pairs of the remaining records of this reader and reads2 into counts.
+        The key of a pair is seq1 + '+' + seq2 (packed by pack_sequence if pack is set) and its value is a list of the number of pairs
+        and the qualities of the first pair, qual1 + ' ' + qual2 (seq2 and qual2 are reverse complemented and reversed if reads2 reverse complements).
+        n_partitions, partition and first_reads are as in count_sequences; pairs are partitioned by the hash of both sequences as read from the files.
+        Stops at the end of the shorter file. Returns the number of pairs read.
+        """
+        cdef long n_reads = 0
+        cdef Py_ssize_t start1, end1, start2, end2
+        cdef unsigned long long fastq1_hash
+        cdef str fastq1_seq, fastq1_qual, fastq2_seq, fastq2_qual
+        cdef list entry
+        while self._next_record(&start1, &end1) and reads2._next_record(&start2, &end2):
+            n_reads += 1
+            self._next_stripped_line(&start1, &end1)
+            reads2._next_stripped_line(&start2, &end2)
+            if n_partitions > 1:
+                fastq1_hash = _hash_bytes(self.buf + start1, end1 - start1, _HASH_SEED)
+                if _hash_bytes(reads2.buf + start2, end2 - start2, fastq1_hash) % n_partitions != partition:
+                    self._skip_line()
+                    self._skip_line()
+                    reads2._skip_line()
+                    reads2._skip_line()
+                    continue
+            fastq1_seq = self._decode(start1, end1, True)
+            fastq2_seq = reads2._decode(start2, end2, True)
+            self._skip_line()
+            fastq1_qual = self._read_stripped(False)
+            reads2._skip_line()
+            fastq2_qual = reads2._read_stripped(False)
+            key = fastq1_seq + '+' + fastq2_seq
+            if pack:
+                key = pack_sequence(key)
+            entry = counts.get(key)
+            if entry is None:
+                counts[key] = [1, fastq1_qual + ' ' + fastq2_qual]
+                if first_reads is not None:
+                    first_reads.append(n_reads - 1)
+            else:
+                entry[0] += 1
+        return n_reads
+
+    def at_end(self):
+        """
+        Return True if there are no records left to read.
+        """
+        if self.end >= 0 and self.offset + self.pos >= self.end:
+            return True
+        return self.pos >= self.size and not self._fill()
+
+
+cdef unsigned char _complement_table[256]
+_complement_table[:] = [0] * 256
+for _nt, _complement in zip(b'ACGTN_-', b'TGCAN_-'):
+    _complement_table[_nt] = _complement
+    _complement_table[chr(_nt).lower().encode('ascii')[0]] = _complement
+
+
+cdef str _reverse(const char* seq, Py_ssize_t n, bint complement):
+    """
+    Return seq reversed, and complemented (as CRISPRessoShared.reverse_complement) if complement is set.
+    """
+    cdef char* out = <char*> malloc(n + 1)
+    cdef Py_ssize_t i
+    cdef unsigned char c
+    if out == NULL:
+        raise MemoryError()
+    try:
+        for i in range(n):
+            c = <unsigned char> seq[n - 1 - i]
+            if complement:
+                if _complement_table[c] == 0:
+                    raise KeyError(seq[n - 1 - i:n - i].decode('UTF-8', 'replace').upper())
+                c = _complement_table[c]
+            out[i] = c
+        return out[:n].decode('UTF-8')
+    finally:
+        free(out)
+
+
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+
+cdef extern from "string.h":
+    void* memset(void* s, int c, size_t n)
+
+# 2-bit codes of the bases of packed sequences; other characters (N, '+', '-', lowercase...) are stored as exceptions
+cdef unsigned char _BASE_CODES[256]
+_BASE_CODES[:] = [4] * 256
+for _code, _nt in enumerate('ACGT'):
+    _BASE_CODES[ord(_nt)] = _code
+cdef const char* _CODE_BASES = b'ACGT'
+
+
+cdef inline Py_ssize_t _varint_size(size_t value):
+    cdef Py_ssize_t size = 1
+    while value >= 0x80:
+        value >>= 7
+        size += 1
+    return size
+
+
+cdef inline unsigned char* _write_varint(unsigned char* out, size_t value):
+    while value >= 0x80:
+        out[0] = (value & 0x7f) | 0x80
+        value >>= 7
+        out += 1
+    out[0] = value
+    return out + 1
+
+
+cdef inline Py_ssize_t _read_varint(const unsigned char* data, Py_ssize_t size, Py_ssize_t* pos) except -1:
+    cdef size_t value = 0
+    cdef int shift = 0
+    while True:
+        if pos[0] >= size or shift > 56:
+            raise ValueError('Invalid packed sequence')
+        value |= <size_t> (data[pos[0]] & 0x7f) << shift
+        pos[0] += 1
+        if data[pos[0] - 1] < 0x80:
+            return value
+        shift += 7
+
+
+cdef bytes _pack(const unsigned char* seq, Py_ssize_t n):
+    """
+    Pack seq: its length as a varint, then 4 bases per byte (2 bits each, A=0 C=1 G=2 T=3, the first base in the low bits),
+    then each run of other characters as (varint distance from the end of the previous run, character, varint run length).
+    Other characters are packed as A in the 2-bit bases, so each sequence has a single packed form.
+    """
+    cdef Py_ssize_t n_base_bytes = (n + 3) >> 2
+    cdef Py_ssize_t size = _varint_size(n) + n_base_bytes
+    cdef Py_ssize_t i = 0, run_start, previous_end = 0
+    cdef unsigned char code
+    while i < n:
+        if _BASE_CODES[seq[i]] == 4:
+            run_start = i
+            while i < n and seq[i] == seq[run_start]:
+                i += 1
+            size += _varint_size(run_start - previous_end) + 1 + _varint_size(i - run_start)
+            previous_end = i
+        else:
+            i += 1
+
+    cdef bytes packed = PyBytes_FromStringAndSize(NULL, size)
+    cdef unsigned char* out = <unsigned char*> PyBytes_AS_STRING(packed)
+    out = _write_varint(out, n)
+    memset(out, 0, n_base_bytes)
+    for i in range(n):
+        code = _BASE_CODES[seq[i]]
+        if code != 4:
+            out[i >> 2] |= code << ((i & 3) << 1)
+    out += n_base_bytes
+    i = 0
+    previous_end = 0
+    while i < n:
+        if _BASE_CODES[seq[i]] == 4:
+            run_start = i
+            while i < n and seq[i] == seq[run_start]:
+                i += 1
+            out = _write_varint(out, run_start - previous_end)
+            out[0] = seq[run_start]
+            out = _write_varint(out + 1, i - run_start)
+            previous_end = i
+        else:
+            i += 1
+    return packed
+
+
+def pack_sequence(str seq):
+    """
+    Pack a read sequence into a compact bytes key: 2 bits per base, plus the runs of other characters (e.g. N, or the '+'
+    between paired reads) stored separately. Equal sequences have equal packed keys, so they can be used as dict keys
+    (hashed over about a quarter of the bytes of the sequence). unpack_sequence returns the sequence.
+    """
+    cdef bytes encoded = seq.encode('ascii')
+    return _pack(encoded, len(encoded))
+
+
+def unpack_sequence(bytes packed):
+    """
+    Return the sequence of a key packed by pack_sequence.
+    """
+    cdef const unsigned char* data = packed
+    cdef Py_ssize_t size = len(packed)
+    cdef Py_ssize_t pos = 0, i, seq_pos = 0, run_length
+    cdef Py_ssize_t n = _read_varint(data, size, &pos)
+    cdef Py_ssize_t n_base_bytes = (n + 3) >> 2
+    if pos + n_base_bytes > size:
+        raise ValueError('Invalid packed sequence')
+    cdef bytes seq = PyBytes_FromStringAndSize(NULL, n)
+    cdef char* out = PyBytes_AS_STRING(seq)
+    for i in range(n):
+        out[i] = _CODE_BASES[(data[pos + (i >> 2)] >> ((i & 3) << 1)) & 3]
+    pos += n_base_bytes
+    while pos < size:
+        seq_pos += _read_varint(data, size, &pos)
+        if pos >= size:
+            raise ValueError('Invalid packed sequence')
+        c = data[pos]
+        pos += 1
+        run_length = _read_varint(data, size, &pos)
+        if seq_pos + run_length > n:
+            raise ValueError('Invalid packed sequence')
+        memset(out + seq_pos, c, run_length)
+        seq_pos += run_length
+    return seq.decode('ascii')
+
+
+TALLY_NUCS = 'ACGTN-'  # the rows of the base count matrices of tally_bases
+cdef int _TALLY_ROWS[256]
+_TALLY_ROWS[:] = [-1] * 256
+for _row, _nt in enumerate(TALLY_NUCS):
+    _TALLY_ROWS[ord(_nt)] = _row
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tally_bases(double[:, ::1] base_counts, str bases, positions, double count):
+    """
+    Add count to the base counts of each base of bases at its position in positions:
+    base_counts[TALLY_NUCS.index(base), position] += count.
+    Bases that are not in TALLY_NUCS and negative positions (the insertions in ref_positions) are skipped.
+
+    Parameters
+    ----------
+    base_counts : np.ndarray
+        float matrix of len(TALLY_NUCS) rows by the length of the reference
+    bases : str
+        the bases, e.g. the aligned sequence of a read or its substitution values
+    positions : list of int
+        the position of each base, e.g. the ref_positions of the alignment
+    count : float
+        the number of reads to count
+    """
+    if not isinstance(positions, list):
+        positions = list(positions)
+    cdef list position_list = positions
+    cdef bytes encoded = bases.encode('ascii')
+    cdef const unsigned char* seq = encoded
+    cdef Py_ssize_t n = len(encoded), i, position, length = base_counts.shape[1]
+    cdef int row
+    if len(position_list) != n:
+        raise ValueError('The bases and positions must have the same length')
+    if base_counts.shape[0] != len(TALLY_NUCS):
+        raise ValueError('The base counts must have a row for each of ' + TALLY_NUCS)
+    for i in range(n):
+        position = position_list[i]
+        row = _TALLY_ROWS[seq[i]]
+        if position < 0 or row < 0:
+            continue
+        if position >= length:
+            raise IndexError('Position %d is out of bounds for length %d' % (position, length))
+        base_counts[row, position] += count
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tally_positions(double[::1] vector, positions, double count):
+    """
+    Add count to vector at positions, like vector[positions] += count with numpy: a position repeated in positions is
+    counted once, and negative positions count from the end.
+
+    Parameters
+    ----------
+    vector : np.ndarray
+        float vector of the counts by position
+    positions : list of int
+        the positions to count, e.g. the insertion_positions of a payload
+    count : float
+        the number of reads to count
+    """
+    if not isinstance(positions, list):
+        positions = list(positions)
+    cdef list position_list = positions
+    cdef Py_ssize_t n = len(position_list), i, j, position, previous = -1, length = vector.shape[0]
+    cdef bint is_sorted = True, is_repeated
+    for i in range(n):
+        position = position_list[i]
+        if position < 0:
+            position += length
+        if position < 0 or position >= length:
+            raise IndexError('Position %d is out of bounds for length %d' % (position_list[i], length))
+        if is_sorted and position < previous:
+            is_sorted = False
+        if is_sorted:
+            is_repeated = position == previous
+        else:
+            is_repeated = False
+            for j in range(i):
+                if (<Py_ssize_t> position_list[j]) % length == position:
+                    is_repeated = True
+                    break
+        if not is_repeated:
+            vector[position] += count
+        previous = position
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tally_lengths(double[::1] vector, coordinates, sizes, double count, bint fill):
+    """
+    Add size * count to vector for each (start, end) coordinates and size: at start and at end for insertions (fill=False),
+    or from start to end (exclusive) for deletions (fill=True).
+
+    Parameters
+    ----------
+    vector : np.ndarray
+        float vector of the lengths by position
+    coordinates : list of (int, int)
+        the coordinates of the insertions or deletions, e.g. the insertion_coordinates of a payload
+    sizes : list of int
+        the size of each insertion or deletion
+    count : float
+        the number of reads to count
+    fill : bool
+        whether to add to all positions from start to end instead of start and end
+    """
+    cdef Py_ssize_t i, position, start, end, length = vector.shape[0]
+    cdef double weight
+    for i in range(len(coordinates)):
+        start, end = coordinates[i]
+        weight = sizes[i] * count
+        if fill:
+            if start < 0 or end > length:
+                raise IndexError('Coordinates (%d, %d) are out of bounds for length %d' % (start, end, length))
+            for position in range(start, end):
+                vector[position] += weight
+        else:
+            if start < 0 or start >= length or end < 0 or end >= length:
+                raise IndexError('Coordinates (%d, %d) are out of bounds for length %d' % (start, end, length))
+            vector[start] += weight
+            vector[end] += weight
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+"""CRISPResso2 - Kendell Clement and Luca Pinello 2018
+Software pipeline for the analysis of genome editing outcomes from deep sequencing data
+(c) 2018 The General Hospital Corporation. All Rights Reserved.
+"""
+
+import math
+import os
+import pickle
+import sqlite3
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from CRISPResso2.CRISPRessoCOREResources import ResultsSlotsDict, pack_sequence, unpack_sequence
+
+STORE_FILENAME = 'CRISPResso2_variants.sqlite'
+
+# fields of the payloads (the ResultsSlotsDict of find_indels_substitutions) by how VariantColumns stores them
+INT_LIST_FIELDS = (
+    'all_insertion_positions', 'all_insertion_left_positions', 'insertion_positions', 'insertion_sizes',
+    'all_deletion_positions', 'deletion_positions', 'deletion_sizes',
+    'all_substitution_positions', 'substitution_positions', 'ref_positions',
+)
+COORDINATE_FIELDS = ('insertion_coordinates', 'all_deletion_coordinates', 'deletion_coordinates')
+SUBSTITUTION_VALUE_FIELDS = ('all_substitution_values', 'substitution_values')
+INT_FIELDS = (
+    'insertion_n', 'deletion_n', 'substitution_n',
+    'insertions_outside_window', 'deletions_outside_window', 'substitutions_outside_window',
+    'total_mods', 'mods_in_window', 'mods_outside_window',
+)
+NAME_FIELDS = ('ref_name', 'classification', 'aln_strand')
+SEQUENCE_FIELDS = ('aln_seq', 'aln_ref')
+VARIANT_FIELDS = ('count', 'aln_ref_names', 'aln_scores', 'ref_aln_details', 'best_match_score', 'best_match_name', 'class_name')
+
+
+class VariantStore(MutableMapping):
+    """Dict of the variant objects of a run that keeps them on disk, used as the variantCache when they don't fit in --max_memory.
+
+    The variant objects are pickled into an SQLite database in directory, under their keys (the packed reads of variantCache).
+    Iterating over the store follows the order given to add (or the order of insertion for entries set with store[key] = value),
+    so a store filled in the order the reads were first seen iterates like the in-memory variantCache.
+
+    Up to max_loaded fetched objects are kept in memory and written back to the database when they are evicted,
+    so changes made to an object right after fetching it (e.g. store[key]['count'] = 0) are kept.
+
+    n_partitions is the number of hash partitions the unique reads are split into to fill the store (see process_fastq).
+    """
+
+    def __init__(self, directory, n_partitions, max_loaded=10000):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, STORE_FILENAME)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.n_partitions = n_partitions
+        self.max_loaded = max_loaded
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute('PRAGMA journal_mode=OFF')
+        self._connection.execute('PRAGMA synchronous=OFF')
+        self._connection.execute('CREATE TABLE variants (key BLOB PRIMARY KEY, ord INTEGER NOT NULL, value BLOB NOT NULL)')
+        self._connection.execute('CREATE INDEX variants_ord ON variants (ord)')
+        self._loaded = OrderedDict()
+        self._next_order = 0
+
+    def _write_back(self, items):
+        self._connection.executemany(
+            'UPDATE variants SET value = ? WHERE key = ?',
+            [(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), key) for key, value in items],
+        )
+        self._connection.commit()
+
+    def _load(self, key, value):
+        self._loaded[key] = value
+        if len(self._loaded) > self.max_loaded:
+            evicted = [self._loaded.popitem(last=False) for _ in range(len(self._loaded) // 2)]
+            self._write_back(evicted)
+
+    def add(self, key, value, order):
+        """Add a new entry, iterated in the position given by order."""
+        self._connection.execute(
+            'INSERT INTO variants (key, ord, value) VALUES (?, ?, ?)',
+            (key, order, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)),
+        )
+        self._next_order = max(self._next_order, order + 1)
+
+    def add_all(self, items):
+        """Add new entries from an iterable of (order, key, value)."""
+        for order, key, value in items:
+            self.add(key, value, order)
+        self._connection.commit()
+
+    def __getitem__(self, key):
+        value = self._loaded.get(key)
+        if value is not None:
+            self._loaded.move_to_end(key)
+            return value
+        row = self._connection.execute('SELECT value FROM variants WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        value = pickle.loads(row[0])
+        self._load(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self._loaded.pop(key, None)
+            self._connection.execute('UPDATE variants SET value = ? WHERE key = ?', (pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), key))
+        else:
+            self.add(key, value, self._next_order)
+
+    def __delitem__(self, key):
+        self._loaded.pop(key, None)
+        if self._connection.execute('DELETE FROM variants WHERE key = ?', (key,)).rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._loaded or self._connection.execute('SELECT 1 FROM variants WHERE key = ?', (key,)).fetchone() is not None
+
+    def __iter__(self, page_size=10000):
+        last_order = -1
+        while True:
+            rows = self._connection.execute('SELECT key, ord FROM variants WHERE ord > ? ORDER BY ord LIMIT ?', (last_order, page_size)).fetchall()
+            if not rows:
+                return
+            for key, _ in rows:
+                yield key
+            last_order = rows[-1][1]
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM variants').fetchone()[0]
+
+    def close(self):
+        """Close the database and remove it."""
+        self._loaded.clear()
+        self._connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class VariantColumns(object):
+    """Columnar storage of the variant objects of aligned reads, which take a fraction of the memory of the variant dicts.
+
+    The fields of the variants and of their payloads are stored in columns: the lists of positions, sizes and coordinates are
+    concatenated into flat int32 buffers indexed by offsets, the scores into a flat float buffer (None stored as nan),
+    the names (references, classes, strands) are interned, and the aligned sequences are kept packed by pack_sequence in an
+    arena where identical sequences (e.g. the aligned reference of most reads) are stored once.
+
+    add returns a VariantView that reads the variant back with the same API and the same values as the variant dict,
+    so a VariantView can be stored in variantCache in place of the variant.
+    """
+
+    def __init__(self):
+        self._names = []
+        self._name_ids = {}
+        self._name_lists = []
+        self._name_list_ids = {}
+        self._sequences = []
+        self._sequence_ids = {}
+
+        self._counts = array('q')
+        self._best_match_scores = array('d')
+        self._best_match_names = array('i')
+        self._class_names = array('i')
+        self._aln_ref_names = array('i')
+        # the scores and ref_aln_details of variant i are at [_ref_offsets[i], _ref_offsets[i + 1])
+        self._ref_offsets = array('q', [0])
+        self._aln_scores = array('d')
+        self._detail_names = array('i')
+        self._detail_s1s = array('i')
+        self._detail_s2s = array('i')
+        self._detail_scores = array('d')
+        # the payloads of variant i are at [_payload_offsets[i], _payload_offsets[i + 1])
+        self._payload_offsets = array('q', [0])
+        self._payload_keys = array('i')
+        self._payload_variants = array('q')
+        self._int_lists = {field: (array('q', [0]), array('i')) for field in INT_LIST_FIELDS + COORDINATE_FIELDS}
+        self._substitution_values = {field: (array('q', [0]), bytearray()) for field in SUBSTITUTION_VALUE_FIELDS}
+        self._ints = {field: array('q') for field in INT_FIELDS}
+        self._name_fields = {field: array('i') for field in NAME_FIELDS}
+        self._sequence_fields = {field: array('i') for field in SEQUENCE_FIELDS}
+        self._irregular_ends = array('b')
+
+        self._variant_extras = {}
+        self._payload_extras = {}
+
+    def __len__(self):
+        return len(self._counts)
+
+    def _intern_name(self, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self._names)
+            self._names.append(name)
+        return name_id
+
+    def _intern_name_list(self, names):
+        names = tuple(names)
+        name_list_id = self._name_list_ids.get(names)
+        if name_list_id is None:
+            name_list_id = self._name_list_ids[names] = len(self._name_lists)
+            self._name_lists.append(names)
+        return name_list_id
+
+    def _intern_sequence(self, sequence):
+        if sequence is None:
+            return -1
+        packed_sequence = pack_sequence(sequence)
+        sequence_id = self._sequence_ids.get(packed_sequence)
+        if sequence_id is None:
+            sequence_id = self._sequence_ids[packed_sequence] = len(self._sequences)
+            self._sequences.append(packed_sequence)
+        return sequence_id
+
+    def _sequence(self, sequence_id):
+        if sequence_id < 0:
+            return None
+        return unpack_sequence(self._sequences[sequence_id])
+
+    @staticmethod
+    def _is_score(score):
+        return score is None or type(score) is float
+
+    @staticmethod
+    def can_store(variant):
+        """Return whether variant is an aligned variant object (with payloads from find_indels_substitutions) that can be stored."""
+        if not isinstance(variant, dict) or variant.get('best_match_score', 0) <= 0:
+            return False
+        for key, value in variant.items():
+            if key.startswith('variant_'):
+                if not isinstance(value, ResultsSlotsDict) or len(value.__dict__) != len(ResultsSlotsDict.__slots__) or value['aln_scores'] is not variant['aln_scores']:
+                    return False
+            elif key not in VARIANT_FIELDS:
+                return False
+        if len(variant) != len(VARIANT_FIELDS) + len([key for key in variant if key.startswith('variant_')]):
+            return False
+        if type(variant['best_match_score']) is not float or not all(VariantColumns._is_score(score) for score in variant['aln_scores']):
+            return False
+        return all(len(detail) == 4 and VariantColumns._is_score(detail[3]) for detail in variant['ref_aln_details'])
+
+    def _add_payload(self, key, payload, variant_index):
+        self._payload_keys.append(self._intern_name(key))
+        self._payload_variants.append(variant_index)
+        for field in INT_LIST_FIELDS:
+            offsets, values = self._int_lists[field]
+            values.extend(payload[field])
+            offsets.append(len(values))
+        for field in COORDINATE_FIELDS:
+            offsets, values = self._int_lists[field]
+            for start, end in payload[field]:
+                values.append(start)
+                values.append(end)
+            offsets.append(len(values))
+        for field in SUBSTITUTION_VALUE_FIELDS:
+            offsets, values = self._substitution_values[field]
+            values.extend(''.join(payload[field].tolist()).encode())
+            offsets.append(len(values))
+        for field in INT_FIELDS:
+            self._ints[field].append(payload[field])
+        for field in NAME_FIELDS:
+            self._name_fields[field].append(self._intern_name(payload[field]))
+        for field in SEQUENCE_FIELDS:
+            self._sequence_fields[field].append(self._intern_sequence(payload[field]))
+        self._irregular_ends.append(payload['irregular_ends'])
+
+    def add(self, variant):
+        """Store a variant object and return a VariantView of it, or return variant itself if it can't be stored (see can_store).
+
+        Parameters
+        ----------
+        variant : dict
+            The variant object of an aligned read, from get_new_variant_object
+
+        Returns
+        -------
+        VariantView or dict
+            The view of the stored variant to use in its place, or variant
+
+        """
+        if not self.can_store(variant):
+            return variant
+        variant_index = len(self._counts)
+        self._counts.append(variant['count'])
+        self._best_match_scores.append(variant['best_match_score'])
+        self._best_match_names.append(self._intern_name(variant['best_match_name']))
+        self._class_names.append(self._intern_name(variant['class_name']))
+        self._aln_ref_names.append(self._intern_name_list(variant['aln_ref_names']))
+        for score, (ref_name, s1, s2, detail_score) in zip(variant['aln_scores'], variant['ref_aln_details']):
+            self._aln_scores.append(np.nan if score is None else score)
+            self._detail_names.append(self._intern_name(ref_name))
+            self._detail_s1s.append(self._intern_sequence(s1))
+            self._detail_s2s.append(self._intern_sequence(s2))
+            self._detail_scores.append(np.nan if detail_score is None else detail_score)
+        self._ref_offsets.append(len(self._aln_scores))
+        for key, value in variant.items():
+            if key.startswith('variant_'):
+                self._add_payload(key, value, variant_index)
+        self._payload_offsets.append(len(self._payload_keys))
+        return VariantView(self, variant_index)
+
+    @staticmethod
+    def _score(score):
+        return None if math.isnan(score) else score
+
+    def _aln_scores_list(self, variant_index):
+        return [self._score(score) for score in self._aln_scores[self._ref_offsets[variant_index]:self._ref_offsets[variant_index + 1]]]
+
+    def _variant_keys(self, variant_index):
+        keys = list(VARIANT_FIELDS)
+        keys.extend(self._names[self._payload_keys[payload_index]] for payload_index in range(self._payload_offsets[variant_index], self._payload_offsets[variant_index + 1]))
+        keys.extend(key for key in self._variant_extras.get(variant_index, ()) if key not in keys)
+        return keys
+
+    def _get_variant_field(self, variant_index, key):
+        extras = self._variant_extras.get(variant_index)
+        if extras is not None and key in extras:
+            return extras[key]
+        if key == 'count':
+            return self._counts[variant_index]
+        if key == 'aln_ref_names':
+            return list(self._name_lists[self._aln_ref_names[variant_index]])
+        if key == 'aln_scores':
+            return self._aln_scores_list(variant_index)
+        if key == 'ref_aln_details':
+            return [
+                (self._names[self._detail_names[ref_index]], self._sequence(self._detail_s1s[ref_index]), self._sequence(self._detail_s2s[ref_index]), self._score(self._detail_scores[ref_index]))
+                for ref_index in range(self._ref_offsets[variant_index], self._ref_offsets[variant_index + 1])
+            ]
+        if key == 'best_match_score':
+            return self._best_match_scores[variant_index]
+        if key == 'best_match_name':
+            return self._names[self._best_match_names[variant_index]]
+        if key == 'class_name':
+            return self._names[self._class_names[variant_index]]
+        key_id = self._name_ids.get(key)
+        if key_id is not None:
+            for payload_index in range(self._payload_offsets[variant_index], self._payload_offsets[variant_index + 1]):
+                if self._payload_keys[payload_index] == key_id:
+                    return PayloadView(self, payload_index)
+        raise KeyError(key)
+
+    def _set_variant_field(self, variant_index, key, value):
+        if key == 'count':
+            self._counts[variant_index] = value
+        else:
+            self._variant_extras.setdefault(variant_index, {})[key] = value
+
+    def _get_payload_field(self, payload_index, key):
+        extras = self._payload_extras.get(payload_index)
+        if extras is not None and key in extras:
+            return extras[key]
+        if key in self._int_lists:
+            offsets, values = self._int_lists[key]
+            field_values = values[offsets[payload_index]:offsets[payload_index + 1]].tolist()
+            if key in COORDINATE_FIELDS:
+                return list(zip(field_values[0::2], field_values[1::2]))
+            return field_values
+        if key in self._substitution_values:
+            offsets, values = self._substitution_values[key]
+            return np.array(list(values[offsets[payload_index]:offsets[payload_index + 1]].decode()))
+        if key in self._ints:
+            return self._ints[key][payload_index]
+        if key in self._name_fields:
+            return self._names[self._name_fields[key][payload_index]]
+        if key in self._sequence_fields:
+            return self._sequence(self._sequence_fields[key][payload_index])
+        if key == 'irregular_ends':
+            return bool(self._irregular_ends[payload_index])
+        if key == 'aln_scores':
+            return self._aln_scores_list(self._payload_variants[payload_index])
+        raise KeyError(key)
+
+
+class VariantView(object):
+    """A variant object stored in VariantColumns, read (and its count set) like the variant dict.
+
+    Setting a field other than count keeps the value with the view's variant. A view is pickled as the variant dict.
+    """
+
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._columns._get_variant_field(self._index, key)
+
+    def __setitem__(self, key, value):
+        self._columns._set_variant_field(self._index, key, value)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._columns._variant_keys(self._index)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        """Return the variant dict, with its payloads as ResultsSlotsDict."""
+        return {key: value.to_results() if isinstance(value, PayloadView) else value for key, value in self.items()}
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(),))
+
+
+class PayloadView(object):
+    """A payload (the ResultsSlotsDict of a reference) of a variant stored in VariantColumns, read like the ResultsSlotsDict."""
+
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._columns._get_payload_field(self._index, key)
+
+    def __setitem__(self, key, value):
+        self._columns._payload_extras.setdefault(self._index, {})[key] = value
+
+    def __contains__(self, key):
+        return key in ResultsSlotsDict.__slots__ or key in self._columns._payload_extras.get(self._index, ())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_results(self):
+        """Return the payload as a ResultsSlotsDict."""
+        return ResultsSlotsDict(**{key: self[key] for key in ResultsSlotsDict.__slots__})
+
+    def __reduce_ex__(self, protocol):
+        return self.to_results().__reduce_ex__(protocol)
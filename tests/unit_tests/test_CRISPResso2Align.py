@@ -1,6 +1,8 @@
 """Unit tests for CRISPResso2Align."""
 
-from CRISPResso2 import CRISPResso2Align
+import pickle
+
+from CRISPResso2 import CRISPResso2Align, CRISPRessoCOREResources
 import numpy as np
 
 ALN_MATRIX = CRISPResso2Align.read_matrix("./CRISPResso2/EDNAFULL")
@@ -332,6 +334,206 @@ def test_global_align_completely_different():
     assert score == 0.0
 
 
+def test_global_align_degenerate_gap_penalties():
+    """Test that gaps reaching the first row or column are traced back to the start with degenerate gap penalties."""
+    seq1, seq2, score = CRISPResso2Align.global_align("AC", "G", matrix=ALN_MATRIX, gap_incentive=np.array([0, 0], dtype=int), gap_open=-1, gap_extend=-2)
+    assert seq1 == "AC-"
+    assert seq2 == "--G"
+    assert score == 0.0
+
+    seq1, seq2, score = CRISPResso2Align.global_align("ACTG", "CACTG", matrix=ALN_MATRIX, gap_incentive=np.zeros(6, dtype=int), gap_open=0, gap_extend=0)
+    assert seq1 == "-ACTG"
+    assert seq2 == "CACTG"
+    assert score == 80.0
+
+    for read, ref in [("A", "G"), ("A", "ACGT"), ("ACGT", "T"), ("TTAC", "CTTA"), ("CTCC", "TTA")]:
+        for gap_open, gap_extend in [(0, 0), (0, -1), (-1, -2), (-2, -2), (5, 1)]:
+            seq1, seq2, score = CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=np.zeros(len(ref) + 1, dtype=int), gap_open=gap_open, gap_extend=gap_extend)
+            assert len(seq1) == len(seq2) <= len(read) + len(ref)
+            assert seq1.replace("-", "") == read
+            assert seq2.replace("-", "") == ref
+
+
+
+# =============================================================================
+# Tests for global_align - banded alignment
+# =============================================================================
+
+
+def test_global_align_banded_matches_full():
+    """Test that banded alignment gives the same result as the full matrix."""
+    ref = "CGGATGTTCCAATCAGTACGCAGAGAGTCGCCGTCTCCAAGGTGAAAGCGGAAGTAGGGCCTTCGCGCACCTCATGGAATCCCTTCTGCAGCACCTGGATCGCTTTTCCGAGCTTCTGGCGGTCTCAAGCACTACCTACGTCAGCACCTGGGACCCC"
+    reads = [
+        ref,
+        ref[:60] + ref[70:],
+        ref[:60] + "TTTT" + ref[60:],
+        ref[:40] + "A" + ref[41:],
+        ref[10:],
+    ]
+    gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+    gap_incentive[60] = 1
+    for read in reads:
+        full = CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive, gap_open=-20, gap_extend=-2)
+        for max_indel_size in [0, 1, 5, 30]:
+            banded = CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive, gap_open=-20, gap_extend=-2, max_indel_size=max_indel_size)
+            assert banded == full
+
+
+def test_global_align_banded_falls_back_for_large_indel():
+    """Test that an indel larger than the band still gives the full matrix alignment."""
+    ref = "ATCGATCGGCTAGCTAGGATCCATGCATGCAATTGGCCAA"
+    read = "ATCGATCGGC" + "TTTTTTTTTTTT" + "TAGCTAGGATCCATGCATGCAATTGGCCAA"
+    gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+    full = CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive)
+    banded = CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive, max_indel_size=0)
+    assert banded == full
+    assert banded[1] == "ATCGATCGGCT" + "-" * 12 + "AGCTAGGATCCATGCATGCAATTGGCCAA"
+
+
+# =============================================================================
+# Tests for Aligner
+# =============================================================================
+
+
+def test_aligner_matches_global_align():
+    """Test that reusing an Aligner across sequences of different lengths matches global_align."""
+    aligner = CRISPResso2Align.Aligner(ALN_MATRIX, gap_open=-20, gap_extend=-2)
+    pairs = [
+        ("ATTA", "ATTTA"),
+        ("AATGCGTAACGTAGCTAGCTAGCATCGATCGATCAGCTAGCTAG", "AATGCGTAACGTAGCTAGCATCGATCGATCAGCTAGCTAG"),
+        ("ATCG", "ATCG"),
+        ("ANNG", "ATCG"),
+    ]
+    for read, ref in pairs:
+        gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+        expected = CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive, gap_open=-20, gap_extend=-2)
+        assert aligner.align(read, ref, gap_incentive) == expected
+
+
+def test_aligner_pickle():
+    """Test that an Aligner can be pickled and keeps its parameters."""
+    aligner = CRISPResso2Align.Aligner(ALN_MATRIX, gap_open=-10, gap_extend=-1, max_indel_size=5)
+    unpickled = pickle.loads(pickle.dumps(aligner))
+    assert unpickled.gap_open == -10
+    assert unpickled.gap_extend == -1
+    assert unpickled.max_indel_size == 5
+    gap_incentive = np.zeros(6, dtype=int)
+    assert unpickled.align("ATTA", "ATTTA", gap_incentive) == aligner.align("ATTA", "ATTTA", gap_incentive)
+
+
+def test_aligner_score_matches_align():
+    """Test that the score-only pass gives the same score as a full alignment."""
+    ref = "CGGATGTTCCAATCAGTACGCAGAGAGTCGCCGTCTCCAAGGTGAAAGCGGAAGTAGGGCCTTCGCGCACCTCATGGAATCCCTTCTGCAGCACCTGGATC"
+    reads = [
+        ref,
+        ref[:60] + ref[70:],
+        ref[:30] + "TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT" + ref[30:],
+        ref[:40] + "A" + ref[41:],
+        ref[10:90],
+        "GATTACA",
+    ]
+    gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+    gap_incentive[60] = 1
+    for max_indel_size in [-1, 0, 5]:
+        aligner = CRISPResso2Align.Aligner(ALN_MATRIX, gap_open=-20, gap_extend=-2, max_indel_size=max_indel_size)
+        for read in reads:
+            assert aligner.score(read, ref, gap_incentive) == aligner.align(read, ref, gap_incentive)[2]
+
+
+
+def test_aligner_align_edits_matches_find_indels_substitutions():
+    """Test that the modifications found in the traceback match those found from the aligned strings."""
+    ref = "CGGATGTTCCAATCAGTACGCAGAGAGTCGCCGTCTCCAAGGTGAAAGCGGAAGTAGGGCCTTCGCGCACCTCATGGAATCCCTTCTGCAGCACCTGGATC"
+    reads = [
+        ref,
+        ref[:60] + ref[70:],
+        ref[:60] + "TTTT" + ref[60:],
+        ref[:40] + "A" + ref[41:],
+        ref[10:90],
+        "GATTACA",
+    ]
+    gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+    gap_incentive[60] = 1
+    include_idxs = list(range(50, 70))
+    include_mask = CRISPRessoCOREResources.get_include_mask(include_idxs, len(ref))
+    aligner = CRISPResso2Align.Aligner(ALN_MATRIX, gap_open=-20, gap_extend=-2, max_indel_size=5)
+    for read in reads:
+        aln_read, aln_ref, score = aligner.align(read, ref, gap_incentive)
+        alignment = aligner.align_edits(read, ref, gap_incentive, include_mask)
+        assert (alignment.aligned_read, alignment.aligned_ref, alignment.score) == (aln_read, aln_ref, score)
+        expected = CRISPRessoCOREResources.find_indels_substitutions(aln_read, aln_ref, include_idxs)
+        edits = CRISPRessoCOREResources.payload_to_lists(alignment.edits)
+        for key, value in expected.__dict__.items():
+            assert str(edits[key]) == str(value), key
+
+
+def test_global_align_batch_matches_global_align():
+    """Test that aligning a batch of reads gives the same results as aligning each read."""
+    ref = "CGGATGTTCCAATCAGTACGCAGAGAGTCGCCGTCTCCAAGGTGAAAGCGGAAGTAGGGCCTTCGCGCACCTCATGGAATCCCTTCTGCAGCACCTGGATC"
+    reads = [
+        ref,
+        ref[:60] + ref[70:],
+        ref[:60] + "TTTT" + ref[60:],
+        ref[:30] + "TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT" + ref[30:],
+        ref[10:90],
+        "GATTACA",
+    ]
+    gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+    gap_incentive[60] = 1
+    batch = CRISPResso2Align.global_align_batch(reads, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive, gap_open=-20, gap_extend=-2, max_indel_size=5)
+    assert batch == [
+        CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive, gap_open=-20, gap_extend=-2)
+        for read in reads
+    ]
+    assert CRISPResso2Align.global_align_batch([], ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive) == []
+
+def test_global_align_score_overflow_falls_back():
+    """Test that alignments whose scores exceed 16 bits are still computed exactly."""
+    ref = "CGGATGTTCCAATCAGTACGCAGAGAGTCGCCGTCTCCAAGGTGAAAGCGGAAGTAGGGCCTTCGCGCACCTCATGGAATCCCTTCTGCAGCACCTGGATC" * 2
+    read = ref[:100] + ref[104:]
+    matrix = CRISPResso2Align.make_matrix(match_score=200, mismatch_score=-200)
+    gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+    seq1, seq2, score = CRISPResso2Align.global_align(read, ref, matrix=matrix, gap_incentive=gap_incentive, gap_open=-20, gap_extend=-2)
+    assert seq1.replace("-", "") == read
+    assert seq2 == ref
+    assert seq1.count("-") == 4
+    assert score == round(100 * len(read) / len(ref), 3)
+
+def test_global_align_linear_space_matches_full():
+    """Test that the linear-space traceback gives the same alignments as the full matrix, including for long sequences."""
+    rng = np.random.default_rng(4)
+    ref = "".join(rng.choice(list("ACGT"), 2500))
+    reads = [
+        ref[:1200] + ref[1210:2400] + "TTTTTTTT",
+        ref[40:1300] + "GGGGGGGGGGGGGGGGGGGGGGGGGGGGGGGGGGGG" + ref[1300:],
+        "AAAA" + ref[:700] + ref[1700:],
+    ]
+    gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+    gap_incentive[1200] = 1
+    for read in reads:
+        for max_indel_size in [-1, 30]:
+            full = CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive, gap_open=-20, gap_extend=-2, max_indel_size=max_indel_size)
+            linear = CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive, gap_open=-20, gap_extend=-2, max_indel_size=max_indel_size, linear_space_threshold=0)
+            assert linear == full
+    aligner = CRISPResso2Align.Aligner(ALN_MATRIX, -20, -2, 30, 1000)
+    assert pickle.loads(pickle.dumps(aligner)).linear_space_threshold == 1000
+    assert aligner.align_batch(reads[:1] + ["ACGT"], ref, gap_incentive) == [
+        CRISPResso2Align.global_align(read, ref, matrix=ALN_MATRIX, gap_incentive=gap_incentive, gap_open=-20, gap_extend=-2)
+        for read in reads[:1] + ["ACGT"]
+    ]
+
+def test_global_align_ungapped_reads():
+    """Test that reads with only substitutions are aligned without gaps, and that shifted reads still get end gaps."""
+    ref = "AATGTCAGCTGACGTTCCAT"
+    gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+    aligner = CRISPResso2Align.Aligner(ALN_MATRIX, -20, -2)
+    assert aligner.align(ref, ref, gap_incentive) == (ref, ref, 100.0)
+    read = "AATGTCAGCTGTCGTTCCAN"
+    assert aligner.align(read, ref, gap_incentive) == (read, ref, 90.0)
+    assert aligner.score(read, ref, gap_incentive) == 90.0
+    read = ref[1:] + "G"
+    assert aligner.align(read, ref, gap_incentive) == ("-ATGTCAGCTGACGTTCCATG", "AATGTCAGCTGACGTTCCAT-", 90.476)
+    assert aligner.score(read, ref, gap_incentive) == 90.476
 
 if __name__ == "__main__":
     # execute only if run as a script
@@ -0,0 +1,64 @@
+"""Tests for CRISPRessoAlignmentCache module."""
+
+import multiprocessing as mp
+import pickle
+
+import numpy as np
+
+from CRISPResso2 import CRISPRessoAlignmentCache
+
+
+def test_alignment_cache_get_put(tmp_path):
+    """Test that stored variants are returned by later caches with the same context, and only those."""
+    cache = CRISPRessoAlignmentCache.AlignmentCache(str(tmp_path), {'refs': ['AAAA']})
+    assert cache.get('ACGT') is None
+    variant = {'aln_scores': [100.0], 'payload': np.array([1, 2, 3])}
+    cache.put('ACGT', variant)
+    variant['count'] = 5
+    cached = cache.get('ACGT')
+    assert cached['aln_scores'] == [100.0]
+    assert 'count' not in cached
+    cache.close()
+
+    cache = CRISPRessoAlignmentCache.AlignmentCache(str(tmp_path), {'refs': ['AAAA']})
+    assert np.array_equal(cache.get('ACGT')['payload'], [1, 2, 3])
+    assert cache.get('TTTT') is None
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+    other_cache = CRISPRessoAlignmentCache.AlignmentCache(str(tmp_path), {'refs': ['AAAC']})
+    assert other_cache.get('ACGT') is None
+
+
+def test_alignment_cache_evicts_least_recently_used(tmp_path):
+    """Test that the least recently used entries are evicted when the cache grows larger than its maximum size."""
+    value_size = len(pickle.dumps('A' * 1000, protocol=pickle.HIGHEST_PROTOCOL))
+    cache = CRISPRessoAlignmentCache.AlignmentCache(str(tmp_path), 'context', max_size_mb=2.5 * value_size / (1024 * 1024), batch_size=1)
+    cache.put('read1', 'A' * 1000)
+    cache.put('read2', 'A' * 1000)
+    assert cache.get('read1') is not None
+    cache.put('read3', 'A' * 1000)
+    cache.flush()
+    assert cache.get('read2') is None
+    assert cache.get('read1') is not None
+    assert cache.get('read3') is not None
+    stats = cache.get_stats()
+    assert (stats['evictions'], stats['entries']) == (1, 2)
+
+
+def _put_in_cache(cache):
+    cache.get('ACGT')
+    cache.put('TTTT', 'variant')
+    cache.flush()
+
+
+def test_alignment_cache_in_other_process(tmp_path):
+    """Test that a cache passed to another process stores its entries in the same database and shares the statistics."""
+    cache = CRISPRessoAlignmentCache.AlignmentCache(str(tmp_path), 'context')
+    process = mp.Process(target=_put_in_cache, args=(cache,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert cache.get('TTTT') == 'variant'
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
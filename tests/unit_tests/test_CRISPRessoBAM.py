@@ -0,0 +1,109 @@
+"""Tests for CRISPRessoBAM module."""
+
+import gzip
+import shutil
+import struct
+
+import pytest
+
+from CRISPResso2 import CRISPRessoBAM, CRISPRessoShared
+
+REFERENCES = [('chr1', 100000), ('chr2', 1000)]
+
+
+def _reg2bin(beg, end):
+    """Return the BAI bin of the 0-based region [beg, end)."""
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+def _make_record(name, ref_id, pos, seq, flag=0, cigar=None):
+    """Return the data of a BAM record, aligned with cigar (a list of (length, operation code), all M by default)."""
+    cigar = cigar if cigar is not None else [(len(seq), 0)]
+    name = name.encode() + b'\0'
+    codes = {base: code for code, base in enumerate('=ACMGRSVTWYHKDBN')}
+    padded_seq = seq + '=' * (len(seq) % 2)
+    packed_seq = bytes(codes[padded_seq[i]] << 4 | codes[padded_seq[i + 1]] for i in range(0, len(padded_seq), 2))
+    header = CRISPRessoBAM.BAM_RECORD_HEADER.pack(ref_id, pos, len(name), 60, _reg2bin(pos, pos + 1), len(cigar), flag, len(seq), -1, -1, 0)
+    return header + name + b''.join(struct.pack('<I', length << 4 | op) for length, op in cigar) + packed_seq + b'\x1e' * len(seq)
+
+
+def _write_bam(path, records):
+    with CRISPRessoBAM.BamWriter(str(path), '@HD\tVN:1.6\tSO:coordinate\n', REFERENCES) as bam_writer:
+        for record in records:
+            bam_writer.write(record)
+    return str(path)
+
+
+def test_bam_writer_and_reader(tmp_path):
+    """Test that records written to a BAM file are read back with their sequence, flag and added tags."""
+    bam_filename = str(tmp_path / 'reads.bam')
+    with CRISPRessoBAM.BamWriter(bam_filename, '@HD\tVN:1.6\tSO:coordinate\n', REFERENCES) as bam_writer:
+        bam_writer.write(_make_record('read1', 0, 10, 'ACGTN'), {'c2': 'ALN=Reference CLASS=Reference_UNMODIFIED'})
+        bam_writer.write(_make_record('read2', 0, 20, 'GGCA', flag=16))
+        bam_writer.write(_make_record('read3', -1, -1, '', flag=4))
+        for i in range(10000):
+            bam_writer.write(_make_record('read%d' % (i + 4), 1, i % 900, 'ACGT' * 10))
+
+    with gzip.open(bam_filename) as fh:
+        assert fh.read(4) == b'BAM\x01'
+    with CRISPRessoBAM.BamReader(bam_filename) as bam_reader:
+        assert bam_reader.header_text == '@HD\tVN:1.6\tSO:coordinate\n'
+        assert bam_reader.references == REFERENCES
+        records = list(bam_reader.fetch())
+    assert len(records) == 10003
+    assert [(record.seq, record.flag) for record in records[:3]] == [('ACGTN', 0), ('GGCA', 16), ('*', 4)]
+    assert records[0].data.endswith(b'c2ZALN=Reference CLASS=Reference_UNMODIFIED\0')
+    assert records[-1].seq == 'ACGT' * 10
+
+
+def test_bam_reader_fetch_region(tmp_path):
+    """Test that the records overlapping a region are read from a file without an index."""
+    records = [
+        _make_record('before', 0, 10, 'A' * 10),
+        _make_record('overlap_start', 0, 95, 'A' * 10),
+        _make_record('deletion', 0, 96, 'A' * 4, cigar=[(2, 0), (10, 2), (2, 0)]),
+        _make_record('unmapped', 0, 98, 'A' * 10, flag=4),
+        _make_record('inside', 0, 150, 'A' * 10),
+        _make_record('far', 0, 50000, 'A' * 10),
+        _make_record('other_chr', 1, 120, 'A' * 10),
+    ]
+    bam_filename = _write_bam(tmp_path / 'reads.bam', records)
+    expected_names = [b'overlap_start', b'deletion', b'inside']
+    with CRISPRessoBAM.BamReader(bam_filename) as bam_reader:
+        assert [record.data[32:].split(b'\0')[0] for record in bam_reader.fetch('chr1:101-200')] == expected_names
+        assert len(list(bam_reader.fetch('chr1:1,000-60,000'))) == 1
+        assert len(list(bam_reader.fetch('chr1'))) == 6
+        assert len(list(bam_reader.fetch('chr2:100'))) == 1
+        assert list(bam_reader.fetch('chr1:60000-70000')) == []
+        with pytest.raises(CRISPRessoShared.BadParameterException):
+            list(bam_reader.fetch('chr3:1-100'))
+
+
+def test_bam_reader_fetch_region_with_index(tmp_path):
+    """Test that fetching a region through the .bai index gives the records found by scanning the whole file."""
+    bam_filename = 'tests/Both.Cas9.fastq.smallGenome.bam'
+    unindexed_filename = str(tmp_path / 'unindexed.bam')
+    shutil.copyfile(bam_filename, unindexed_filename)
+    with CRISPRessoBAM.BamReader(bam_filename) as bam_reader, CRISPRessoBAM.BamReader(unindexed_filename) as unindexed_reader:
+        n_fetched = 0
+        for name, length in bam_reader.references:
+            for region in [name, '%s:1-%d' % (name, length // 2), '%s:%d-%d' % (name, length // 3, length)]:
+                indexed_records = [record.data for record in bam_reader.fetch(region)]
+                assert indexed_records == [record.data for record in unindexed_reader.fetch(region)], region
+                n_fetched += len(indexed_records)
+    assert n_fetched > 0
+
+
+def test_parse_flags():
+    """Test that flags are parsed as samtools does."""
+    assert CRISPRessoBAM.parse_flags('0') == 0
+    assert CRISPRessoBAM.parse_flags('4') == 4
+    assert CRISPRessoBAM.parse_flags('0x904') == 0x904
+    assert CRISPRessoBAM.parse_flags('010') == 8
+    assert CRISPRessoBAM.parse_flags('UNMAP,SECONDARY') == 0x104
+    with pytest.raises(CRISPRessoShared.BadParameterException):
+        CRISPRessoBAM.parse_flags('UNMAPPED')
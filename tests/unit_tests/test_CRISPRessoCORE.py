@@ -1,6 +1,7 @@
 """Unit tests for CRISPResso2CORE."""
 import os
 import pytest
+import numpy as np
 import pandas as pd
 from pytest_check import check
 
@@ -858,6 +859,137 @@ def test_get_cloned_include_idxs_from_quant_window_coordinates_include_zero():
     assert CRISPRessoCORE.get_cloned_include_idxs_from_quant_window_coordinates(quant_window_coordinates, s1inds) == [0, 1, 2, 3, 4]
 
 
+# =============================================================================
+# Tests for count_fastq_reads
+# =============================================================================
+
+
+def _write_reads(path, seqs, quals=None):
+    # qualities starting with '@' check that records are found at the start of byte ranges
+    quals = quals or ['@' + 'I' * (len(seq) - 1) for seq in seqs]
+    path.write_text(''.join(f'@read{i}\n{seq}\n+\n{qual}\n' for i, (seq, qual) in enumerate(zip(seqs, quals))))
+    return str(path)
+
+
+@pytest.mark.parametrize("n_processes", [1, 3])
+def test_count_fastq_reads(tmp_path, n_processes):
+    """Test that unique reads are counted in the order they were first seen, with one or several processes."""
+    seqs = ['ACGT', 'TTGA', 'ACGT', 'CCCC', 'TTGA', 'GGAT', 'ACGT', 'CAGT', 'AACC', 'GGAT'] * 5 + ['TTTT']
+    fastq = _write_reads(tmp_path / 'reads.fastq', seqs)
+    variantCache = {}
+    assert CRISPRessoCORE.count_fastq_reads(variantCache, fastq, n_processes=n_processes) == (51, True)
+    assert [(CRISPRessoCOREResources.unpack_sequence(key), count) for key, count in variantCache.items()] == [('ACGT', 15), ('TTGA', 10), ('CCCC', 5), ('GGAT', 10), ('CAGT', 5), ('AACC', 5), ('TTTT', 1)]
+
+
+@pytest.mark.parametrize("n_processes", [1, 3])
+def test_count_fastq_reads_paired(tmp_path, n_processes):
+    """Test that unique read pairs are counted with the qualities of their first pair, and that files of different lengths are reported."""
+    fastq1 = _write_reads(tmp_path / 'r1.fastq', ['ACGT', 'AAAA', 'ACGT', 'CCCC'], ['IIII', 'HHHH', 'GGGG', 'FFFF'])
+    fastq2 = _write_reads(tmp_path / 'r2.fastq', ['AACG', 'TTTT', 'AACG'], ['ABCD', 'EEEE', 'DDDD'])
+    variantCache = {}
+    assert CRISPRessoCORE.count_fastq_reads(variantCache, fastq1, fastq2, n_processes) == (3, False)
+    assert variantCache == {CRISPRessoCOREResources.pack_sequence('ACGT+CGTT'): [2, 'IIII DCBA'], CRISPRessoCOREResources.pack_sequence('AAAA+AAAA'): [1, 'HHHH EEEE']}
+    assert [CRISPRessoCOREResources.unpack_sequence(key) for key in variantCache] == ['ACGT+CGTT', 'AAAA+AAAA']
+
+
+def test_get_n_memory_partitions(tmp_path):
+    """Test that reads that may not fit in the memory budget are split into partitions."""
+    fastq = _write_reads(tmp_path / 'reads.fastq', ['A' * 100] * 10)
+    assert CRISPRessoCORE.get_n_memory_partitions(fastq, 10, 0) == 1
+    assert CRISPRessoCORE.get_n_memory_partitions(fastq, 1000, 10) == 1
+    n_reads = 10 * 1024 * 1024 // (100 * CRISPRessoCORE.VARIANT_BYTES_PER_BASE)
+    assert CRISPRessoCORE.get_n_memory_partitions(fastq, n_reads, 1) == 10
+    assert CRISPRessoCORE.get_n_memory_partitions(fastq, n_reads + 1, 1) == 11
+
+
+def test_variant_file_records(tmp_path):
+    """Test that variant objects are read back from variant files as they were written, and that truncated files are detected."""
+    variant_file_path = CRISPRessoCORE.get_variant_file_path(str(tmp_path), 0)
+    variant = {'best_match_score': 90.0, 'aln_ref_names': ['Reference'], 'variant_Reference': {'ref_positions': [0, 1, -1, 2], 'insertion_coordinates': [(1, 3)], 'substitution_values': np.array([65, 67], dtype=np.int32)}}
+    with open(variant_file_path, 'wb') as fh:
+        CRISPRessoCORE.write_variant_records(fh, [('ACGT', variant), ('AAAA', {'best_match_score': 0})])
+        CRISPRessoCORE.write_variant_records(fh, [])
+        CRISPRessoCORE.write_variant_records(fh, [('CCCC', {'best_match_score': 10.0})])
+    records = list(CRISPRessoCORE.read_variant_files([variant_file_path]))
+    assert [seq for seq, _ in records] == ['ACGT', 'AAAA', 'CCCC']
+    payload = records[0][1]['variant_Reference']
+    assert payload['ref_positions'] == [0, 1, -1, 2]
+    assert payload['insertion_coordinates'] == [(1, 3)]
+    assert payload['substitution_values'].dtype == np.int32
+    assert np.array_equal(payload['substitution_values'], [65, 67])
+
+    with open(variant_file_path, 'rb') as fh:
+        data = fh.read()
+    with open(variant_file_path, 'wb') as fh:
+        fh.write(data[:-1])
+    with pytest.raises(CRISPRessoShared.OutputFolderIncompleteException):
+        list(CRISPRessoCORE.read_variant_files([variant_file_path]))
+
+
+def test_read_variant_files_in_chunk_order(tmp_path):
+    """Test that records of several variant files are read back in the order of their chunks."""
+    variant_file_paths = [CRISPRessoCORE.get_variant_file_path(str(tmp_path), i) for i in range(3)]
+    with open(variant_file_paths[0], 'wb') as fh:
+        CRISPRessoCORE.write_variant_records(fh, [('C', 2)], 2)
+        CRISPRessoCORE.write_variant_records(fh, [('D', 3), ('E', 4)], 3)
+    with open(variant_file_paths[1], 'wb') as fh:
+        CRISPRessoCORE.write_variant_records(fh, [('A', 0), ('B', 1)], 0)
+    open(variant_file_paths[2], 'wb').close()
+    assert list(CRISPRessoCORE.read_variant_files(variant_file_paths)) == [('A', 0), ('B', 1), ('C', 2), ('D', 3), ('E', 4)]
+
+
+def test_get_weighted_chunks():
+    """Test that reads are split into consecutive chunks of similar total length."""
+    seq_list = ['A' * 10] * 64 + ['A' * 80] * 8
+    chunks = CRISPRessoCORE.get_weighted_chunks(seq_list, 2, 1)
+    assert len(chunks) == CRISPRessoCORE.CHUNKS_PER_PROCESS
+    assert chunks == [(i, i + 8) for i in range(0, 64, 8)] + [(i, i + 1) for i in range(64, 72)]
+    assert CRISPRessoCORE.get_weighted_chunks([], 2, 4) == []
+    assert len(CRISPRessoCORE.get_weighted_chunks(['ACGT'] * 3, 1, 4)) == 3
+
+
+def test_get_frequency_interval():
+    """Test the Wilson score interval of a modified frequency."""
+    low, high = CRISPRessoCORE.get_frequency_interval(50, 100)
+    assert low == pytest.approx(0.4038, abs=1e-4)
+    assert high == pytest.approx(0.5962, abs=1e-4)
+    low, high = CRISPRessoCORE.get_frequency_interval(0, 1000)
+    assert low == pytest.approx(0, abs=1e-12)
+    assert 0 < high < 0.004
+    assert CRISPRessoCORE.get_frequency_interval(0, 0) == (0.0, 1.0)
+
+
+def test_align_fastq_to_convergence(monkeypatch):
+    """Test that reads are drawn until the modified frequency is known to within the precision or the read budget."""
+    def get_variants(seq_list, *args, **kwargs):
+        for seq in seq_list:
+            classification = 'MODIFIED' if seq.startswith('T') else 'UNMODIFIED'
+            yield {'best_match_score': 0 if seq.startswith('N') else 100, 'class_name': 'Reference_' + classification, 'aln_ref_names': ['Reference'],
+                   'variant_Reference': {'classification': classification, 'insertion_n': 0, 'deletion_n': 0}}
+    monkeypatch.setattr(CRISPRessoCORE, 'get_new_variant_objects_threaded', get_variants)
+
+    def get_variant_cache():
+        variant_cache = {'A' * 10: 70000, 'T' * 10: 20000, 'N' * 10: 10000}
+        variant_cache.update({'T' * 9 + 'A' * (i + 1): 1 for i in range(20)})
+        return variant_cache
+
+    args = type('Args', (), {'convergence_precision': 0.01, 'convergence_max_reads': 0, 'discard_indel_reads': False})
+    variant_cache = get_variant_cache()
+    new_variants, convergence = CRISPRessoCORE.align_fastq_to_convergence(variant_cache, args, {}, ['Reference'], None, None, None, 1)
+    assert convergence == {'n_reads_analyzed': 10000, 'n_reads': 100020, 'precision': 0.01, 'converged': True}
+    assert sum(variant_cache.values()) == 10000
+    assert len(new_variants) == len(variant_cache)
+    assert variant_cache['A' * 10] == pytest.approx(7000, rel=0.05)
+
+    args.convergence_precision = 0.001
+    args.convergence_max_reads = 25000
+    variant_cache = get_variant_cache()
+    new_variants, convergence = CRISPRessoCORE.align_fastq_to_convergence(variant_cache, args, {}, ['Reference'], None, None, None, 1)
+    assert convergence['n_reads_analyzed'] == 25000
+    assert not convergence['converged']
+    assert sum(variant_cache.values()) == 25000
+
+
 # =============================================================================
 # Tests for get_variant_cache_equal_boundaries (parallelization functions)
 # =============================================================================
@@ -1817,6 +1949,88 @@ def test_coding_seq_filename_never_too_long():
     assert len(table_filename.encode('utf-8')) <= 255
 
 
+# =============================================================================
+# Tests for build_kmer_index and get_score_upper_bounds
+# =============================================================================
+
+
+def test_build_kmer_index():
+    """Test that k-mers are indexed for each reference and its reverse complement."""
+    kmer_index = CRISPRessoCORE.build_kmer_index(['AACCGG', 'TTTTAA'], 4)
+
+    assert kmer_index['kmer_size'] == 4
+    assert kmer_index['ref_lengths'] == [6, 6]
+    assert kmer_index['kmer_masks']['AACC'] == 0b01
+    assert kmer_index['kmer_masks']['CCGG'] == 0b11  # palindrome, on both strands
+    assert kmer_index['kmer_masks']['TTTT'] == 0b0100
+    assert kmer_index['kmer_masks']['TTAA'] == 0b1100
+    assert kmer_index['kmer_masks']['AAAA'] == 0b1000
+
+
+def test_get_score_upper_bounds_are_upper_bounds():
+    """Test that alignment scores never exceed the k-mer score bounds."""
+    refs = [
+        'CGGATGTTCCAATCAGTACGCAGAGAGTCGCCGTCTCCAAGGTGAAAGCGGAAGTAGGGCCTTCGCGCACCTCATGGAATCCCTTCTGCAGCACCTGGATC',
+        'GCTTTTCCGAGCTTCTGGCGGTCTCAAGCACTACCTACGTCAGCACCTGGGACCCCGCCACCGTGCGCCGGGCCTTGCAGTGGGCGCGCTACCTGCGCC',
+    ]
+    reads = [
+        refs[0],
+        refs[0][:40] + refs[0][50:],
+        refs[0][:40] + 'TTTTT' + refs[0][40:70] + 'A' + refs[0][71:],
+        CRISPRessoShared.reverse_complement(refs[1][5:]),
+        refs[1][:50] + refs[0][50:],
+        'ACGT',
+    ]
+    kmer_index = CRISPRessoCORE.build_kmer_index(refs, 10)
+    for read in reads:
+        score_bounds = CRISPRessoCORE.get_score_upper_bounds(kmer_index, read)
+        for ref, (fw_bound, rc_bound) in zip(refs, score_bounds):
+            gap_incentive = np.zeros(len(ref) + 1, dtype=int)
+            fw_score = CRISPResso2Align.global_align(read, ref, ALN_MATRIX, gap_incentive, -20, -2)[2]
+            rc_score = CRISPResso2Align.global_align(CRISPRessoShared.reverse_complement(read), ref, ALN_MATRIX, gap_incentive, -20, -2)[2]
+            assert fw_score <= fw_bound
+            assert rc_score <= rc_bound
+
+    assert CRISPRessoCORE.get_score_upper_bounds(kmer_index, refs[0])[0][0] == 100.0
+    assert max(CRISPRessoCORE.get_score_upper_bounds(kmer_index, refs[0])[1]) < 100.0
+
+
+def test_hdr_run_with_pruned_references(tmp_path, monkeypatch):
+    """Test that the first reference is still aligned when references are pruned, as the HDR analysis maps all reads onto it."""
+    amplicon = 'CGGATGTTCCAATCAGTACGCAGAGAGTCGCCGTCTCCAAGGTGAAAGCGGAAGTAGGGCCTTCGCGCACCTCATGGAATCCCTTCTGCAGCACCTGGATCGCTTTTCCGAGCTTCTGGCGGTCTCAAGCACTACCTACGTCAGCACC'
+    hdr = amplicon[:50] + 'T' + amplicon[51:95] + amplicon[105:]
+    fastq_path = tmp_path / 'reads.fastq'
+    with open(fastq_path, 'w') as fastq_file:
+        for idx in range(20):
+            seq = hdr if idx % 2 else amplicon
+            fastq_file.write('@read%d\n%s\n+\n%s\n' % (idx, seq, 'I' * len(seq)))
+
+    kmer_index = CRISPRessoCORE.build_kmer_index([amplicon, hdr], 10)
+    assert max(CRISPRessoCORE.get_score_upper_bounds(kmer_index, hdr)[0]) < 100.0  # the HDR reads would prune the amplicon
+
+    monkeypatch.setattr('sys.argv', [
+        'CRISPResso', '-r1', str(fastq_path), '-a', amplicon, '-e', hdr, '-o', str(tmp_path), '-n', 'hdr',
+        '--aln_prune_references', '--suppress_report', '--suppress_plots',
+    ])
+    with pytest.raises(SystemExit) as exit_info:
+        CRISPRessoCORE.main()
+    assert exit_info.value.code == 0
+
+    quantification = pd.read_csv(tmp_path / 'CRISPResso_on_hdr' / 'CRISPResso_quantification_of_editing_frequency.txt', sep='\t')
+    assert quantification.set_index('Amplicon')['Reads_aligned'].to_dict() == {'Reference': 10, 'HDR': 10}
+
+
+def test_get_scores_and_counts_skips_pruned_references():
+    """Test that references without a score (pruned with --aln_prune_references) are ignored."""
+    variant_dict = {
+        'seq1': {'aln_scores': [None, 90.0], 'count': 10},
+    }
+
+    homology_scores, counts, alleles_data = CRISPRessoCORE.get_scores_and_counts(variant_dict)
+
+    assert homology_scores == [90.0]
+
+
 # =============================================================================
 # Tests for coding_seq_names parsing logic
 # =============================================================================
@@ -1,3 +1,7 @@
+import gzip
+import pickle
+
+import numpy as np
 import pytest
 
 from CRISPResso2 import CRISPRessoCOREResources
@@ -238,6 +242,64 @@ def test_find_indels_substitutions():
     assert payload["ref_positions"] == correct_payload["ref_positions"]
 
 
+def test_find_indels_substitutions_arrays():
+    """Test that the window mask and array payload give the same results as find_indels_substitutions."""
+    include_idxs = [-1, 2, 3, 4, 5, 6, 7, 30]
+    mask = CRISPRessoCOREResources.get_include_mask(include_idxs, 12)
+    assert mask.tolist() == [0, 0, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0]
+
+    read_seq_al = 'AT-GCAAATTCCAT--'
+    ref_seq_al = 'ATCGC--TTACCATGG'
+    payload = CRISPRessoCOREResources.find_indels_substitutions_arrays(read_seq_al.encode('ascii'), ref_seq_al.encode('ascii'), mask)
+    expected = CRISPRessoCOREResources.find_indels_substitutions(read_seq_al, ref_seq_al, include_idxs)
+    with_mask = CRISPRessoCOREResources.find_indels_substitutions(read_seq_al, ref_seq_al, include_idxs, mask)
+    for key, value in expected.__dict__.items():
+        assert str(with_mask[key]) == str(value), key
+        if key.endswith('coordinates'):
+            assert payload[key].dtype == np.int32
+            assert [tuple(coordinate) for coordinate in payload[key].tolist()] == value, key
+        elif key.endswith('values'):
+            assert payload[key].tolist() == value.tolist(), key
+        elif isinstance(value, list):
+            assert payload[key].dtype == np.int32
+            assert payload[key].tolist() == value, key
+        else:
+            assert payload[key] == value, key
+
+
+def test_results_slots_dict_pickle():
+    """Test that ResultsSlotsDict reads and writes fields like a dict and keeps their values and types when pickled."""
+    payload = CRISPRessoCOREResources.find_indels_substitutions('AT-GCAAATTCCAT--', 'ATCGC--TTACCATGG', [2, 3, 4, 5])
+    payload['aln_seq'] = 'AT-GCAAATTCCAT--'
+    payload['total_mods'] = 6.0
+    with pytest.raises(AttributeError):
+        payload['aln_ref']
+    with pytest.raises(AttributeError):
+        payload['not_a_field'] = 1
+    assert 'aln_ref' not in payload.__dict__
+    assert list(payload.__dict__) == [field for field in CRISPRessoCOREResources.ResultsSlotsDict.__slots__ if field in payload.__dict__]
+
+    counts = CRISPRessoCOREResources.ResultsSlotsDict(deletion_n=2.5, insertion_n=np.int64(3), substitution_n=2**70, mods_in_window=4)
+    assert counts['deletion_n'] == 2.5
+    assert type(counts['insertion_n']) is np.int64
+    assert counts['substitution_n'] == 2**70
+    assert counts['mods_in_window'] == 4
+    counts['deletion_n'] = 1
+    assert type(counts['deletion_n']) is int and counts['deletion_n'] == 1
+
+    empty = CRISPRessoCOREResources.find_indels_substitutions('ACGT', 'ACGT', [1])
+    for expected in [payload, empty, counts]:
+        unpickled = pickle.loads(pickle.dumps(expected))
+        assert isinstance(unpickled, CRISPRessoCOREResources.ResultsSlotsDict)
+        assert list(unpickled.__dict__) == list(expected.__dict__)
+        for key, value in expected.__dict__.items():
+            assert type(unpickled[key]) is type(value), key
+            if isinstance(value, np.ndarray):
+                assert unpickled[key].dtype == value.dtype and unpickled[key].tolist() == value.tolist(), key
+            else:
+                assert unpickled[key] == value, key
+
+
 # =============================================================================
 # Tests for find_indels_substitutions_legacy function
 # =============================================================================
@@ -289,6 +351,172 @@ def test_find_indels_substitutions_legacy():
     assert payload["ref_positions"] == correct_payload["ref_positions"]
 
 
+# =============================================================================
+# Tests for SeedMatcher
+# =============================================================================
+
+
+def test_seed_matcher_counts_seeds():
+    """Test that SeedMatcher counts the same seeds as substring searches."""
+    fw_seeds = [["ACGTAC", "GGTTCA", "TTTACG"], ["CCCGGG", "ACGTAC"]]
+    rc_seeds = [["GTACGT", "TGAACC", "CGTAAA"], ["CCCGGG", "GTACGT"]]
+    matcher = CRISPRessoCOREResources.SeedMatcher(fw_seeds, rc_seeds)
+    reads = ["AAACGTACGGTTCAGG", "TTGAACCCGTAAAGTACGT", "CCCGGGT", "", "NNNN"]
+    for read in reads:
+        assert matcher.count_seeds(read) == (
+            [sum(seed in read for seed in seeds) for seeds in fw_seeds],
+            [sum(seed in read for seed in seeds) for seeds in rc_seeds],
+        )
+    assert matcher.count_seeds("AAACGTACGGTT", "TTTACGA") == ([2, 1], [0, 0])
+
+
+def test_seed_matcher_overlapping_and_repeated_seeds():
+    """Test that seeds that are suffixes of other seeds and seeds repeated in a list are all counted."""
+    matcher = CRISPRessoCOREResources.SeedMatcher([["AACG", "ACG", "CG", "CG"]], [["TTT"]])
+    assert matcher.count_seeds("GAACGT") == ([4], [0])
+    assert matcher.count_seeds("GACGTTT") == ([3], [1])
+
+
+def test_seed_matcher_pickle():
+    """Test that a SeedMatcher can be sent to other processes."""
+    matcher = CRISPRessoCOREResources.SeedMatcher([["ACGT"]], [["ACGA"]])
+    assert pickle.loads(pickle.dumps(matcher)).count_seeds("TACGAT") == ([0], [1])
+
+
+def _write_fastq(path, text):
+    if path.suffix == '.gz':
+        with gzip.open(path, 'wt') as fastq_handle:
+            fastq_handle.write(text)
+    else:
+        path.write_text(text)
+    return str(path)
+
+
+@pytest.mark.parametrize("filename", ["reads.fastq", "reads.fastq.gz"])
+def test_fastq_reader_records(tmp_path, filename):
+    """Test that records are read across blocks, and that a truncated last record is read with empty lines."""
+    fastq = _write_fastq(tmp_path / filename, "@r1 a\nACGT \n+\nIIHH\n@r2\nAAC\n+r2\nIII\n@r3\nGG")
+    with CRISPRessoCOREResources.FastqReader(fastq, block_size=3) as reader:
+        assert list(reader) == [("@r1 a", "ACGT", "+", "IIHH"), ("@r2", "AAC", "+r2", "III"), ("@r3", "GG", "", "")]
+    reader = CRISPRessoCOREResources.FastqReader(fastq, reverse_complement=True)
+    assert next(reader) == ("@r1 a", "ACGT", "+", "HHII")
+    assert next(reader) == ("@r2", "GTT", "+r2", "III")
+    reader.close()
+
+
+def test_fastq_reader_count_sequences(tmp_path):
+    """Test that the sequences of single-end reads are counted."""
+    fastq = _write_fastq(tmp_path / "reads.fastq.gz", "@r1\nACGT\n+\nIIII\n@r2\nAAC\n+\nIII\n@r3\nACGT\n+\nHHHH\n")
+    counts = {}
+    with CRISPRessoCOREResources.FastqReader(fastq) as reader:
+        assert reader.count_sequences(counts) == 3
+        assert reader.at_end()
+    assert counts == {"ACGT": 2, "AAC": 1}
+
+    counts = {}
+    with CRISPRessoCOREResources.FastqReader(fastq) as reader:
+        assert reader.count_sequences(counts, max_reads=2) == 2
+        assert counts == {"ACGT": 1, "AAC": 1}
+        assert reader.count_sequences(counts, max_reads=2) == 1
+        assert reader.count_sequences(counts, max_reads=2) == 0
+    assert counts == {"ACGT": 2, "AAC": 1}
+
+    counts = {}
+    with CRISPRessoCOREResources.FastqReader(fastq) as reader:
+        assert reader.count_sequences(counts, pack=True) == 3
+    assert counts == {CRISPRessoCOREResources.pack_sequence("ACGT"): 2, CRISPRessoCOREResources.pack_sequence("AAC"): 1}
+
+
+def test_pack_sequence():
+    """Test that sequences are packed into 2 bits per base plus their other characters, and unpacked back."""
+    for seq in ["", "A", "ACGT", "ACGTN", "NNACGTTT+GGCAnnn--ACG", "A" * 1000 + "N" * 300 + "-" * 200]:
+        assert CRISPRessoCOREResources.unpack_sequence(CRISPRessoCOREResources.pack_sequence(seq)) == seq
+    assert CRISPRessoCOREResources.pack_sequence("ACGTN") == b"\x05\xe4\x00\x04N\x01"
+    assert len(CRISPRessoCOREResources.pack_sequence("ACGT" * 40)) == 42
+    assert CRISPRessoCOREResources.pack_sequence("ACGTA") != CRISPRessoCOREResources.pack_sequence("ACGTN")
+    with pytest.raises(ValueError):
+        CRISPRessoCOREResources.unpack_sequence(b"\x05\xe4")
+
+
+def test_fastq_reader_count_pairs(tmp_path):
+    """Test that read pairs are counted by R1 and reverse complemented R2 sequence, keeping the qualities of the first pair."""
+    fastq1 = _write_fastq(tmp_path / "r1.fastq", "@r1\nACGT\n+\nIIIH\n@r2\nACGT\n+\nHHHH\n@r3\nA\n+\nI\n")
+    fastq2 = _write_fastq(tmp_path / "r2.fastq", "@r1\nacct\n+\nABCD\n@r2\nACCT\n+\nEEEE\n")
+    counts = {}
+    with CRISPRessoCOREResources.FastqReader(fastq1) as reader1, CRISPRessoCOREResources.FastqReader(fastq2, reverse_complement=True) as reader2:
+        assert reader1.count_pairs(reader2, counts) == 2
+        assert not reader1.at_end()
+        assert reader2.at_end()
+    assert counts == {"ACGT+AGGT": [2, "IIIH DCBA"]}
+
+
+def test_fastq_reader_byte_ranges(tmp_path):
+    """Test that readers of consecutive byte ranges read each record once, even when quality lines start with '@'."""
+    text = "".join("@r%d\nACGTA\n+\n@@III\n" % i for i in range(20))
+    fastq = _write_fastq(tmp_path / "reads.fastq", text)
+    records = list(CRISPRessoCOREResources.FastqReader(fastq))
+    for n_ranges in [2, 3, 7, 50]:
+        bounds = [len(text) * i // n_ranges for i in range(n_ranges + 1)]
+        range_records = []
+        for start, end in zip(bounds, bounds[1:]):
+            range_records += list(CRISPRessoCOREResources.FastqReader(fastq, block_size=4, start=start, end=end))
+        assert range_records == records
+    with pytest.raises(ValueError):
+        CRISPRessoCOREResources.FastqReader(_write_fastq(tmp_path / "reads.fastq.gz", text), start=10)
+
+
+def test_fastq_reader_reverse_complement_unknown_base(tmp_path):
+    """Test that reverse complementing a read with an unknown base raises the same error as CRISPRessoShared.reverse_complement."""
+    fastq = _write_fastq(tmp_path / "reads.fastq", "@r1\nACxT\n+\nIIII\n")
+    with pytest.raises(KeyError):
+        list(CRISPRessoCOREResources.FastqReader(fastq, reverse_complement=True))
+
+
+# =============================================================================
+# Tests for the tally kernels
+# =============================================================================
+
+
+def test_tally_kernels():
+    """Test that the tallies give the same vectors as adding to them allele by allele with numpy indexing."""
+    rng = np.random.default_rng(0)
+    expected = {name: np.zeros(50) for name in ['positions', 'insertion_lengths', 'deletion_lengths']}
+    vectors = {name: vector.copy() for name, vector in expected.items()}
+    expected_base_counts = np.zeros((len(CRISPRessoCOREResources.TALLY_NUCS), 50))
+    base_counts = expected_base_counts.copy()
+    for _ in range(200):
+        count = int(rng.integers(1, 10))
+        positions = rng.integers(-5, 50, size=int(rng.integers(0, 6))).tolist()
+        if rng.random() < 0.5:
+            positions.sort()
+        expected['positions'][positions] += count
+        CRISPRessoCOREResources.tally_positions(vectors['positions'], positions, count)
+
+        start = int(rng.integers(0, 40))
+        coordinates = [(start, start + int(rng.integers(1, 4))), (start + 5, start + 5 + int(rng.integers(1, 4)))]
+        sizes = [int(size) for size in rng.integers(1, 5, size=2)]
+        for (start, end), size in zip(coordinates, sizes):
+            expected['insertion_lengths'][start] += size * count
+            expected['insertion_lengths'][end] += size * count
+            expected['deletion_lengths'][list(range(start, end))] += size * count
+        CRISPRessoCOREResources.tally_lengths(vectors['insertion_lengths'], coordinates, sizes, count, False)
+        CRISPRessoCOREResources.tally_lengths(vectors['deletion_lengths'], coordinates, sizes, count, True)
+
+        bases = ''.join(rng.choice(list('ACGTN-X'), size=10))
+        ref_positions = [int(position) for position in rng.permutation(60)[:10] - 10]
+        for nuc, position in zip(bases, ref_positions):
+            if position >= 0 and nuc != 'X':
+                expected_base_counts[CRISPRessoCOREResources.TALLY_NUCS.index(nuc), position] += count
+        CRISPRessoCOREResources.tally_bases(base_counts, bases, ref_positions, count)
+    for name in expected:
+        assert np.array_equal(vectors[name], expected[name]), name
+    assert np.array_equal(base_counts, expected_base_counts)
+    with pytest.raises(IndexError):
+        CRISPRessoCOREResources.tally_positions(vectors['positions'], [50], 1)
+    with pytest.raises(ValueError):
+        CRISPRessoCOREResources.tally_bases(base_counts, 'AC', [0], 1)
+
+
 if __name__ == "__main__":
     # execute only if run as a script
     test_find_indels_substitutions()
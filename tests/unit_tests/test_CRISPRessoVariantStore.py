@@ -0,0 +1,121 @@
+"""Tests for CRISPRessoVariantStore module."""
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from CRISPResso2 import CRISPRessoCOREResources, CRISPRessoVariantStore
+
+
+def test_variant_store_iterates_in_order(tmp_path):
+    """Test that entries are iterated by their order, and that entries set later come after them."""
+    store = CRISPRessoVariantStore.VariantStore(str(tmp_path), 2)
+    store.add_all([(5, 'CCCC', {'count': 1}), (0, 'AAAA', {'count': 3})])
+    store.add_all([(2, 'GGGG', {'count': 2})])
+    store[''] = {'count': 0}
+    assert list(store) == ['AAAA', 'GGGG', 'CCCC', '']
+    assert len(store) == 4
+    assert dict(store.items()) == {'AAAA': {'count': 3}, 'GGGG': {'count': 2}, 'CCCC': {'count': 1}, '': {'count': 0}}
+    assert 'GGGG' in store
+    assert 'TTTT' not in store
+    with pytest.raises(KeyError):
+        store['TTTT']
+    del store['GGGG']
+    assert list(store) == ['AAAA', 'CCCC', '']
+    store.close()
+    assert not os.path.exists(store.path)
+
+
+def test_variant_store_keeps_changes_to_fetched_objects(tmp_path):
+    """Test that changes made to fetched objects are kept after they're evicted from memory."""
+    store = CRISPRessoVariantStore.VariantStore(str(tmp_path), 2, max_loaded=2)
+    store.add_all([(i, 'read%d' % i, {'count': 1}) for i in range(10)])
+    for key in store:
+        store[key]['count'] += 1
+    assert [store[key]['count'] for key in store] == [2] * 10
+    store.close()
+
+
+def _make_variant(aln_seq, aln_ref, count=1):
+    """Return a variant object aligned to Reference, as made by get_new_variant_object."""
+    aln_scores = [90.5, None]
+    payload = CRISPRessoCOREResources.find_indels_substitutions(aln_seq, aln_ref, list(range(3, 9)))
+    payload['ref_name'] = 'Reference'
+    payload['aln_scores'] = aln_scores
+    payload['irregular_ends'] = aln_seq[0] != aln_ref[0]
+    payload['insertions_outside_window'] = 0
+    payload['deletions_outside_window'] = len(payload['all_deletion_coordinates']) - len(payload['deletion_coordinates'])
+    payload['substitutions_outside_window'] = len(payload['all_substitution_positions']) - len(payload['substitution_positions'])
+    payload['total_mods'] = 3
+    payload['mods_in_window'] = payload['substitution_n'] + payload['deletion_n'] + payload['insertion_n']
+    payload['mods_outside_window'] = payload['total_mods'] - payload['mods_in_window']
+    payload['classification'] = 'MODIFIED' if payload['mods_in_window'] else 'UNMODIFIED'
+    payload['aln_seq'] = aln_seq
+    payload['aln_ref'] = aln_ref
+    payload['aln_strand'] = '+'
+    return {
+        'count': count,
+        'aln_ref_names': ['Reference'],
+        'aln_scores': aln_scores,
+        'ref_aln_details': [('Reference', aln_seq, aln_ref, 90.5), ('HDR', None, None, None)],
+        'best_match_score': 90.5,
+        'variant_Reference': payload,
+        'best_match_name': 'Reference',
+        'class_name': 'Reference_' + payload['classification'],
+    }
+
+
+def _assert_same_variant(view, variant):
+    assert sorted(view.keys()) == sorted(variant.keys())
+    for key in variant:
+        if key.startswith('variant_'):
+            for field in CRISPRessoCOREResources.ResultsSlotsDict.__slots__:
+                value, expected = view[key][field], variant[key][field]
+                assert type(value) is type(expected), field
+                if isinstance(expected, np.ndarray):
+                    assert value.dtype == expected.dtype and value.tolist() == expected.tolist(), field
+                else:
+                    assert value == expected, field
+        else:
+            assert view[key] == variant[key], key
+
+
+def test_variant_columns_read_back_variants():
+    """Test that stored variants are read back with the same values and types, and that counts can be set."""
+    columns = CRISPRessoVariantStore.VariantColumns()
+    variants = [
+        _make_variant('AAT-GGCCTTA', 'AATTGGCC-TA', count=3),
+        _make_variant('GATTGGCATTA', 'AATTGGCCTTA'),
+        _make_variant('AATTGGCCTTA', 'AATTGGCCTTA', count=5),
+    ]
+    views = [columns.add(variant) for variant in variants]
+    assert len(columns) == 3
+    for view, variant in zip(views, variants):
+        _assert_same_variant(view, variant)
+        assert len(view) == len(variant)
+        assert 'variant_Reference' in view and 'variant_HDR' not in view
+    with pytest.raises(KeyError):
+        views[0]['variant_HDR']
+
+    views[0]['count'] = 0
+    views[1]['crispresso2_annotation'] = 'ALN=Reference'
+    assert [view['count'] for view in views] == [0, 1, 5]
+    assert views[1]['crispresso2_annotation'] == 'ALN=Reference'
+
+    unpickled = pickle.loads(pickle.dumps(views[2]))
+    assert type(unpickled) is dict
+    assert isinstance(unpickled['variant_Reference'], CRISPRessoCOREResources.ResultsSlotsDict)
+    _assert_same_variant(unpickled, variants[2])
+
+
+def test_variant_columns_keep_other_variants():
+    """Test that variants that can't be stored (e.g. with legacy payloads or not aligned) are returned unchanged."""
+    columns = CRISPRessoVariantStore.VariantColumns()
+    legacy_variant = _make_variant('AATTGGCCTTA', 'AATTGGCCTTA')
+    legacy_variant['variant_Reference'] = legacy_variant['variant_Reference'].__dict__
+    not_aligned_variant = {'count': 1, 'aln_scores': [10.0], 'ref_aln_details': [('Reference', None, None, 10.0)], 'best_match_score': 0}
+    assert columns.add(legacy_variant) is legacy_variant
+    assert columns.add(not_aligned_variant) is not_aligned_variant
+    assert len(columns) == 0